@@ -0,0 +1,123 @@
+#!/usr/bin/python
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the testkraut package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Micro-benchmark for output capturing in utils.run_command()
+
+Reports the CPU time (user+sys) consumed by the capturing process per MB of
+command output, for the previous polling implementation (reproduced below)
+and the current one, with and without spooling.
+
+Usage: bench_run_command.py [MB of output]
+"""
+
+__docformat__ = 'restructuredtext'
+
+import os
+import sys
+import time
+import select
+import datetime
+import resource
+import subprocess
+
+from testkraut.utils import run_command
+
+
+class LegacyStream(object):
+    # previous implementation, as taken from Nipype
+    def __init__(self, name, impl):
+        self._name = name
+        self._impl = impl
+        self._buf = ''
+        self._rows = []
+        self._lastidx = 0
+
+    def fileno(self):
+        return self._impl.fileno()
+
+    def read(self, drain=0):
+        while self._read(drain) is not None:
+            if not drain:
+                break
+
+    def _read(self, drain):
+        fd = self.fileno()
+        buf = os.read(fd, 4096)
+        if not buf and not self._buf:
+            return None
+        if '\n' not in buf:
+            if not drain:
+                self._buf += buf
+                return []
+        buf = self._buf + buf
+        if '\n' in buf:
+            tmp, rest = buf.rsplit('\n', 1)
+        else:
+            tmp = buf
+            rest = None
+        self._buf = rest
+        now = datetime.datetime.now().isoformat()
+        rows = tmp.split('\n')
+        self._rows += [(now, '%s %s:%s' % (self._name, now, r), r) for r in rows]
+        self._lastidx = len(self._rows)
+
+
+def legacy_run_command(cmdline, cwd=None, env=None, timeout=0.01):
+    PIPE = subprocess.PIPE
+    proc = subprocess.Popen(cmdline, stdout=PIPE, stderr=PIPE, shell=True,
+                            cwd=cwd, env=env)
+    streams = [LegacyStream('stdout', proc.stdout),
+               LegacyStream('stderr', proc.stderr)]
+
+    def _process(drain=0):
+        res = select.select(streams, [], [], timeout)
+        for stream in res[0]:
+            stream.read(drain)
+
+    while proc.returncode is None:
+        proc.poll()
+        _process()
+    returncode = proc.returncode
+    _process(drain=1)
+    result = {}
+    temp = []
+    for stream in streams:
+        rows = stream._rows
+        temp += rows
+        result[stream._name] = [r[2] for r in rows]
+    temp.sort()
+    result['merged'] = [r[1] for r in temp]
+    result['retval'] = returncode
+    return result
+
+
+def _cpu_time():
+    ru = resource.getrusage(resource.RUSAGE_SELF)
+    return ru.ru_utime + ru.ru_stime
+
+def bench(label, func, nmb):
+    # ~80 byte lines, like a chatty tool would produce
+    cmd = 'yes "%s" | head -c %i' % ('x' * 79, nmb * 1024 * 1024)
+    wall = time.time()
+    cpu = _cpu_time()
+    func(cmd)
+    cpu = _cpu_time() - cpu
+    wall = time.time() - wall
+    print('%-28s %8.3f s CPU/MB  %8.3f s wall' % (label, cpu / nmb, wall))
+
+def main():
+    nmb = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    print('capturing %i MB of output' % nmb)
+    bench('legacy (10ms polling)', legacy_run_command, nmb)
+    bench('run_command()', run_command, nmb)
+    bench('run_command(spool_size=1MB)',
+          lambda cmd: run_command(cmd, spool_size=1024 * 1024), nmb)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/python
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the testkraut package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Micro-benchmark for the differences between long sequences
+
+Reports the wall clock time of seqdiff.get_opcodes() and of
+difflib.SequenceMatcher for lists of strings with a number of typical
+modifications. difflib is skipped for lists longer than the given limit, as
+it can take very long.
+
+Usage: bench_seqdiff.py [number of elements] [difflib limit]
+"""
+
+__docformat__ = 'restructuredtext'
+
+import sys
+import time
+import random
+import difflib
+
+from testkraut.seqdiff import get_opcodes
+
+
+def _changed(a):
+    # the same values, some of them changed in place
+    b = list(a)
+    for i in random.sample(xrange(len(b)), len(b) // 100):
+        b[i] = b[i] + '_changed'
+    return b
+
+def _edited(a):
+    # some insertions and deletions
+    b = list(a)
+    for i in sorted(random.sample(xrange(len(b)), 20), reverse=True):
+        if i % 2:
+            del b[i]
+        else:
+            b.insert(i, 'inserted%i' % i)
+    return b
+
+def _repetitive(a):
+    # few distinct values, as in argument lists or table columns
+    return ['value%i' % (i % 7) for i in xrange(len(a))]
+
+def _shifted(a):
+    # a block moved from the start to the end
+    n = len(a) // 10
+    return a[n:] + a[:n]
+
+def bench(name, func, a, b, repeats=3):
+    timings = []
+    for i in range(repeats):
+        wall = time.time()
+        opcodes = func(a, b)
+        timings.append(time.time() - wall)
+    changed = sum([oc[2] - oc[1] for oc in opcodes if oc[0] != 'equal'])
+    print('  %-10s %10.4f s  (%i opcodes, %i elements differ)'
+          % (name, min(timings), len(opcodes), changed))
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    difflib_limit = int(sys.argv[2]) if len(sys.argv) > 2 else n
+    random.seed(0)
+    a = ['element %i' % i for i in xrange(n)]
+    for name, modify in (('changed in place', _changed),
+                         ('insertions/deletions', _edited),
+                         ('shifted block', _shifted),
+                         ('few distinct values', _repetitive)):
+        b = modify(a)
+        fr = a if modify != _repetitive else _edited(b)
+        print('%s (%i elements)' % (name, n))
+        bench('seqdiff', get_opcodes, fr, b)
+        if n <= difflib_limit:
+            bench('difflib',
+                  lambda x, y: difflib.SequenceMatcher(None, x, y).get_opcodes(),
+                  fr, b, repeats=1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/python
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the testkraut package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Micro-benchmark for placing test input files into a testbed
+
+Reports the wall clock time per GB of input for each staging mode of
+lookup.stage_file(). The input file and testbeds are created in the given
+directory (default: the temp directory), as staging performance depends on
+the file system.
+
+Usage: bench_staging.py [MB of input] [directory]
+"""
+
+__docformat__ = 'restructuredtext'
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+from testkraut.lookup import stage_file, staging_modes
+
+
+def bench(mode, src, wdir, nmb, repeats=3):
+    timings = []
+    for i in range(repeats):
+        dst = os.path.join(wdir, 'testbed_%s_%i' % (mode, i))
+        os.makedirs(dst)
+        wall = time.time()
+        used = stage_file(src, os.path.join(dst, 'input.nii.gz'), mode)
+        timings.append(time.time() - wall)
+        shutil.rmtree(dst)
+    best = min(timings)
+    print('%-10s %10.4f s/GB%s' % (mode, best * 1024. / nmb,
+                                   '' if used == mode
+                                      else '  (fell back to %s)' % used))
+
+def main():
+    nmb = int(sys.argv[1]) if len(sys.argv) > 1 else 1024
+    basedir = sys.argv[2] if len(sys.argv) > 2 else None
+    wdir = tempfile.mkdtemp(prefix='testkraut_bench', dir=basedir)
+    try:
+        src = os.path.join(wdir, 'input')
+        chunk = os.urandom(1024 * 1024)
+        with open(src, 'wb') as f:
+            for i in range(nmb):
+                f.write(chunk)
+        print('staging a %i MB input file in %s' % (nmb, wdir))
+        for mode in staging_modes:
+            bench(mode, src, wdir, nmb)
+    finally:
+        shutil.rmtree(wdir)
+
+if __name__ == '__main__':
+    main()
@@ -16,3 +16,4 @@ import cmd_cachefiles
 import cmd_diff
 import cmd_export2table
 import cmd_compare
+import cmd_run
@@ -8,6 +8,15 @@
 ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
 """Cache input files requires by test(s).
 
+With --verify the content of all files in the cache is checked against
+their hash instead. Corrupt files are moved into a quarantine directory in
+the cache, and dangling symlinks (e.g. to files that were moved) are
+removed. Files that did not change since their last successful verification
+are skipped, unless --full is given.
+
+Examples:
+
+$ testkraut cachefiles --verify --report verify.json
 """
 
 __docformat__ = 'restructuredtext'
@@ -17,13 +26,12 @@ __docformat__ = 'restructuredtext'
 
 import argparse
 import os
-import shutil
-import urllib2
-from os.path import join as opj
-from glob import glob
+from ..fileindex import get_file_index
+from ..filecache import FileCache
+from ..hashstore import fetch_into_cache
 from ..spec import SPEC
-from ..utils import sha1sum, get_test_library_paths, get_spec, get_filecache_dir
-from testkraut import cfg
+from ..specindex import get_spec_index
+from ..utils import get_test_library_paths, get_spec
 from .helpers import parser_add_common_args
 
 parser_args = dict(formatter_class=argparse.RawDescriptionHelpFormatter)
@@ -36,96 +44,105 @@ def setup_parser(parser):
             help="where to search for files")
     parser.add_argument('--copy', action='store_true',
             help="copy files into the cache instead of symlinking them")
+    parser.add_argument('--verify', action='store_true',
+            help="""verify the content of all cached files instead of
+                 caching files""")
+    parser.add_argument('--full', action='store_true',
+            help="""with --verify, also verify files that did not change since
+                 their last verification""")
+    parser.add_argument('--report', metavar='FILENAME',
+            help="""with --verify, write a report in JSON format to this file
+                 ('-' for stdout)""")
+
+def verify(args):
+    import json
+    import sys
+    lgr = args.logger
+    cache = FileCache(args.filecache)
+    cache.cleanup()
+    def progress(ndone, ntotal, filename):
+        lgr.debug("verified %i of %i files" % (ndone, ntotal))
+    report = cache.verify(full=args.full, progress=progress)
+    lgr.info("verified %i file(s), %i unchanged, %i corrupt, %i dangling"
+             % tuple([len(report[k])
+                        for k in ('ok', 'unchanged', 'corrupt', 'dangling')]))
+    if not args.report is None:
+        if args.report == '-':
+            json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        else:
+            with open(args.report, 'w') as reportfile:
+                json.dump(report, reportfile, indent=2, sort_keys=True)
+    if len(report['corrupt']):
+        raise RuntimeError("corrupt files found in the cache")
 
 def run(args):
     lgr = args.logger
     lgr.debug("using file cache at '%s'" % args.filecache)
+    if args.verify:
+        return verify(args)
     if not len(args.ids):
         # if none specified go through all the SPECs in the lib
-        args.ids = []
-        for tld in get_test_library_paths(args.library): 
-            args.ids.extend([os.path.basename(d)
-                                for d in glob(opj(tld, '*'))
-                                        if os.path.isdir(d)])
+        specs = ((spec_id, SPEC(open(spec_fname)))
+                    for spec_fname, spec_id, error
+                        in get_spec_index().refresh(
+                                get_test_library_paths(args.library))
+                    if error is None)
+    else:
+        specs = ((test_id, get_spec(test_id, args.library))
+                    for test_id in args.ids)
     wanted_files = set()
     hash_lookup = {}
+    # known size and quicksum of wanted files
+    file_props = {}
     # scan the SPECs of all tests for needed files and their sha1sums
-    for test_id in args.ids:
+    for test_id, spec in specs:
         lgr.debug("scan required files for test '%s'" % test_id)
-        spec = get_spec(test_id, args.library)
         for _, input in spec.get_inputs('file').iteritems():
             if 'sha1sum' in input:
                 wanted_files.add(input['sha1sum'])
                 hash_lookup[input['sha1sum']] = (test_id, input.get('value', ''))
+                file_props[input['sha1sum']] = dict(
+                        size=input.get('size', None),
+                        quicksum=input.get('quicksum', None))
                 lgr.debug("add '%s' (%s) to the list of files to look for"
                           % (input.get('value', ''), input['sha1sum']))
-    # what do we have in the cache?
-    have_files = [os.path.basename(f) for f in glob(opj(args.filecache, '*'))
-                        if os.path.isfile(f)]
+    cache = FileCache(args.filecache)
+    # leftovers of crashed processes
+    cache.cleanup()
     # what is missing
-    missing_files = wanted_files.difference(have_files)
+    missing_files = set([sha1 for sha1 in wanted_files if not sha1 in cache])
     search_cache = {}
     # search in all locale dirs
     for search_dir in (args.search + args.library):
-        for root, dirnames, filenames in os.walk(search_dir):
-            for fname in filenames:
-                fpath = opj(root, fname)
-                sha1 = sha1sum(fpath)
-                if sha1 in missing_files:
-                    # make path relative to cache dir
-                    search_cache[sha1] = os.path.relpath(fpath, args.filecache)
-                    lgr.debug("found missing '%s' at '%s'" % (sha1, fpath))
-                    missing_files.remove(sha1)
-    # ensure the cache is there
-    if not os.path.exists(args.filecache):
-        os.makedirs(args.filecache)
-    # try downloading missing files from the web
-    hashpots = cfg.get('hash stores', 'http').split()
-    for sha1 in missing_files.copy():
-        for hp in hashpots:
-            try:
-                urip = urllib2.urlopen('%s%s' % (hp, sha1))
-                dst_path = opj(args.filecache, sha1)
-                fp = open(dst_path, 'wb')
-                lgr.debug("download '%s%s'->'%s'" % (hp, sha1, dst_path))
-                fp.write(urip.read())
-                fp.close()
+        if not os.path.isdir(search_dir):
+            continue
+        index = get_file_index(search_dir)
+        for sha1 in missing_files.copy():
+            fpath = index.find_by_sha1(sha1, **file_props[sha1])
+            if not fpath is None:
+                search_cache[sha1] = fpath
+                lgr.debug("found missing '%s' at '%s'" % (sha1, fpath))
                 missing_files.remove(sha1)
-                break
-            except urllib2.HTTPError:
-                lgr.debug("cannot find '%s' at '%s'" % (sha1, hp))
-            except urllib2.URLError:
-                lgr.debug("cannot connect to at '%s'" % hp)
+    # try downloading missing files from the web
+    missing_files.difference_update(fetch_into_cache(cache, missing_files))
     # copy/link them into the cache
     for sha1, fpath in search_cache.iteritems():
-        dst_path = opj(args.filecache, sha1)
-        if os.path.lexists(dst_path):
-            if os.path.islink(dst_path):
-                # remove existing symlink
-                os.remove(dst_path)
-                lgr.debug("removing existing symlink '%s' in filecache"
-                          % dst_path)
-            else:
-                lgr.warning(
-                    "Will not replace existing non-symlink cache content: [%s: %s (%s)]"
-                    % (hash_lookup[sha1] + (sha1,)))
-        if not args.copy:
-            os.symlink(fpath, dst_path)
-            lgr.debug("symlink '%s'->'%s'" % (fpath, dst_path))
-        elif hasattr(os, 'link'):
+        if args.copy:
             # be nice and try hard-linking
-            try:
-                os.link(fpath, dst_path)
-                lgr.debug("hardlink '%s'->'%s'" % (fpath, dst_path))
-            except OSError:
-                # silently fail if linking doesn't work (e.g.
-                # cross-device link ... will recover later
-                shutil.copy(fpath, dst_path)
-                lgr.debug("copylink '%s'->'%s'" % (fpath, dst_path))
+            mode = 'hardlink'
         else:
-            shutil.copy(fpath, dst_path)
-            lgr.debug("copylink '%s'->'%s'" % (fpath, dst_path))
+            mode = 'symlink'
+        with cache.get_entry_lock(sha1):
+            if sha1 in cache:
+                # added by someone else meanwhile
+                continue
+            cache.insert(sha1, fpath, mode=mode)
+            lgr.debug("%s '%s'->'%s'" % (mode, fpath, sha1))
     if len(missing_files):
         lgr.warning('cannot find needed file(s):')
         for mf in missing_files:
             lgr.warning('  %s: %s (%s)' % (hash_lookup[mf] + (mf,)))
+    cache.flush()
+    lgr.info("file cache: %(hits)i hits, %(misses)i misses, "
+             "%(insertions)i insertions, %(evictions)i evictions"
+             % cache.stats)
@@ -18,7 +18,10 @@ __docformat__ = 'restructuredtext'
 import sys
 import argparse
 import re
-from ..spec import SPEC
+import json
+import sre_parse
+import sre_constants
+from ..spec import SPEC, SPECJSONEncoder
 from .helpers import parser_add_common_args
 
 try:
@@ -44,7 +47,13 @@ def setup_parser(parser):
     parser.add_argument('--min-rel-numdiff', type=float,
             help="""minimum relative numerical difference to be considered an
                  actual difference. Differences are evaluated relative to the
-                 first input (``from``).""")
+                 first input (``from``). If both thresholds are given, they
+                 add up to a single tolerance.""")
+    parser.add_argument('--max-edit-distance', type=int,
+            help="""maximum number of insertions and deletions with which
+                 shifted sequence elements are aligned. Sequence regions that
+                 differ more are reported as replaced as a whole. Default:
+                 1000""")
     parser.add_argument('--exclude-types', nargs='+',
             choices=('num', 'str', 'seq', 'mis'), default=tuple(),
             help="""exclude one or more types of differences from the output.
@@ -54,12 +63,49 @@ def setup_parser(parser):
                  """)
     parser_add_common_args(parser, opt=('include_spec_elements',
                                         'exclude_spec_elements'))
+    parser.add_argument('--json', action='store_true',
+            help="""print one JSON object per difference and line, instead of
+                 a colored diff. Each object has the ``location`` of the
+                 difference, its ``type`` (see --exclude-types), and the
+                 difference record.""")
     parser.add_argument('specs', nargs=2, metavar='SPEC',
             help="SPEC name/identifier")
 
 def print_diff_hdr(fr, to, mode):
     print '%sdiff --%s\n--- %s\n+++ %s' % (style.BRIGHT, mode, fr, to)
 
+def _get_difftype(diffspec):
+    if 'ndiff' in diffspec:
+        return 'str'
+    elif 'numdiff' in diffspec or 'arraydiff' in diffspec:
+        return 'num'
+    elif 'seqmatch' in diffspec:
+        return 'seq'
+    else:
+        return 'mis'
+
+def print_json(breadcrumbs, diffspec, fr, to, exclude_types):
+    difftype = _get_difftype(diffspec)
+    if difftype in exclude_types:
+        return
+    record = dict([(k, v) for k, v in diffspec.iteritems()
+                        if k != '%%magic%%'])
+    record['location'] = breadcrumbs
+    record['type'] = difftype
+    if difftype == 'str':
+        record['ndiff'] = list(diffspec['ndiff'])
+    elif difftype == 'mis':
+        record['from'] = fr
+        record['to'] = to
+    print json.dumps(record, cls=SPECJSONEncoder, sort_keys=True,
+                     allow_nan=False)
+
+def _format_max(value):
+    # maximum of an array difference -- None if it is infinite
+    if value is None:
+        return 'inf'
+    return '%g' % value
+
 def print_diff(breadcrumbs, diffspec, fr, to, exclude_types):
     if 'ndiff' in diffspec:
         if 'str' in exclude_types:
@@ -77,6 +123,20 @@ def print_diff(breadcrumbs, diffspec, fr, to, exclude_types):
             return
         print_diff_hdr(breadcrumbs, breadcrumbs, 'num')
         print '$ %s' % diffspec['numdiff']
+    elif 'arraydiff' in diffspec:
+        if 'num' in exclude_types:
+            return
+        print_diff_hdr(breadcrumbs, breadcrumbs, 'num')
+        summary = diffspec['arraydiff']
+        print '$ %i of %i values differ (max abs: %s, max rel: %s)' \
+                % (summary['count'], summary['size'],
+                   _format_max(summary['max_abs']),
+                   _format_max(summary['max_rel']))
+        # the largest differences
+        for index, f, t in summary['top']:
+            print colors.CYAN + '@@ %s @@' % (index,)
+            print colors.RED + '- %s' % f
+            print colors.GREEN + '+ %s' % t
     elif 'seqmatch' in diffspec:
         if 'seq' in exclude_types:
             return
@@ -106,53 +166,68 @@ def print_diff(breadcrumbs, diffspec, fr, to, exclude_types):
         if not to is None:
             print colors.GREEN + '+ %s' % to
 
-def walk_difftree(dt, fr, to, render, breadcrumbs=None, exclude_types=None,
-                  exclude_elements=None, include_elements=None):
-    if exclude_types is None:
-        exclude_types = tuple()
-    if breadcrumbs is None:
-        breadcrumbs = []
-    for i, k in enumerate(dt):
-        if isinstance(dt, dict):
-            v = dt[k]
-            f = fr.get(k, None)
-            t = to.get(k, None)
-            breadcrumb = k
-        else:
-            v = k
-            f = fr[i]
-            t = to[i]
-            breadcrumb = '(%i)' % i
-        if not (isinstance(v, dict) or isinstance(v, list)):
-            # non-container
-            continue
-        if isinstance(v, dict) and '%%magic%%' in v and v['%%magic%%'] == 'diff':
-            # we found a diff -- render it
-            bc_str = '->'.join(breadcrumbs + [breadcrumb])
-            if not include_elements is None:
-                # how often does this location string match any given include
-                # expression
-                incmatches = sum([not exp.match(bc_str) is None for exp
-                                    in include_elements])
-                if not incmatches > 0:
-                    # if not at least one matches, skip this one
-                    continue
-            if not exclude_elements is None:
-                # how often does this location string match any given exclude
-                # expression
-                excmatches = sum([not exp.match(bc_str) is None for exp
-                                    in exclude_elements])
-                if excmatches > 0:
-                    # if at least one matches, skip this one too
-                    continue
-            render(bc_str, v, f, t, exclude_types=exclude_types)
-        else:
-            # walk further
-            walk_difftree(v, f, t, render, breadcrumbs + [breadcrumb],
-                          exclude_types=exclude_types,
-                          include_elements=include_elements,
-                          exclude_elements=exclude_elements,
-                          )
+def _get_location(path):
+    # location string of a diff record
+    return '->'.join([('(%i)' % p) if isinstance(p, int) else p for p in path])
+
+def _get_literal_prefix(exp):
+    # text that every match of a compiled regular expression starts with
+    prefix = ''
+    if exp.flags & re.IGNORECASE:
+        return prefix
+    for op, arg in sre_parse.parse(exp.pattern):
+        # stay with ASCII to be comparable with byte and unicode locations
+        if op != sre_constants.LITERAL or arg > 127:
+            break
+        prefix += chr(arg)
+    return prefix
+
+# regular expression constructs whose match depends on the text that
+# follows the matched text
+_lookahead_tokens = ('$', '\\Z', '\\b', '\\B', '(?=', '(?!')
+
+def _get_pruner(include_elements, exclude_elements):
+    # function that determines whether all differences in and below a
+    # location would be filtered out, so it needs no comparison at all
+    if not include_elements is None:
+        # no match of an include expression can start with anything else
+        prefixes = [_get_literal_prefix(exp) for exp in include_elements]
+    if not exclude_elements is None:
+        # if these match a location, they match all locations below it
+        subtree_excludes = [exp for exp in exclude_elements
+                            if not sum([t in exp.pattern
+                                        for t in _lookahead_tokens])]
+    def prune(path):
+        location = _get_location(path)
+        if not include_elements is None \
+           and not sum([p.startswith(location) or location.startswith(p)
+                        for p in prefixes]):
+            return True
+        if not exclude_elements is None \
+           and sum([not exp.match(location) is None
+                    for exp in subtree_excludes]):
+            return True
+        return False
+    return prune
+
+def _is_selected(location, include_elements, exclude_elements):
+    if not include_elements is None:
+        # how often does this location string match any given include
+        # expression
+        incmatches = sum([not exp.match(location) is None for exp
+                            in include_elements])
+        if not incmatches > 0:
+            # if not at least one matches, skip this one
+            return False
+    if not exclude_elements is None:
+        # how often does this location string match any given exclude
+        # expression
+        excmatches = sum([not exp.match(location) is None for exp
+                            in exclude_elements])
+        if excmatches > 0:
+            # if at least one matches, skip this one too
+            return False
+    return True
 
 def run(args):
     for argname in ('include_elements', 'exclude_elements'):
@@ -162,13 +237,22 @@ def run(args):
                 setattr(args, argname, [re.compile(e) for e in arg])
             except re.error:
                 raise ValueError("malformed regular expression in %s" % arg)
+    if args.json:
+        render = print_json
+    else:
+        render = print_diff
     fspec = SPEC(open(args.specs[0]))
     tspec = SPEC(open(args.specs[1]))
-    difftree = fspec.diff(tspec,
-                          min_abs_numdiff=args.min_abs_numdiff,
-                          min_rel_numdiff=args.min_abs_numdiff)
-    walk_difftree(difftree, fspec, tspec, print_diff,
-                  exclude_types=args.exclude_types,
-                  include_elements=args.include_elements,
-                  exclude_elements=args.exclude_elements,
-                  )
+    # render differences as they are found
+    for path, diffspec, fr, to in fspec.iter_diff(
+            tspec,
+            min_abs_numdiff=args.min_abs_numdiff,
+            min_rel_numdiff=args.min_rel_numdiff,
+            max_edit_distance=args.max_edit_distance,
+            prune=_get_pruner(args.include_elements, args.exclude_elements)):
+        location = _get_location(path)
+        if not _is_selected(location, args.include_elements,
+                            args.exclude_elements):
+            continue
+        render(location, diffspec, fr, to, exclude_types=args.exclude_types)
+        sys.stdout.flush()
@@ -30,7 +30,8 @@ import re
 import itertools
 from os.path import join as opj
 from ..spec import SPEC
-from ..utils import sha1sum, get_cmd_prov_strace, guess_file_tags
+from ..utils import sha1sum, hash_files, quicksum, get_cmd_prov_strace, \
+        guess_file_tags
 from ..pkg_mngr import PkgManager
 from .helpers import parser_add_common_opt
 
@@ -84,7 +85,9 @@ def setup_parser(parser):
     parser.add_argument('arg', nargs='+', metavar='ARGS',
         help="""command or workflow filename""")
 
-def get_dir_hashes(path, ignore=None):
+def get_dir_hashes(path, ignore=None, stats=False):
+    # sha1 of all files in a directory tree, or with ``stats`` a dict with
+    # their sha1, size, and quicksum
     if ignore is None:
         ignore = []
     dir_content = []
@@ -94,8 +97,13 @@ def get_dir_hashes(path, ignore=None):
         dirfiles = [fn for fn in itertools.imap(opj,
                                                 [dirlist[0]] * nfiles,
                                                 tocheck)]
-        dir_content += [(fn, sha1sum(fn)) for fn in dirfiles if os.path.isfile(fn)]
-    return dict(dir_content)
+        dir_content += [fn for fn in dirfiles if os.path.isfile(fn)]
+    hashes = hash_files(dir_content)
+    if not stats:
+        return dict([(fn, h['sha1']) for fn, h in hashes.iteritems()])
+    return dict([(fn, dict(sha1=h['sha1'], size=os.path.getsize(fn),
+                           quicksum=quicksum(fn)))
+                    for fn, h in hashes.iteritems()])
 
 def find_executables(path):
     executables = []
@@ -146,7 +154,11 @@ def run(args):
     # assume execution within the testbed
     testbed_dir = os.path.abspath(os.curdir)
     # get the state of the union
-    prior_test_hashes = get_dir_hashes(testbed_dir)
+    # (size and quicksum of inputs have to be recorded before the command
+    # can modify, move, or delete them)
+    prior_test_stats = get_dir_hashes(testbed_dir, stats=True)
+    prior_test_hashes = dict([(fn, st['sha1'])
+                                for fn, st in prior_test_stats.iteritems()])
     # run through strace
     if args.no_strace:
         testcmd = subprocess.Popen(args.arg,
@@ -209,8 +221,12 @@ def run(args):
         if not relname in used_files:
             # skip
             continue
+        # size and quicksum allow for ruling out most files quickly when
+        # searching for this input
         s = dict(type='file', value=relname,
-                 sha1sum=prior_test_hashes[ipf])
+                 sha1sum=prior_test_stats[ipf]['sha1'],
+                 size=prior_test_stats[ipf]['size'],
+                 quicksum=prior_test_stats[ipf]['quicksum'])
         spec['inputs']['file:%s' % relname] = s
     # record all output files
     for opf in new_files:
@@ -0,0 +1,87 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the testkraut package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Run test SPECs from the test libraries.
+
+If no SPEC IDs are given, all SPECs found in any configured test library
+are executed. With -j multiple SPECs are executed in parallel by a pool of
+worker processes. SPECs that have their ``exclusive`` flag set are always
+executed alone, after all other tests have completed.
+
+Results of a previous passing run of a SPEC are reused, if the SPEC, its
+input files, its dependencies, and the relevant environment are unchanged
+(--force disables this).
+
+Results are reported in a human-readable form, or as a subunit stream
+(--subunit; requires python-subunit).
+
+Examples:
+
+$ testkraut run -j 8
+
+$ testkraut run -j 8 --subunit fsl-mcflirt afni-fmri-glm | subunit2pyunit
+"""
+
+__docformat__ = 'restructuredtext'
+
+# magic line for manpage summary
+# man: -*- % run test SPECs from the test libraries
+
+import argparse
+import sys
+from .helpers import parser_add_common_args
+
+parser_args = dict(formatter_class=argparse.RawDescriptionHelpFormatter)
+
+def setup_parser(parser):
+    parser.add_argument('ids', nargs='*', metavar='ID',
+            help="SPEC name/identifier")
+    parser_add_common_args(parser, opt=('librarypaths',))
+    parser.add_argument('-s', '--search', action='append', default=[],
+            help="where to search for test input files")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+            help="""number of SPECs to execute in parallel. If 0, the number
+                 of CPUs in the system is used.""")
+    parser.add_argument('--subunit', action='store_true',
+            help="report results as a subunit stream on stdout")
+    parser.add_argument('--force', action='store_true',
+            help="""execute all SPECs, even if results of a previous run of an
+                 unchanged SPEC could be reused""")
+
+def run(args):
+    lgr = args.logger
+    from ..utils import get_test_library_paths
+    from ..testcase import discover_specs
+    from ..runner import run_specs
+    specs = discover_specs(get_test_library_paths(args.library))
+    if len(args.ids):
+        wanted = [i.replace('-', '_') for i in args.ids]
+        unknown = [i for i in wanted if not i in specs]
+        if len(unknown):
+            raise ValueError("cannot find SPEC(s) for test(s): %s"
+                             % ', '.join(unknown))
+        specs = dict([(i, specs[i]) for i in wanted])
+    nprocs = args.jobs
+    if nprocs < 1:
+        import multiprocessing
+        nprocs = multiprocessing.cpu_count()
+    if args.subunit:
+        import subunit
+        result = subunit.TestProtocolClient(sys.stdout)
+    else:
+        import testtools
+        result = testtools.TextTestResult(sys.stdout)
+    lgr.debug("run %i tests with %i worker(s)" % (len(specs), nprocs))
+    result.startTestRun()
+    try:
+        run_specs(specs, result, search_dirs=args.search, nprocs=nprocs,
+                  force=args.force)
+    finally:
+        result.stopTestRun()
+    if not args.subunit and not result.wasSuccessful():
+        raise RuntimeError("abort due to test failure")
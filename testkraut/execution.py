@@ -0,0 +1,718 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the testkraut package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Execution environment for test code"""
+
+__docformat__ = 'restructuredtext'
+
+import os
+import threading
+from contextlib import contextmanager
+
+from six import text_type
+
+from .utils import expandvars, which
+
+import logging
+lgr = logging.getLogger(__name__)
+
+# serializes all code that needs to temporarily modify the process-wide
+# environment and working directory
+_activation_lock = threading.RLock()
+
+
+class ExecutionContext(object):
+    """Environment variables and working directory for executing a test
+
+    A context carries its own environment mapping and working directory,
+    and hands them explicitly to any subprocess that is started for a test.
+    Neither ``os.environ``, nor the current working directory of the process
+    are modified, hence multiple tests can be executed concurrently (e.g. in
+    threads) within the same interpreter.
+
+    Parameters
+    ----------
+    cwd : path or None
+      Working directory. Defaults to the current working directory.
+    env : dict or None
+      Environment variables. Defaults to a copy of ``os.environ``.
+    """
+    def __init__(self, cwd=None, env=None):
+        if cwd is None:
+            cwd = os.getcwd()
+        if env is None:
+            env = os.environ
+        self.cwd = cwd
+        self.env = dict(env)
+
+    def expandvars(self, path):
+        """Expand environment variables in a path using the context's env"""
+        return expandvars(path, self.env)
+
+    def which(self, program):
+        """Locate an executable in the context's search path"""
+        return which(program, self.env)
+
+    def abspath(self, path):
+        """Return an absolute path, relative paths are anchored at cwd"""
+        return os.path.join(self.cwd, self.expandvars(path))
+
+    def popen(self, cmd, **kwargs):
+        """Start a subprocess within this context
+
+        All keyword arguments are passed on to ``subprocess.Popen``.
+        """
+        import subprocess
+        kwargs.setdefault('cwd', self.cwd)
+        kwargs.setdefault('env', self.env)
+        return subprocess.Popen(cmd, **kwargs)
+
+    @contextmanager
+    def activate(self):
+        """Temporarily apply this context to the whole process
+
+        This is only needed for code that has to run within the current
+        interpreter (e.g. Python test code) and uses ``os.environ`` or
+        relative paths. As this affects the entire process, activations of
+        all contexts are serialized, i.e. code running in an activated
+        context never runs concurrently with other such code.
+        """
+        with _activation_lock:
+            environ_restore = dict(os.environ)
+            initial_cwd = os.getcwd()
+            os.environ.clear()
+            os.environ.update(self.env)
+            os.chdir(self.cwd)
+            try:
+                yield self
+            finally:
+                os.chdir(initial_cwd)
+                os.environ.clear()
+                os.environ.update(environ_restore)
+
+
+def _strip_partial_utf8(data, at_start=False):
+    # remove an incomplete UTF-8 encoded character from the end (or the
+    # start) of a byte string
+    octets = bytearray(data)
+    if at_start:
+        i = 0
+        # skip continuation bytes
+        while i < min(3, len(octets)) and 0x80 <= octets[i] < 0xC0:
+            i += 1
+        return data[i:]
+    i = len(octets) - 1
+    while i >= max(0, len(octets) - 3) and 0x80 <= octets[i] < 0xC0:
+        i -= 1
+    if i >= 0 and octets[i] >= 0xC0:
+        # lead byte: how long should the sequence be
+        length = 2 if octets[i] < 0xE0 else 3 if octets[i] < 0xF0 else 4
+        if len(octets) - i < length:
+            return data[:i]
+    return data
+
+def summarize_output(filename, preview_size=4096):
+    """Describe a file with captured output of a test
+
+    Returns
+    -------
+    dict
+      With the size of the output in ``bytes``, its ``sha1sum``, and a
+      ``preview``. If the output is larger than twice the ``preview_size``,
+      the preview is limited to the first and the last ``preview_size`` bytes
+      (or less, to not split a UTF-8 encoded character). The preview is
+      decoded as UTF-8, with invalid bytes replaced.
+    """
+    from .utils import sha1sum
+    size = os.path.getsize(filename)
+    with open(filename, 'rb') as f:
+        if size <= 2 * preview_size:
+            preview = f.read()
+        else:
+            head = _strip_partial_utf8(f.read(preview_size))
+            f.seek(-preview_size, os.SEEK_END)
+            tail = _strip_partial_utf8(f.read(), at_start=True)
+            preview = b''.join((
+                head,
+                ('\n[... %i bytes omitted ...]\n'
+                    % (size - len(head) - len(tail))).encode(),
+                tail))
+    return dict(preview=preview.decode('utf-8', 'replace'), bytes=size,
+                sha1sum=sha1sum(filename))
+
+def match_output_file(filename, test, target):
+    """Check a file with captured output of a test without loading it
+
+    Parameters
+    ----------
+    filename : path
+    test : {'value', 'contains', 'matches', 'startswith', 'endswith'}
+      Whether the output equals the target, contains it, matches it (as a
+      regular expression from the start), or starts or ends with it.
+    target : str
+      Unicode targets are UTF-8 encoded.
+
+    Returns
+    -------
+    bool
+    """
+    import re
+    import mmap
+    if isinstance(target, text_type):
+        target = target.encode('utf-8')
+    size = os.path.getsize(filename)
+    with open(filename, 'rb') as f:
+        if test == 'value':
+            return size == len(target) and f.read() == target
+        elif test == 'startswith':
+            return f.read(len(target)) == target
+        elif test == 'endswith':
+            if len(target) > size:
+                return False
+            f.seek(size - len(target))
+            return f.read() == target
+        elif test == 'contains':
+            if not len(target):
+                return True
+            # keep enough of the previous chunk for matches across chunks
+            overlap = b''
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                chunk = overlap + chunk
+                if target in chunk:
+                    return True
+                overlap = chunk[max(0, len(chunk) - len(target) + 1):]
+            return False
+        elif test == 'matches':
+            if not size:
+                return not re.match(target, b'') is None
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                return not re.match(target, mapped) is None
+            finally:
+                mapped.close()
+    raise ValueError("unknown output test '%s'" % test)
+
+
+def _rusage2dict(ru):
+    import platform
+    # ru_maxrss is reported in kilobytes on Linux, but in bytes on OSX
+    maxrss_unit = 1 if platform.system() == 'Darwin' else 1024
+    return dict(
+        cpu_user=ru.ru_utime,
+        cpu_system=ru.ru_stime,
+        max_rss=ru.ru_maxrss * maxrss_unit,
+        # block I/O operations are counted in units of 512 bytes
+        io_read_bytes=ru.ru_inblock * 512,
+        io_write_bytes=ru.ru_oublock * 512,
+        ctx_switches_voluntary=ru.ru_nvcsw,
+        ctx_switches_involuntary=ru.ru_nivcsw)
+
+def wait_for_process(proc):
+    """Wait for a subprocess to finish and determine its resource usage
+
+    The reported resource usage includes all descendants of the process that
+    have been waited for.
+
+    Parameters
+    ----------
+    proc : subprocess.Popen
+
+    Returns
+    -------
+    returncode, dict
+      The dictionary contains CPU times (``cpu_user``, ``cpu_system``; in
+      seconds), peak resident memory (``max_rss``; in bytes), bytes read from
+      and written to storage (``io_read_bytes``, ``io_write_bytes``), and the
+      number of context switches (``ctx_switches_voluntary``,
+      ``ctx_switches_involuntary``).
+    """
+    proc.returncode, resources = _wait4(proc.pid)
+    return proc.returncode, resources
+
+def _wait4(pid):
+    import errno
+    while True:
+        try:
+            _, status, ru = os.wait4(pid, 0)
+            break
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+    if os.WIFSIGNALED(status):
+        returncode = -os.WTERMSIG(status)
+    else:
+        returncode = os.WEXITSTATUS(status)
+    return returncode, _rusage2dict(ru)
+
+@contextmanager
+def record_resource_usage(info):
+    """Record the resource usage of code executed in the current process
+
+    Upon exit, ``info`` is updated with the wall clock time (``wallclock``;
+    in seconds) and the resource usage (see ``wait_for_process()``) of the
+    current process and any subprocess that finished in the meantime. All
+    values are differences between start and end, except for ``max_rss``,
+    which is the peak memory usage of the process (or its largest child)
+    since it was started.
+    """
+    import time
+    import resource
+    usages = (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)
+    start = [_rusage2dict(resource.getrusage(u)) for u in usages]
+    start_time = time.time()
+    try:
+        yield info
+    finally:
+        wallclock = time.time() - start_time
+        end = [_rusage2dict(resource.getrusage(u)) for u in usages]
+        for key in start[0]:
+            if key == 'max_rss':
+                info[key] = max([e[key] for e in end])
+            else:
+                info[key] = sum([e[key] - s[key] for s, e in zip(start, end)])
+        info['wallclock'] = wallclock
+
+
+#
+# Resource limits
+#
+# SPEC field names of supported limits and their corresponding rlimits
+_limit_resources = {
+    'max_memory': 'RLIMIT_AS',
+    'max_cpu_seconds': 'RLIMIT_CPU',
+    'max_open_files': 'RLIMIT_NOFILE',
+}
+
+# output of tools hitting a limit (memory or open files)
+_violation_messages = {
+    'memory': ('MemoryError', 'Cannot allocate memory', 'std::bad_alloc',
+               'out of memory', 'Out of memory'),
+    'open files': ('Too many open files',),
+}
+
+def get_limits(testspec):
+    """Return the resource limits declared in a test SPEC"""
+    return dict([(k, testspec[k]) for k in _limit_resources if k in testspec])
+
+def apply_limits(limits):
+    """Apply resource limits to the current process
+
+    To be called in a child process, right before the actual test code is
+    executed.
+    """
+    import resource
+    for key, value in limits.items():
+        rlimit = getattr(resource, _limit_resources[key])
+        _, hard = resource.getrlimit(rlimit)
+        value = int(value)
+        if hard != resource.RLIM_INFINITY:
+            value = min(value, hard)
+        if key == 'max_cpu_seconds':
+            # exceeding the soft limit sends SIGXCPU, the hard limit SIGKILL
+            resource.setrlimit(rlimit, (value, value + 1
+                                        if hard == resource.RLIM_INFINITY
+                                        else hard))
+        else:
+            resource.setrlimit(rlimit, (value, value))
+
+def get_preexec_fn(limits=None):
+    """Return a function to set up a child process for a test
+
+    The child becomes the leader of a new process group (to be able to kill
+    all its descendants on timeout), and any resource limits are applied.
+    """
+    def _setup_child():
+        os.setsid()
+        if limits:
+            apply_limits(limits)
+    return _setup_child
+
+class ProcessGroupTimeout(object):
+    """Kill a process group once a timeout expired
+
+    Parameters
+    ----------
+    pid : int
+      PID of the process group leader.
+    timeout : float or None
+      Timeout in seconds. If None, nothing is done.
+    """
+    def __init__(self, pid, timeout):
+        self.pid = pid
+        self.expired = False
+        self._timer = None
+        if not timeout is None:
+            self._timer = threading.Timer(timeout, self._kill)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _kill(self):
+        import signal
+        self.expired = True
+        lgr.debug("timeout expired, killing process group %i" % self.pid)
+        try:
+            os.killpg(self.pid, signal.SIGKILL)
+        except OSError:
+            # already gone
+            pass
+
+    def cancel(self):
+        if not self._timer is None:
+            self._timer.cancel()
+
+def identify_limit_violation(limits, timeout, returncode, resources,
+                             timed_out=False, exception=None, stderr=None):
+    """Determine whether a test failed due to a violated limit
+
+    Parameters
+    ----------
+    limits : dict
+      As returned by ``get_limits()``.
+    timeout : float or None
+    returncode : int
+    resources : dict
+      As returned by ``wait_for_process()``.
+    timed_out : bool
+      Whether the process was killed due to an expired timeout.
+    exception : dict or None
+      Info on an exception raised by Python test code.
+    stderr : path or None
+      Name of a file with the error output of the test.
+
+    Returns
+    -------
+    None or str
+      The type of violation: 'timeout', 'cpu time', 'memory', or 'open files'.
+    """
+    import signal
+    if timed_out:
+        return 'timeout'
+    if 'max_cpu_seconds' in limits:
+        # SIGXCPU is only sent when exceeding the soft limit (possibly to a
+        # process started by a shell), SIGKILL for the hard limit
+        if returncode in (-signal.SIGXCPU, 128 + signal.SIGXCPU):
+            return 'cpu time'
+        if returncode == -signal.SIGKILL \
+           and resources['cpu_user'] + resources['cpu_system'] \
+                >= limits['max_cpu_seconds']:
+            return 'cpu time'
+    if returncode == 0 and exception is None:
+        return None
+    failure_msg = ''
+    if not exception is None:
+        failure_msg = '%s: %s\n' % (exception['type'], exception['info'])
+    if not stderr is None and os.path.exists(stderr):
+        # look at the end of the error output only
+        with open(stderr, 'rb') as f:
+            f.seek(max(0, os.path.getsize(stderr) - 65536))
+            failure_msg += f.read().decode('utf-8', 'replace')
+    for violation, limit in (('memory', 'max_memory'),
+                             ('open files', 'max_open_files')):
+        if not limit in limits:
+            continue
+        for msg in _violation_messages[violation]:
+            if msg in failure_msg:
+                return violation
+    return None
+
+def _set_cloexec(fd):
+    # do not pass a file descriptor on to executed programs
+    import fcntl
+    fcntl.fcntl(fd, fcntl.F_SETFD,
+                fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+def _read_result(fd):
+    # read a length-prefixed message, without waiting for the end of file:
+    # the write end might also be held by descendants of the writer
+    import struct
+    data = b''
+    size = None
+    while size is None or len(data) < size:
+        chunk = os.read(fd, 65536)
+        if not len(chunk):
+            # the writer died
+            return None
+        data += chunk
+        if size is None and len(data) >= 4:
+            size = struct.unpack('!I', data[:4])[0] + 4
+    return data[4:size]
+
+def _redirect_output(stdout, stderr):
+    import sys
+    for fd, filename, attr in ((1, stdout, 'stdout'), (2, stderr, 'stderr')):
+        outfile = open(filename, 'wb')
+        os.dup2(outfile.fileno(), fd)
+        outfile.close()
+        # line-buffered and bypassing any capturing in the parent
+        setattr(sys, attr, os.fdopen(fd, 'w', 1))
+
+def run_forked(func, ctx, stdout, stderr, limits=None, timeout=None):
+    """Execute a callable in a forked child process
+
+    The child process runs in the given execution context, with the
+    specified resource limits, and a timeout. Any output is written to
+    files. The calling process must not run other threads, as the child
+    could inherit locks they hold (e.g. of the logging module) and
+    deadlock -- use a (single-threaded) ``Zygote`` instead.
+
+    Parameters
+    ----------
+    func : callable
+      Called without arguments in the child process.
+    ctx : ExecutionContext
+    stdout, stderr : path
+      Output file names.
+    limits : dict or None
+      As returned by ``get_limits()``.
+    timeout : float or None
+      Timeout in seconds. The process group of the child is killed on expiry.
+
+    Returns
+    -------
+    exception, returncode, resources, timed_out
+      ``exception`` is None or a dict with ``type`` and ``info`` of an
+      exception raised by ``func``. ``resources`` is the resource usage of
+      the child (see ``wait_for_process()``).
+    """
+    import pickle
+    import struct
+    import sys
+    import time
+    rfd, wfd = os.pipe()
+    start_time = time.time()
+    pid = os.fork()
+    if pid == 0:
+        # child
+        status = 1
+        try:
+            os.close(rfd)
+            # not inherited by any program the test executes
+            _set_cloexec(wfd)
+            get_preexec_fn()()
+            os.environ.clear()
+            os.environ.update(ctx.env)
+            os.chdir(ctx.cwd)
+            _redirect_output(stdout, stderr)
+            if limits:
+                apply_limits(limits)
+            exception = None
+            try:
+                func()
+            except BaseException as e:
+                exception = dict(type=e.__class__.__name__, info=str(e))
+            result = pickle.dumps(exception, protocol=2)
+            with os.fdopen(wfd, 'wb') as resultfile:
+                resultfile.write(struct.pack('!I', len(result)) + result)
+            status = 0
+        finally:
+            for f in (sys.stdout, sys.stderr):
+                try:
+                    f.flush()
+                except:
+                    pass
+            os._exit(status)
+    # parent
+    os.close(wfd)
+    timer = ProcessGroupTimeout(pid, timeout)
+    try:
+        try:
+            result = _read_result(rfd)
+        finally:
+            os.close(rfd)
+        returncode, resources = _wait4(pid)
+    finally:
+        timer.cancel()
+    resources['wallclock'] = time.time() - start_time
+    exception = pickle.loads(result) if not result is None else None
+    return exception, returncode, resources, timer.expired
+
+
+#
+# Zygote process for running Python test code
+#
+def exec_python_code(code=None, filename=None):
+    """Execute Python test code (a string or a file) in a clean namespace"""
+    if not code is None:
+        exec(code, {}, {})
+    elif not filename is None:
+        execfile(filename, {}, {})
+    else:
+        raise ValueError("no test code found")
+
+class Zygote(object):
+    """Pre-initialized process that forks a child process for each test
+
+    Starting a fresh interpreter for each test would require re-importing
+    all (heavy) modules a test needs, while running tests within the test
+    runner process lets broken tests affect the runner and all following
+    tests. A zygote imports a configurable set of modules once, and serves
+    requests to run Python code in a forked child process with
+    ``run_forked()``. Requests can be sent by the process that started the
+    zygote, and by any process forked from it (e.g. worker processes of a
+    test runner). The zygote terminates when all these processes are gone.
+    It runs no threads, hence it can be forked safely -- but it has to be
+    started before the requesting process starts any thread.
+
+    Parameters
+    ----------
+    preload : list or None
+      Names of modules to import into the zygote.
+    """
+    def __init__(self, preload=None):
+        self.preload = preload if not preload is None else []
+        self.pid = None
+        self._owner = None
+        self._sockdir = None
+        self._address = None
+        self._authkey = None
+        self._lifeline = None
+
+    def start(self):
+        """Start the zygote process, and wait until it is ready"""
+        import tempfile
+        self._sockdir = tempfile.mkdtemp(prefix='testkraut_zygote')
+        self._address = os.path.join(self._sockdir, 'socket')
+        self._authkey = os.urandom(20)
+        ready_rfd, ready_wfd = os.pipe()
+        # the zygote exits once the write end of this pipe is closed in all
+        # processes
+        life_rfd, life_wfd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                os.close(ready_rfd)
+                os.close(life_wfd)
+                self._serve(ready_wfd, life_rfd)
+                status = 0
+            finally:
+                os._exit(status)
+        os.close(ready_wfd)
+        os.close(life_rfd)
+        # do not pass the lifeline on to executed programs
+        _set_cloexec(life_wfd)
+        self._lifeline = life_wfd
+        with os.fdopen(ready_rfd, 'rb') as ready:
+            ready = ready.read(1)
+        if ready != b'1':
+            os.waitpid(pid, 0)
+            self._cleanup()
+            raise RuntimeError("zygote process failed to start")
+        self.pid = pid
+        self._owner = os.getpid()
+        lgr.debug("started zygote process %i" % pid)
+        return self
+
+    def _serve(self, ready_wfd, life_rfd):
+        # main loop of the zygote process
+        import signal
+        from multiprocessing.connection import Listener
+        # the lifeline is watched by a separate process, a thread would
+        # make forking the zygote unsafe
+        zygote_pid = os.getpid()
+        if os.fork() == 0:
+            try:
+                os.close(ready_wfd)
+                os.read(life_rfd, 1)
+                if os.getppid() == zygote_pid:
+                    os.kill(zygote_pid, signal.SIGTERM)
+            finally:
+                os._exit(0)
+        os.close(life_rfd)
+        for module in self.preload:
+            try:
+                __import__(module)
+            except ImportError as e:
+                lgr.debug("cannot preload module '%s' (%s)" % (module, str(e)))
+        listener = Listener(self._address, family='AF_UNIX',
+                            authkey=self._authkey)
+        # request handlers are not waited for
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+        os.write(ready_wfd, b'1')
+        os.close(ready_wfd)
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception as e:
+                lgr.debug("zygote failed to accept request: %s" % str(e))
+                continue
+            if os.fork() == 0:
+                # request handler, supervises the actual test process
+                status = 1
+                try:
+                    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                    func, cwd, env, stdout, stderr, limits, timeout = conn.recv()
+                    conn.send(run_forked(func,
+                                         ExecutionContext(cwd=cwd, env=env),
+                                         stdout, stderr,
+                                         limits=limits, timeout=timeout))
+                    status = 0
+                finally:
+                    os._exit(status)
+            conn.close()
+
+    def run_forked(self, func, ctx, stdout, stderr, limits=None, timeout=None):
+        """Execute a callable in a child process forked from the zygote
+
+        Same as ``run_forked()``, but ``func`` needs to be picklable (e.g.
+        a ``functools.partial`` of a module-level function).
+        """
+        from multiprocessing.connection import Client
+        conn = Client(self._address, family='AF_UNIX', authkey=self._authkey)
+        try:
+            conn.send((func, ctx.cwd, ctx.env, stdout, stderr, limits, timeout))
+            return conn.recv()
+        finally:
+            conn.close()
+
+    def stop(self):
+        """Terminate the zygote process
+
+        Only has an effect in the process that started the zygote.
+        """
+        if self.pid is None or self._owner != os.getpid():
+            return
+        import signal
+        try:
+            os.kill(self.pid, signal.SIGTERM)
+            os.waitpid(self.pid, 0)
+        except OSError:
+            pass
+        lgr.debug("stopped zygote process %i" % self.pid)
+        self.pid = None
+        self._cleanup()
+
+    def _cleanup(self):
+        import shutil
+        if not self._lifeline is None:
+            os.close(self._lifeline)
+            self._lifeline = None
+        shutil.rmtree(self._sockdir, ignore_errors=True)
+
+_zygote = None
+
+def get_zygote():
+    """Return the zygote for running Python tests, start it if necessary
+
+    Modules listed in the 'preload modules' setting of the 'testrun'
+    section are imported into the zygote. Returns None if no zygote process
+    could be started.
+    """
+    global _zygote
+    if _zygote is None:
+        import atexit
+        from testkraut import cfg
+        preload = cfg.get('testrun', 'preload modules', default='').split()
+        try:
+            _zygote = Zygote(preload).start()
+        except (OSError, RuntimeError) as e:
+            lgr.warning("cannot start zygote process (%s), Python tests will "
+                        "run in the test runner process" % str(e))
+            return None
+        atexit.register(_zygote.stop)
+    return _zygote
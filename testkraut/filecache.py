@@ -0,0 +1,941 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the testkraut package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Content-addressed cache for test input files"""
+
+__docformat__ = 'restructuredtext'
+
+import os
+import re
+import time
+import errno
+import fcntl
+import shutil
+import socket
+import sqlite3
+import tempfile
+import threading
+from os.path import join as opj
+
+from testkraut import cfg
+from .utils import get_filecache_dir, hash_files
+
+import logging
+lgr = logging.getLogger(__name__)
+
+_sha1_regex = re.compile(r'^[0-9a-f]{40}$')
+
+# file name extensions of compressed cache entries
+compression_methods = {'gzip': '.gz', 'bz2': '.bz2', 'lzma': '.xz'}
+
+_compressed_regex = re.compile(r'^[0-9a-f]{40}\.(gz|bz2|xz)$')
+
+_chunk_size = 1024 * 1024
+
+_size_units = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3,
+               'T': 1024 ** 4}
+
+# tables of the index database of a file cache
+_index_schema = [
+    ("CREATE TABLE IF NOT EXISTS entries "
+     "(sha1 TEXT PRIMARY KEY, size INTEGER, atime REAL)", ()),
+    ("CREATE INDEX IF NOT EXISTS entries_atime ON entries (atime)", ()),
+    ("CREATE TABLE IF NOT EXISTS counters "
+     "(name TEXT PRIMARY KEY, value INTEGER)", ()),
+    # file state at the last successful verification
+    ("CREATE TABLE IF NOT EXISTS verified "
+     "(sha1 TEXT PRIMARY KEY, size INTEGER, mtime REAL, inode INTEGER)", ()),
+    # lookups of compressed entries
+    ("CREATE TABLE IF NOT EXISTS lookups "
+     "(sha1 TEXT PRIMARY KEY, value INTEGER)", ()),
+    # decompressed copies of compressed entries
+    ("CREATE TABLE IF NOT EXISTS hot "
+     "(sha1 TEXT PRIMARY KEY, size INTEGER, atime REAL)", ()),
+]
+
+def parse_size(size):
+    """Convert a size specification like '500M' or '2G' into bytes"""
+    match = re.match(r'^\s*(\d+)\s*([KMGT]?)B?\s*$', size.upper())
+    if match is None:
+        raise ValueError("invalid size specification '%s'" % size)
+    return int(match.group(1)) * _size_units[match.group(2)]
+
+
+def _import_lzma():
+    try:
+        import lzma
+    except ImportError:
+        # Python 2
+        from backports import lzma
+    return lzma
+
+def open_entry(filename, mode='rb'):
+    """Open a cache entry, with transparent (de)compression
+
+    The compression method is determined by the file name extension.
+    """
+    if filename.endswith('.gz'):
+        import gzip
+        return gzip.open(filename, mode)
+    elif filename.endswith('.bz2'):
+        import bz2
+        return bz2.BZ2File(filename, mode)
+    elif filename.endswith('.xz'):
+        return _import_lzma().LZMAFile(filename, mode)
+    return open(filename, mode)
+
+def decompress_file(src, dst):
+    """Write the decompressed content of a compressed cache entry to a file"""
+    with open_entry(src) as srcfile, open(dst, 'wb') as dstfile:
+        shutil.copyfileobj(srcfile, dstfile, _chunk_size)
+    return dst
+
+def _compress_file(src, dst, method):
+    dst += compression_methods[method]
+    with open(src, 'rb') as srcfile, open_entry(dst, 'wb') as dstfile:
+        shutil.copyfileobj(srcfile, dstfile, _chunk_size)
+    return dst
+
+
+class _TolerantReader(object):
+    # turns decompression errors into a premature end of the content
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+
+    def read(self, size):
+        try:
+            return self._fileobj.read(size)
+        except Exception as e:
+            lgr.debug("cannot decompress '%s' (%s)"
+                      % (getattr(self._fileobj, 'name', ''), str(e)))
+            return b''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._fileobj.close()
+
+def _open_entry_tolerant(filename, mode='rb'):
+    return _TolerantReader(open_entry(filename, mode))
+
+
+class _ProcessLock(object):
+    # holders of an entry lock within this process: POSIX record locks are
+    # held per process (not per thread or descriptor), and closing any
+    # descriptor of a lock file releases them, hence a process holds at most
+    # one descriptor per lock file, and its threads are coordinated here
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.nshared = 0
+        self.exclusive = False
+        # whether the record lock is being acquired
+        self.busy = False
+        self.fd = None
+
+    def is_available(self, shared):
+        if self.busy or self.exclusive:
+            return False
+        if shared:
+            return True
+        return not self.nshared
+
+_process_locks = {}
+_process_locks_lock = threading.Lock()
+
+def _get_process_lock(path):
+    # record locks are not inherited by forked processes, neither is this
+    key = (os.getpid(), path)
+    with _process_locks_lock:
+        if not key in _process_locks:
+            _process_locks[key] = _ProcessLock()
+        return _process_locks[key]
+
+
+class EntryLock(object):
+    """Exclusive or shared lock on a cache entry
+
+    Excludes other threads, processes, and hosts sharing the cache (via
+    ``fcntl`` record locks, which are supported by NFS too). Any number of
+    shared locks can be held at the same time, but an exclusive lock
+    excludes any other lock. Locks of a crashed process are released by the
+    operating system; what remains is an unlocked lock file, which
+    ``FileCache.cleanup()`` removes.
+
+    Can be used as a context manager.
+
+    Parameters
+    ----------
+    path : path
+      Lock file.
+    shared : bool
+      Whether to acquire a shared lock, e.g. for reading an entry.
+    """
+    def __init__(self, path, shared=False):
+        self.path = path
+        self.shared = shared
+        self._plock = _get_process_lock(path)
+
+    def acquire(self, blocking=True):
+        """Acquire the lock
+
+        Returns
+        -------
+        bool
+          False, if the lock is held by someone else and ``blocking`` is
+          False.
+        """
+        plock = self._plock
+        with plock.cond:
+            while not plock.is_available(self.shared):
+                if not blocking:
+                    return False
+                plock.cond.wait()
+            if self.shared and plock.nshared:
+                # this process holds a shared lock already
+                plock.nshared += 1
+                return True
+            plock.busy = True
+        fd = None
+        try:
+            fd = self._lock_file(blocking)
+        finally:
+            with plock.cond:
+                plock.busy = False
+                if not fd is None:
+                    plock.fd = fd
+                    if self.shared:
+                        plock.nshared += 1
+                    else:
+                        plock.exclusive = True
+                plock.cond.notify_all()
+        return not fd is None
+
+    def _lock_file(self, blocking):
+        mode = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+        while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                try:
+                    fcntl.lockf(fd, mode | fcntl.LOCK_NB)
+                except IOError as e:
+                    if not e.errno in (errno.EACCES, errno.EAGAIN):
+                        raise
+                    if not blocking:
+                        os.close(fd)
+                        return None
+                    lgr.debug("waiting for lock '%s' held by %s"
+                              % (self.path, os.read(fd, 1024) or 'unknown'))
+                    fcntl.lockf(fd, mode)
+            except:
+                os.close(fd)
+                raise
+            # the lock file might have been removed (by a cleanup) while
+            # waiting for the lock -- then this lock would not exclude anyone
+            try:
+                current = os.stat(self.path).st_ino == os.fstat(fd).st_ino
+            except OSError:
+                current = False
+            if current:
+                if not self.shared:
+                    # who holds the lock, for those who wait
+                    os.ftruncate(fd, 0)
+                    os.write(fd, '%s:%i' % (socket.gethostname(),
+                                            os.getpid()))
+                return fd
+            os.close(fd)
+
+    def release(self):
+        """Release the lock"""
+        plock = self._plock
+        with plock.cond:
+            if self.shared:
+                plock.nshared -= 1
+                last = not plock.nshared
+            else:
+                plock.exclusive = False
+                last = True
+            if last:
+                fcntl.lockf(plock.fd, fcntl.LOCK_UN)
+                os.close(plock.fd)
+                plock.fd = None
+            plock.cond.notify_all()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class FileCache(object):
+    """Cache of files, keyed by their SHA1 hash
+
+    Entries are stored in a sharded directory layout (``ab/cd/<sha1>``).
+    An entry can be a file, or a symlink to a file elsewhere (which does not
+    count towards the cache size). New entries are placed atomically by
+    renaming, hence concurrent users never see partial files.
+
+    An SQLite database in the cache directory records size and last access
+    time of all entries, and counts hits, misses, insertions and evictions.
+    Whenever a byte quota is exceeded, least recently used entries are
+    evicted. Lookups only read the file system: access times and counts are
+    collected in memory and written to the database in a single transaction
+    by ``flush()``, and whenever the cache is modified. If the database is
+    locked (e.g. busy, or on a file system with unreliable locking), writes
+    are postponed to the next flush instead of failing.
+
+    Optionally, copies of files (not links to files elsewhere) are stored
+    compressed. Such entries are decompressed on placement (see
+    ``is_compressed()`` and ``decompress_file()``). Frequently used
+    compressed entries additionally get a decompressed copy in a "hot tier"
+    of limited size, which is used like an uncompressed entry.
+
+    A cache can be shared by several processes and hosts (e.g. on NFS).
+    Whoever creates an entry should hold its lock (see ``get_entry_lock()``),
+    and check whether the entry exists once the lock is acquired, to avoid
+    duplicate downloads. Whoever reads an entry (e.g. from a lookup until
+    it is staged) should hold a shared lock. Entries are only evicted while
+    their lock is free, and only moved into quarantine while holding their
+    exclusive lock.
+
+    Parameters
+    ----------
+    path : path or None
+      Location of the cache. Defaults to the configured file cache.
+    quota : int or None
+      Maximum size of the cache in bytes. Defaults to the 'quota' setting
+      in the 'cache' section (e.g. '50G'). If None and not configured, the
+      cache size is not limited. Decompressed copies in the hot tier do not
+      count towards the quota.
+    compression : {None, 'gzip', 'bz2', 'lzma'}
+      Compression of new entries. Defaults to the 'compression' setting in
+      the 'cache' section. 'lzma' requires the ``backports.lzma`` package on
+      Python 2.
+    hot_size : int or None
+      Maximum size of the hot tier in bytes. Defaults to the 'hot tier size'
+      setting in the 'cache' section (default: 1G).
+    """
+    # number of lookups of a compressed entry before it is decompressed into
+    # the hot tier
+    hot_threshold = 2
+    # seconds to wait for a locked database before postponing writes
+    index_timeout = 5.0
+
+    def __init__(self, path=None, quota=None, compression=None,
+                 hot_size=None):
+        if path is None:
+            path = get_filecache_dir()
+        self.path = os.path.abspath(path)
+        if quota is None:
+            quota = cfg.get('cache', 'quota', default='')
+            quota = parse_size(quota) if len(quota.strip()) else None
+        self.quota = quota
+        if compression is None:
+            compression = cfg.get('cache', 'compression', default='').strip()
+        if compression in ('', 'none'):
+            compression = None
+        if not compression is None \
+           and not compression in compression_methods:
+            raise ValueError("unknown compression method '%s'" % compression)
+        if compression == 'lzma':
+            try:
+                _import_lzma()
+            except ImportError:
+                lgr.warning("no lzma module found -- cache entries will not "
+                            "be compressed")
+                compression = None
+        self.compression = compression
+        if hot_size is None:
+            hot_size = parse_size(cfg.get('cache', 'hot tier size',
+                                          default='1G'))
+        self.hot_size = hot_size
+        # statistics for this instance
+        self.stats = dict(hits=0, misses=0, insertions=0, evictions=0)
+        # database updates that have not been written yet
+        self._pending_counts = {}
+        self._pending_atimes = {}
+        self._pending_lookups = {}
+        self._pending_statements = []
+        self._tmpdir = opj(self.path, '.tmp')
+        self._lockdir = opj(self.path, '.locks')
+        for d in (self.path, self._tmpdir, self._lockdir):
+            if not os.path.exists(d):
+                try:
+                    os.makedirs(d)
+                except OSError:
+                    # created concurrently
+                    if not os.path.isdir(d):
+                        raise
+        self._db = sqlite3.connect(opj(self.path, '.index.sqlite'),
+                                   timeout=self.index_timeout)
+        self._pending_schema = list(_index_schema)
+        self.flush()
+        self._migrate_flat_entries()
+
+    def _get_entry_path(self, sha1):
+        return opj(self.path, sha1[:2], sha1[2:4], sha1)
+
+    def _get_entry_variants(self, sha1):
+        # all possible paths of an entry, uncompressed first
+        path = self._get_entry_path(sha1)
+        return [path] + [path + ext
+                            for ext in sorted(compression_methods.values())]
+
+    def _get_stored_path(self, sha1):
+        # path of an existing entry (file or link), preferring an
+        # uncompressed one
+        for path in self._get_entry_variants(sha1):
+            if os.path.lexists(path):
+                return path
+        return None
+
+    def _is_hot_copy(self, fname, sha1):
+        # decompressed copy of a compressed entry
+        return fname == sha1 \
+               and len([v for v in self._get_entry_variants(sha1)[1:]
+                            if os.path.lexists(v)]) > 0
+
+    def is_compressed(self, path):
+        """Whether a path is that of a compressed entry of this cache"""
+        return os.path.dirname(os.path.dirname(os.path.dirname(path))) \
+                    == self.path \
+               and not _compressed_regex.match(os.path.basename(path)) is None
+
+    def _count(self, name, n=1):
+        self.stats[name] += n
+        self._pending_counts[name] = self._pending_counts.get(name, 0) + n
+
+    def _execute(self, *statements):
+        # write (sql, parameters) statements to the database, or postpone
+        # them if it is locked
+        self._pending_statements.extend(statements)
+        self.flush()
+
+    def flush(self):
+        """Write pending updates to the database
+
+        Returns
+        -------
+        bool
+          False, if the database is locked. Updates are kept for the next
+          flush then.
+        """
+        statements = list(self._pending_schema)
+        for name, n in self._pending_counts.items():
+            statements.append(("INSERT OR IGNORE INTO counters VALUES (?, 0)",
+                               (name,)))
+            statements.append(("UPDATE counters SET value=value+? "
+                               "WHERE name=?", (n, name)))
+        for sha1, atime in self._pending_atimes.items():
+            statements.append(("UPDATE entries SET atime=? WHERE sha1=?",
+                               (atime, sha1)))
+            statements.append(("UPDATE hot SET atime=? WHERE sha1=?",
+                               (atime, sha1)))
+        for sha1, n in self._pending_lookups.items():
+            statements.append(("INSERT OR IGNORE INTO lookups VALUES (?, 0)",
+                               (sha1,)))
+            statements.append(("UPDATE lookups SET value=value+? "
+                               "WHERE sha1=?", (n, sha1)))
+        # modifications come last, they might remove what was looked up
+        statements.extend(self._pending_statements)
+        if not len(statements):
+            return True
+        try:
+            with self._db:
+                for sql, params in statements:
+                    self._db.execute(sql, params)
+        except sqlite3.OperationalError as e:
+            lgr.debug("cannot write to file cache index, postponing %i "
+                      "update(s) (%s)" % (len(statements), str(e)))
+            return False
+        self._pending_schema = []
+        self._pending_counts = {}
+        self._pending_atimes = {}
+        self._pending_lookups = {}
+        self._pending_statements = []
+        return True
+
+    def get_counters(self):
+        """Return hit, miss, insertion and eviction counts of all users
+
+        Counts of this instance that are not yet written are included.
+        """
+        counters = dict([(k, 0) for k in self.stats])
+        try:
+            counters.update(dict(self._db.execute(
+                                "SELECT name, value FROM counters")))
+        except sqlite3.OperationalError as e:
+            lgr.debug("cannot read file cache index, only counts of this "
+                      "instance are known (%s)" % str(e))
+        for name, n in self._pending_counts.items():
+            counters[name] = counters.get(name, 0) + n
+        return counters
+
+    def _migrate_flat_entries(self):
+        # move entries of the previous flat layout (<cache>/<sha1>)
+        for fname in os.listdir(self.path):
+            if _sha1_regex.match(fname) is None:
+                continue
+            src = opj(self.path, fname)
+            if os.path.islink(src):
+                target = os.readlink(src)
+                if not os.path.isabs(target):
+                    target = os.path.normpath(opj(self.path, target))
+                if not os.path.exists(target):
+                    lgr.debug("removing dangling legacy cache entry '%s'"
+                              % src)
+                    os.remove(src)
+                    continue
+                self.insert(fname, target, mode='symlink')
+                os.remove(src)
+            else:
+                self._place(fname, src, os.rename)
+            lgr.debug("migrated legacy cache entry '%s'" % fname)
+
+    def __contains__(self, sha1):
+        path = self._get_stored_path(sha1)
+        return not path is None and os.path.exists(path)
+
+    def __iter__(self):
+        try:
+            sha1s = [row[0] for row in self._db.execute(
+                        "SELECT sha1 FROM entries ORDER BY sha1").fetchall()]
+        except sqlite3.OperationalError as e:
+            lgr.debug("cannot read file cache index, listing entries on "
+                      "disk (%s)" % str(e))
+            sha1s = sorted(set([sha1 for fname, sha1, path
+                                    in self._iter_entry_paths()
+                                        if os.path.exists(path)]))
+        for sha1 in sha1s:
+            yield sha1
+
+    def get_path(self, sha1):
+        """Return the path of a cached file, or None if it is not cached
+
+        A lookup marks the entry as recently used (see ``flush()``). The
+        path might be that of a compressed entry (see ``is_compressed()``).
+        """
+        path = self._get_stored_path(sha1)
+        if path is None or not os.path.exists(path):
+            if not path is None:
+                lgr.debug("removing dangling cache entry '%s'" % path)
+                self.remove(sha1)
+            self._count('misses')
+            return None
+        self._pending_atimes[sha1] = time.time()
+        self._count('hits')
+        if not self.is_compressed(path) or not self.hot_size:
+            return path
+        self._pending_lookups[sha1] = self._pending_lookups.get(sha1, 0) + 1
+        try:
+            recorded = self._db.execute(
+                            "SELECT value FROM lookups WHERE sha1=?",
+                            (sha1,)).fetchone()
+        except sqlite3.OperationalError:
+            recorded = None
+        nlookups = self._pending_lookups[sha1] \
+                    + (0 if recorded is None else recorded[0])
+        if nlookups >= self.hot_threshold:
+            path = self._make_hot(sha1, path)
+        return path
+
+    def _make_hot(self, sha1, path):
+        # place a decompressed copy next to a compressed entry
+        tmpname = decompress_file(path, self.get_temp_filename())
+        hotpath = self._get_entry_path(sha1)
+        os.rename(tmpname, hotpath)
+        self._execute(("INSERT OR REPLACE INTO hot VALUES (?, ?, ?)",
+                       (sha1, os.path.getsize(hotpath), time.time())))
+        lgr.debug("added '%s' to the hot tier of the file cache" % sha1)
+        self._evict_hot(keep=(sha1,))
+        return hotpath
+
+    def _evict_hot(self, keep=()):
+        # remove least recently used decompressed copies beyond the budget
+        try:
+            size = self._db.execute("SELECT SUM(size) FROM hot").fetchone()[0]
+            candidates = self._db.execute(
+                    "SELECT sha1, size FROM hot ORDER BY atime").fetchall()
+        except sqlite3.OperationalError as e:
+            lgr.debug("cannot read file cache index, no eviction from the "
+                      "hot tier (%s)" % str(e))
+            return
+        excess = (size or 0) - self.hot_size
+        for sha1, size in candidates:
+            if excess <= 0:
+                break
+            if sha1 in keep:
+                continue
+            lock = self.get_entry_lock(sha1)
+            if not lock.acquire(blocking=False):
+                continue
+            try:
+                hotpath = self._get_entry_path(sha1)
+                if os.path.lexists(hotpath):
+                    os.remove(hotpath)
+                self._execute(("DELETE FROM hot WHERE sha1=?", (sha1,)),
+                              ("DELETE FROM lookups WHERE sha1=?", (sha1,)))
+            finally:
+                lock.release()
+            excess -= size
+
+    def get_temp_filename(self):
+        """Return the name of a new temporary file within the cache
+
+        To be used for creating an entry with ``commit()``, e.g. when
+        downloading a file.
+        """
+        fd, tmpname = tempfile.mkstemp(dir=self._tmpdir)
+        os.close(fd)
+        return tmpname
+
+    def get_download_filename(self, sha1):
+        """Return a temporary file name for downloading a file into the cache
+
+        Unlike ``get_temp_filename()`` the name is always the same for a
+        hash, hence an interrupted download can be resumed. To be used with
+        ``commit()``.
+        """
+        return opj(self._tmpdir, sha1)
+
+    def commit(self, sha1, tmpname):
+        """Turn a temporary file into a cache entry
+
+        The file is compressed, if configured.
+
+        Parameters
+        ----------
+        sha1 : str
+          Hash of the file content.
+        tmpname : path
+          As returned by ``get_temp_filename()`` or
+          ``get_download_filename()``.
+
+        Returns
+        -------
+        path
+          Location of the cache entry.
+        """
+        if self.compression is None:
+            return self._place(sha1, tmpname, os.rename)
+        compressed = self.get_temp_filename()
+        os.remove(compressed)
+        compressed = _compress_file(tmpname, compressed, self.compression)
+        os.remove(tmpname)
+        return self._place(sha1, compressed, os.rename, compressed=True)
+
+    def insert(self, sha1, src, mode='copy'):
+        """Put a file into the cache
+
+        Parameters
+        ----------
+        sha1 : str
+          Hash of the file content.
+        src : path
+          File to be cached.
+        mode : {'copy', 'hardlink', 'symlink'}
+          Whether to put a copy of the file into the cache (compressed, if
+          configured), a hard link (if impossible, a copy), or a symlink to
+          the file.
+
+        Returns
+        -------
+        path
+          Location of the cache entry.
+        """
+        tmpname = self.get_temp_filename()
+        os.remove(tmpname)
+        if mode == 'symlink':
+            os.symlink(os.path.realpath(src), tmpname)
+        elif mode == 'hardlink':
+            try:
+                os.link(os.path.realpath(src), tmpname)
+            except OSError:
+                # e.g. a cross-device link
+                shutil.copy(src, tmpname)
+        elif mode == 'copy':
+            if not self.compression is None:
+                tmpname = _compress_file(src, tmpname, self.compression)
+                return self._place(sha1, tmpname, os.rename, compressed=True)
+            shutil.copy(src, tmpname)
+        else:
+            raise ValueError("unknown cache insertion mode '%s'" % mode)
+        return self._place(sha1, tmpname, os.rename)
+
+    def _place(self, sha1, src, move, compressed=False):
+        path = self._get_entry_path(sha1)
+        if compressed:
+            path += os.path.splitext(src)[1]
+        dirname = os.path.dirname(path)
+        if not os.path.exists(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                if not os.path.isdir(dirname):
+                    raise
+        # atomically replaces any existing entry of the same kind
+        move(src, path)
+        for variant in self._get_entry_variants(sha1):
+            if variant != path and os.path.lexists(variant):
+                os.remove(variant)
+        # symlinks do not occupy space in the cache
+        size = 0 if os.path.islink(path) else os.path.getsize(path)
+        self._count('insertions')
+        self._execute(("INSERT OR REPLACE INTO entries VALUES (?, ?, ?)",
+                       (sha1, size, time.time())),
+                      ("DELETE FROM hot WHERE sha1=?", (sha1,)),
+                      ("DELETE FROM lookups WHERE sha1=?", (sha1,)))
+        lgr.debug("added '%s' to file cache" % sha1)
+        # never evict what was just asked for
+        self.evict(keep=(sha1,))
+        return path
+
+    def remove(self, sha1):
+        """Remove an entry from the cache"""
+        for path in self._get_entry_variants(sha1):
+            if os.path.lexists(path):
+                os.remove(path)
+        self._execute(*([("DELETE FROM entries WHERE sha1=?", (sha1,))]
+                        + [("DELETE FROM verified WHERE sha1=?",
+                            (os.path.basename(name),))
+                            for name in self._get_entry_variants(sha1)]
+                        + [("DELETE FROM hot WHERE sha1=?", (sha1,)),
+                           ("DELETE FROM lookups WHERE sha1=?", (sha1,))]))
+
+    def _iter_entry_paths(self):
+        # all entries on disk, whether recorded in the database or not
+        for shard in sorted(os.listdir(self.path)):
+            if len(shard) != 2:
+                # e.g. the database or the temp directory
+                continue
+            for subshard in sorted(os.listdir(opj(self.path, shard))):
+                subdir = opj(self.path, shard, subshard)
+                for fname in sorted(os.listdir(subdir)):
+                    if not _sha1_regex.match(fname) is None \
+                       or not _compressed_regex.match(fname) is None:
+                        yield fname, fname[:40], opj(subdir, fname)
+
+    def verify(self, full=False, nthreads=None, progress=None):
+        """Check the content of all cache entries against their hash
+
+        Entries are rehashed in parallel. Compressed entries are hashed by
+        their decompressed content, and those that cannot be decompressed
+        count as corrupt. Corrupt entries are moved into a ``.quarantine``
+        directory in the cache, and dangling symlinks are removed.
+
+        Parameters
+        ----------
+        full : bool
+          If False, entries whose size, modification time and inode did not
+          change since their last successful verification are skipped.
+        nthreads : int or None
+          Number of files hashed concurrently (see ``utils.hash_files()``).
+        progress : callable or None
+          See ``utils.hash_files()``.
+
+        Returns
+        -------
+        dict
+          Report with the hashes of all entries that were verified ('ok'),
+          skipped as unchanged ('unchanged'), corrupt (mapped to their
+          location in quarantine; 'corrupt'), and dangling symlinks (mapped
+          to the link target; 'dangling').
+        """
+        report = dict(ok=[], unchanged=[], corrupt={}, dangling={})
+        try:
+            verified = dict([(row[0], tuple(row[1:]))
+                                for row in self._db.execute(
+                                    "SELECT sha1, size, mtime, inode "
+                                    "FROM verified")])
+        except sqlite3.OperationalError as e:
+            lgr.debug("cannot read file cache index, checking all entries "
+                      "(%s)" % str(e))
+            verified = {}
+        tocheck = {}
+        # a compressed entry and its decompressed copy are one entry
+        for fname, sha1, path in self._iter_entry_paths():
+            if sha1 in report['dangling'] or sha1 in report['corrupt']:
+                continue
+            if not os.path.exists(path):
+                with self.get_entry_lock(sha1):
+                    if not os.path.lexists(path) or os.path.exists(path):
+                        # replaced meanwhile
+                        continue
+                    report['dangling'][sha1] = os.readlink(path)
+                    lgr.warning("removing dangling cache entry '%s' "
+                                "(-> '%s')" % (sha1, report['dangling'][sha1]))
+                    self.remove(sha1)
+                continue
+            st = os.stat(path)
+            state = (st.st_size, st.st_mtime, st.st_ino)
+            if not full and verified.get(fname, None) == state:
+                report['unchanged'].append(sha1)
+                continue
+            tocheck[path] = (fname, sha1, state)
+        hashes = hash_files(tocheck.keys(), nthreads=nthreads,
+                            progress=progress, opener=_open_entry_tolerant)
+        quarantine = opj(self.path, '.quarantine')
+        for path, (fname, sha1, state) in sorted(tocheck.items()):
+            if sha1 in report['corrupt']:
+                continue
+            if hashes[path]['sha1'] == sha1:
+                report['ok'].append(sha1)
+                # written at once, below
+                self._pending_statements.append(
+                    ("INSERT OR REPLACE INTO verified VALUES (?, ?, ?, ?)",
+                     (fname,) + state))
+                continue
+            # wait for anyone reading the entry
+            with self.get_entry_lock(sha1):
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    st = None
+                if st is None \
+                   or (st.st_size, st.st_mtime, st.st_ino) != state:
+                    # replaced meanwhile
+                    continue
+                if not os.path.exists(quarantine):
+                    os.makedirs(quarantine)
+                qpath = opj(quarantine, fname)
+                # moves a symlink, not its target
+                os.rename(path, qpath)
+                report['corrupt'][sha1] = qpath
+                lgr.warning("moved corrupt cache entry '%s' into quarantine"
+                            % fname)
+                self.remove(sha1)
+        self.flush()
+        for key in ('ok', 'unchanged'):
+            report[key] = sorted(set(report[key]) - set(report['corrupt']))
+        return report
+
+    def get_size(self):
+        """Return the total size of all cached files in bytes"""
+        try:
+            size = self._db.execute(
+                        "SELECT SUM(size) FROM entries").fetchone()[0]
+        except sqlite3.OperationalError as e:
+            lgr.debug("cannot read file cache index, summing up entries on "
+                      "disk (%s)" % str(e))
+            size = sum([os.path.getsize(path)
+                            for fname, sha1, path in self._iter_entry_paths()
+                                if not os.path.islink(path)
+                                   and not self._is_hot_copy(fname, sha1)])
+        return 0 if size is None else size
+
+    def evict(self, keep=()):
+        """Remove least recently used entries until the quota is met
+
+        Parameters
+        ----------
+        keep : sequence
+          SHA1 hashes of entries that must not be evicted.
+        """
+        if self.quota is None:
+            return
+        # recent lookups of this instance count
+        self.flush()
+        try:
+            excess = self.get_size() - self.quota
+            if excess <= 0:
+                return
+            candidates = self._db.execute(
+                    "SELECT sha1, size FROM entries WHERE size > 0 "
+                    "ORDER BY atime").fetchall()
+        except sqlite3.OperationalError as e:
+            lgr.debug("cannot read file cache index, no eviction (%s)"
+                      % str(e))
+            return
+        for sha1, size in candidates:
+            if excess <= 0:
+                break
+            if sha1 in keep:
+                continue
+            lock = self.get_entry_lock(sha1)
+            if not lock.acquire(blocking=False):
+                # in use
+                continue
+            try:
+                lgr.debug("evicting '%s' from file cache" % sha1)
+                self.remove(sha1)
+            finally:
+                lock.release()
+            self._count('evictions')
+            excess -= size
+
+    def get_entry_lock(self, sha1, shared=False):
+        """Return the (not yet acquired) lock of an entry
+
+        Parameters
+        ----------
+        sha1 : str
+        shared : bool
+          Whether to return a shared lock, which prevents the removal of an
+          entry while it is read. The entry must not be modified while a
+          shared lock is held by the same thread.
+        """
+        return EntryLock(opj(self._lockdir, sha1), shared=shared)
+
+    def cleanup(self, max_age=86400):
+        """Remove stale lock files and temporary files
+
+        Lock files are removed unless a lock is held. Temporary files (e.g.
+        of crashed processes) are removed once they were not modified for
+        some time -- partial downloads only if the lock of their entry is
+        free.
+
+        Parameters
+        ----------
+        max_age : float
+          Age of temporary files (in seconds) to be considered stale.
+
+        Returns
+        -------
+        int
+          Number of removed files.
+        """
+        nremoved = 0
+        now = time.time()
+        for fname in os.listdir(self._tmpdir):
+            path = opj(self._tmpdir, fname)
+            try:
+                if now - os.lstat(path).st_mtime < max_age:
+                    continue
+            except OSError:
+                # gone already
+                continue
+            sha1 = fname.split('.')[0]
+            if _sha1_regex.match(sha1) is None:
+                os.remove(path)
+                nremoved += 1
+                continue
+            lock = self.get_entry_lock(sha1)
+            if not lock.acquire(blocking=False):
+                continue
+            try:
+                if os.path.lexists(path):
+                    os.remove(path)
+                    nremoved += 1
+            finally:
+                lock.release()
+        # after the temporary files, their checks create lock files
+        for fname in os.listdir(self._lockdir):
+            lock = EntryLock(opj(self._lockdir, fname))
+            if not lock.acquire(blocking=False):
+                continue
+            try:
+                os.remove(lock.path)
+                nremoved += 1
+            finally:
+                lock.release()
+        if nremoved:
+            lgr.debug("removed %i stale file(s) from the file cache"
+                      % nremoved)
+        return nremoved
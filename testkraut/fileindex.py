@@ -0,0 +1,254 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the testkraut package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Persistent index of the files in local data directories
+
+For each indexed directory tree an SQLite database records path, size,
+modification time, inode, and the SHA1 hash of every file. Indices are
+refreshed by comparing the recorded state with ``stat()`` results, and
+hashes are only computed when needed -- and only once for an unchanged file.
+A recorded hash is only used if the file's current state still matches the
+recorded one, hence files changed after the last refresh are never reported
+under a stale hash.
+"""
+
+__docformat__ = 'restructuredtext'
+
+import os
+import stat
+import sqlite3
+import threading
+from hashlib import sha1 as _sha1
+from os.path import join as opj
+
+from six import iteritems
+
+from .utils import sha1sum, hash_files, get_fileindex_dir, \
+        quicksum as _quicksum
+
+import logging
+lgr = logging.getLogger(__name__)
+
+# refreshed indices of the current process, per thread
+_indices = {}
+
+# number of files hashed at once when looking for a particular hash
+_hash_batch_size = 64
+
+def _get_state(path):
+    # (size, mtime, inode) of a regular file, or None
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    return (st.st_size, st.st_mtime, st.st_ino)
+
+def get_file_index(root):
+    """Return the index of a directory tree
+
+    The index is refreshed once per process and thread, upon first access.
+    """
+    root = os.path.abspath(root)
+    # database connections cannot be shared across threads
+    key = (os.getpid(), threading.current_thread().ident, root)
+    if not key in _indices:
+        index = FileIndex(root)
+        index.refresh()
+        _indices[key] = index
+    return _indices[key]
+
+
+class FileIndex(object):
+    """Index of path, size, mtime, inode, and sha1sum of all files in a tree
+
+    Parameters
+    ----------
+    root : path
+      Root directory of the tree.
+    dbfilename : path or None
+      Location of the index database. By default, a file in the configured
+      index directory, named after a hash of the root path.
+    """
+    def __init__(self, root, dbfilename=None):
+        self.root = os.path.abspath(root)
+        if dbfilename is None:
+            indexdir = get_fileindex_dir()
+            if not os.path.exists(indexdir):
+                os.makedirs(indexdir)
+            dbfilename = opj(indexdir,
+                             '%s.sqlite' % _sha1(self.root).hexdigest())
+        self._db = sqlite3.connect(dbfilename, timeout=60)
+        # paths are byte strings
+        self._db.text_factory = str
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS files "
+                             "(path TEXT PRIMARY KEY, name TEXT, "
+                             "size INTEGER, mtime REAL, inode INTEGER, "
+                             "sha1 TEXT)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS files_name "
+                             "ON files (name)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS files_sha1 "
+                             "ON files (sha1)")
+
+    def refresh(self):
+        """Bring the index in sync with the directory tree
+
+        Only files that were added, or whose size, modification time or
+        inode changed are (re-)indexed. Their hashes are computed on demand.
+        """
+        known = dict([(row[0], tuple(row[1:])) for row in self._db.execute(
+                        "SELECT path, size, mtime, inode FROM files")])
+        updated = []
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for fname in filenames:
+                fpath = opj(dirpath, fname)
+                try:
+                    st = os.stat(fpath)
+                except OSError:
+                    # e.g. a dangling symlink
+                    continue
+                if not stat.S_ISREG(st.st_mode):
+                    continue
+                relpath = os.path.relpath(fpath, self.root)
+                state = (st.st_size, st.st_mtime, st.st_ino)
+                if known.pop(relpath, None) != state:
+                    updated.append((relpath, fname) + state)
+        with self._db:
+            self._db.executemany(
+                    "INSERT OR REPLACE INTO files "
+                    "(path, name, size, mtime, inode, sha1) "
+                    "VALUES (?, ?, ?, ?, ?, NULL)", updated)
+            # whatever is left is gone
+            self._db.executemany("DELETE FROM files WHERE path=?",
+                                 [(p,) for p in known])
+        lgr.debug("refreshed index of '%s' (%i updated, %i removed)"
+                  % (self.root, len(updated), len(known)))
+
+    def find_by_name(self, name):
+        """Return the paths of all files with a path ending in ``name``
+
+        Paths are sorted by depth, i.e. files closer to the root come first.
+        """
+        name = os.path.normpath(name)
+        candidates = [row[0] for row in self._db.execute(
+                        "SELECT path FROM files WHERE name=?",
+                        (os.path.basename(name),))
+                        if row[0] == name or row[0].endswith(os.sep + name)]
+        return [opj(self.root, p)
+                    for p in sorted(candidates,
+                                    key=lambda p: (p.count(os.sep), p))]
+
+    def find_by_sha1(self, sha1, size=None, quicksum=None):
+        """Return the path of a file with the given SHA1 hash, or None
+
+        Hashes of all files not hashed yet are computed (and recorded) until
+        a match is found.
+
+        Parameters
+        ----------
+        sha1 : str
+        size : int or None
+          If given, only files of this size are considered.
+        quicksum : str or None
+          If given, only files with this quicksum (see ``utils.quicksum()``)
+          are hashed in full.
+        """
+        for row in self._db.execute(
+                "SELECT path, size, mtime, inode FROM files WHERE sha1=?",
+                (sha1,)).fetchall():
+            if self._is_current(row[0], tuple(row[1:])):
+                return opj(self.root, row[0])
+        query = "SELECT path FROM files WHERE sha1 IS NULL"
+        params = ()
+        if not size is None:
+            query += " AND size=?"
+            params = (size,)
+        unhashed = [opj(self.root, row[0])
+                        for row in self._db.execute(query + " ORDER BY path",
+                                                    params)]
+        if not quicksum is None:
+            unhashed = [p for p in unhashed
+                            if self._get_quicksum(p) == quicksum]
+        # hash in batches, to stop early once the file is found
+        for i in range(0, len(unhashed), _hash_batch_size):
+            batch = unhashed[i:i + _hash_batch_size]
+            # state before hashing -- a file modified meanwhile is rehashed
+            # next time
+            states = dict([(p, self._get_current_state(p)) for p in batch])
+            hashes = hash_files([p for p in batch if not states[p] is None])
+            for path, h in iteritems(hashes):
+                self._record(path, states[path], h['sha1'])
+            for path, h in iteritems(hashes):
+                if h['sha1'] == sha1:
+                    return path
+        return None
+
+    def get_sha1(self, path):
+        """Return the SHA1 hash of an indexed file
+
+        A recorded hash is used, if the file did not change since. Otherwise
+        the hash is computed and recorded.
+        """
+        relpath = os.path.relpath(path, self.root)
+        row = self._db.execute(
+                "SELECT sha1, size, mtime, inode FROM files WHERE path=?",
+                (relpath,)).fetchone()
+        if not row is None and not row[0] is None \
+           and self._is_current(relpath, tuple(row[1:])):
+            return row[0]
+        state = _get_state(path)
+        hash_ = sha1sum(path)
+        if not row is None and not state is None:
+            self._record(path, state, hash_)
+        return hash_
+
+    def _is_current(self, relpath, state):
+        # whether a file is still in its recorded state -- if not, its record
+        # is updated to the current state (without a hash) or removed
+        return self._get_current_state(opj(self.root, relpath),
+                                       state) == state
+
+    def _get_current_state(self, path, recorded=None):
+        # current state of an indexed file, updating its record if it
+        # differs from the recorded state
+        relpath = os.path.relpath(path, self.root)
+        state = _get_state(path)
+        if state is None:
+            lgr.debug("indexed file '%s' is gone" % path)
+            with self._db:
+                self._db.execute("DELETE FROM files WHERE path=?", (relpath,))
+        elif not recorded is None and state != recorded:
+            lgr.debug("indexed file '%s' changed" % path)
+            with self._db:
+                self._db.execute(
+                        "UPDATE files SET size=?, mtime=?, inode=?, sha1=NULL "
+                        "WHERE path=?", state + (relpath,))
+        return state
+
+    def _get_quicksum(self, path):
+        # quicksum of an indexed file, or None if it is gone
+        try:
+            return _quicksum(path)
+        except IOError:
+            return None
+
+    def _record(self, path, state, hash_):
+        # record the hash of a file in a given state
+        with self._db:
+            self._db.execute(
+                    "UPDATE files SET size=?, mtime=?, inode=?, sha1=? "
+                    "WHERE path=?",
+                    state + (hash_, os.path.relpath(path, self.root)))
+
+    def __iter__(self):
+        paths = [row[0] for row in self._db.execute(
+                    "SELECT path FROM files ORDER BY path")]
+        for relpath in paths:
+            yield opj(self.root, relpath)
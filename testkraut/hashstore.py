@@ -0,0 +1,480 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the testkraut package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Download of files from the web and from hash stores
+
+A hash store is a web location that provides files under their SHA1 hash
+(``<store URL><sha1>``). Downloads are streamed to disk in chunks, and the
+content is hashed while being written, so that a corrupt file never makes it
+into the file cache. Interrupted downloads are kept as ``.part`` files and
+resumed with HTTP range requests. Connections are kept alive and reused for
+subsequent requests to the same host.
+"""
+
+__docformat__ = 'restructuredtext'
+
+import os
+import time
+import socket
+import hashlib
+import threading
+from six.moves import http_client
+from six.moves.urllib.parse import urlsplit, urljoin
+
+from testkraut import cfg
+
+import logging
+lgr = logging.getLogger(__name__)
+
+_chunk_size = 1024 * 1024
+_max_redirects = 5
+
+
+class ConnectionPool(object):
+    """Idle keep-alive HTTP(S) connections, per host
+
+    Parameters
+    ----------
+    maxsize : int
+      Maximum number of idle connections kept per host.
+    timeout : float
+      Socket timeout of new connections in seconds.
+    """
+    def __init__(self, maxsize=4, timeout=60):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def get(self, scheme, netloc):
+        """Return a connection to a host and whether it was used before"""
+        with self._lock:
+            idle = self._idle.get((scheme, netloc), [])
+            if len(idle):
+                return idle.pop(), True
+        if scheme == 'https':
+            conn_class = http_client.HTTPSConnection
+        elif scheme == 'http':
+            conn_class = http_client.HTTPConnection
+        else:
+            raise ValueError("unsupported URL scheme '%s'" % scheme)
+        return conn_class(netloc, timeout=self.timeout), False
+
+    def put(self, scheme, netloc, conn):
+        """Return a connection that is ready for another request"""
+        with self._lock:
+            idle = self._idle.setdefault((scheme, netloc), [])
+            if len(idle) < self.maxsize:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        """Close all idle connections"""
+        with self._lock:
+            for idle in self._idle.values():
+                for conn in idle:
+                    conn.close()
+            self._idle = {}
+
+# shared by all downloads of a process
+_pool = ConnectionPool()
+
+def _request(url, pool, offset=0, method='GET'):
+    # returns the final URL, and connection and response of a request,
+    # following redirects
+    for _ in range(_max_redirects + 1):
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        headers = {}
+        if offset:
+            headers['Range'] = 'bytes=%i-' % offset
+        while True:
+            conn, reused = pool.get(parts.scheme, parts.netloc)
+            try:
+                conn.request(method, path, headers=headers)
+                response = conn.getresponse()
+                break
+            except (socket.error, http_client.HTTPException):
+                conn.close()
+                if not reused:
+                    raise
+                # the server closed an idle connection, retry with a new one
+                lgr.debug("reconnecting to '%s'" % parts.netloc)
+        if not response.status in (301, 302, 303, 307, 308):
+            return url, conn, response
+        response.read()
+        pool.put(parts.scheme, parts.netloc, conn)
+        url = urljoin(url, response.getheader('location'))
+        lgr.debug("redirected to '%s'" % url)
+    raise http_client.HTTPException("too many redirects")
+
+def _release(url, conn, response, pool):
+    # make a connection available for the next request, if possible
+    if response.will_close:
+        conn.close()
+    else:
+        parts = urlsplit(url)
+        pool.put(parts.scheme, parts.netloc, conn)
+
+def fetch(url, dst, sha1=None, pool=None):
+    """Download a file
+
+    The file content is streamed into ``<dst>.part``, which is renamed to
+    ``dst`` once the download is complete (and verified). If a ``.part``
+    file exists already, the download continues where it stopped.
+
+    Parameters
+    ----------
+    url : str
+    dst : path
+      Destination path. An existing file is replaced.
+    sha1 : str or None
+      If given, the download is rejected unless the SHA1 hash of the
+      content matches.
+    pool : ConnectionPool or None
+      Connections to reuse. If None, a pool shared by all downloads is used.
+
+    Returns
+    -------
+    None or path
+      None is returned whenever the download failed.
+    """
+    if pool is None:
+        pool = _pool
+    return _fetch(url, dst, sha1, pool)[0]
+
+def _fetch(url, dst, sha1, pool):
+    # like fetch(), but also returns the reason of a failure: 'unreachable',
+    # 'missing', 'interrupted', or 'corrupt'
+    partname = dst + '.part'
+    hasher = hashlib.sha1()
+    offset = 0
+    if os.path.exists(partname):
+        # hash what we have already to be able to verify the whole file
+        with open(partname, 'rb') as partfile:
+            for chunk in iter(lambda: partfile.read(_chunk_size), b''):
+                hasher.update(chunk)
+                offset += len(chunk)
+    try:
+        url, conn, response = _request(url, pool, offset)
+    except (socket.error, http_client.HTTPException, ValueError) as e:
+        lgr.debug("cannot connect to '%s' (%s)" % (url, str(e)))
+        return None, 'unreachable'
+    if response.status == 206 and offset:
+        lgr.debug("resume download '%s'->'%s' at byte %i"
+                  % (url, dst, offset))
+        mode = 'ab'
+    elif response.status == 200:
+        lgr.debug("download '%s'->'%s'" % (url, dst))
+        # the server might not support range requests, start over
+        hasher = hashlib.sha1()
+        offset = 0
+        mode = 'wb'
+    else:
+        response.read()
+        _release(url, conn, response, pool)
+        if response.status == 416 and offset:
+            # nothing left to download -- or a bogus .part file
+            if not sha1 is None and hasher.hexdigest() == sha1:
+                os.rename(partname, dst)
+                return dst, None
+            lgr.debug("discarding unusable partial download '%s'" % partname)
+            os.remove(partname)
+            return _fetch(url, dst, sha1, pool)
+        lgr.debug("cannot find '%s' (HTTP status %i)"
+                  % (url, response.status))
+        if response.status >= 500:
+            return None, 'unreachable'
+        return None, 'missing'
+    length = response.getheader('content-length')
+    received = 0
+    try:
+        with open(partname, mode) as partfile:
+            while True:
+                chunk = response.read(_chunk_size)
+                if not len(chunk):
+                    break
+                hasher.update(chunk)
+                partfile.write(chunk)
+                received += len(chunk)
+    except (socket.error, http_client.HTTPException) as e:
+        conn.close()
+        lgr.debug("download of '%s' interrupted (%s)" % (url, str(e)))
+        return None, 'interrupted'
+    if not length is None and received < int(length):
+        conn.close()
+        lgr.debug("download of '%s' incomplete (%i of %s bytes)"
+                  % (url, received, length))
+        return None, 'interrupted'
+    _release(url, conn, response, pool)
+    if not sha1 is None and hasher.hexdigest() != sha1:
+        lgr.warning("content downloaded from '%s' does not match hash '%s', "
+                    "discarded" % (url, sha1))
+        os.remove(partname)
+        return None, 'corrupt'
+    os.rename(partname, dst)
+    return dst, None
+
+def get_hash_stores():
+    """Return the URLs of all configured hash stores"""
+    return cfg.get('data sources', 'hash stores', default='').split()
+
+class MirrorManager(object):
+    """Route downloads to the best available hash store
+
+    All hash stores are probed concurrently, upon first use and whenever
+    no live store is known. Latency (of probes and downloads) and
+    throughput (of downloads) are tracked per store, and each download is
+    attempted at the store with the lowest expected transfer time first.
+    Stores that cannot be reached are skipped until a retry interval has
+    passed, and stores that do not have a file are not asked for it again
+    for a while (negative cache).
+
+    Parameters
+    ----------
+    hash_stores : sequence
+      URLs of the hash stores.
+    probe_timeout : float
+      Socket timeout of probes, in seconds.
+    retry_interval : float
+      Time in seconds before an unreachable store is considered again.
+    negative_ttl : float
+      Time in seconds a store is not asked again for a file it does not
+      have.
+    pool : ConnectionPool or None
+      Connections to reuse. If None, a pool shared by all downloads is used.
+    """
+    # weight of a new measurement in the moving averages
+    _alpha = 0.3
+
+    def __init__(self, hash_stores, probe_timeout=5, retry_interval=300,
+                 negative_ttl=3600, pool=None):
+        self.hash_stores = list(hash_stores)
+        self.probe_timeout = probe_timeout
+        self.retry_interval = retry_interval
+        self.negative_ttl = negative_ttl
+        self._pool = _pool if pool is None else pool
+        self._probe_pool = ConnectionPool(timeout=probe_timeout)
+        self._lock = threading.Lock()
+        self._probe_lock = threading.Lock()
+        # per store: moving averages of latency (s) and throughput (bytes/s)
+        self.latency = {}
+        self.throughput = {}
+        # moving average of the size of downloaded files
+        self._size = {}
+        # time when an unreachable store is considered again
+        self._dead_until = {}
+        # (store, sha1) -> expiry time
+        self._missing = {}
+        self._probed = False
+
+    def _update(self, stats, hs, value):
+        with self._lock:
+            if hs in stats:
+                value = self._alpha * value + (1 - self._alpha) * stats[hs]
+            stats[hs] = value
+
+    def _mark_dead(self, hs):
+        lgr.debug("hash store '%s' is unreachable" % hs)
+        with self._lock:
+            self._dead_until[hs] = time.time() + self.retry_interval
+            self.latency.pop(hs, None)
+
+    def probe(self):
+        """Check the availability and latency of all hash stores at once"""
+        def _probe(hs):
+            start = time.time()
+            try:
+                url, conn, response = _request(hs, self._probe_pool,
+                                               method='HEAD')
+            except (socket.error, http_client.HTTPException, ValueError):
+                return hs, None
+            response.read()
+            _release(url, conn, response, self._probe_pool)
+            if response.status >= 500:
+                return hs, None
+            # any other response shows that the store is alive
+            return hs, time.time() - start
+
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(max(1, len(self.hash_stores)))
+        try:
+            results = pool.map(_probe, self.hash_stores)
+        finally:
+            pool.close()
+            pool.join()
+        self._probe_pool.close()
+        for hs, latency in results:
+            if latency is None:
+                self._mark_dead(hs)
+            else:
+                with self._lock:
+                    self._dead_until.pop(hs, None)
+                self._update(self.latency, hs, latency)
+        self._probed = True
+
+    def get_live_stores(self, sha1=None):
+        """Return the reachable hash stores, best first
+
+        Parameters
+        ----------
+        sha1 : str or None
+          If given, stores known not to have this file are excluded.
+        """
+        if not self._probed:
+            with self._probe_lock:
+                if not self._probed:
+                    self.probe()
+        now = time.time()
+        with self._lock:
+            live = [hs for hs in self.hash_stores
+                        if self._dead_until.get(hs, 0) <= now
+                            and self._missing.get((hs, sha1), 0) <= now]
+
+        def _expected_time(hs):
+            # for a file of typical size; unknown stores last
+            latency = self.latency.get(hs, self.probe_timeout)
+            if hs in self.throughput:
+                return latency + self._size[None] / self.throughput[hs]
+            return latency
+        return sorted(live, key=_expected_time)
+
+    def fetch(self, sha1, dst):
+        """Download a file from the best hash store that has it
+
+        Parameters
+        ----------
+        sha1 : str
+        dst : path
+
+        Returns
+        -------
+        None or path
+          None is returned if no store provided the file.
+        """
+        stores = self.get_live_stores(sha1)
+        if not len(stores) and len(self.hash_stores) \
+           and not len(self.get_live_stores()):
+            # everything is considered dead, probe again -- but not if live
+            # stores are merely known not to have the file
+            self.probe()
+            stores = self.get_live_stores(sha1)
+        for hs in stores:
+            start = time.time()
+            path, failure = _fetch('%s%s' % (hs, sha1), dst, sha1, self._pool)
+            elapsed = time.time() - start
+            if path is not None:
+                # do not count the latency as transfer time
+                size = os.path.getsize(path)
+                transfer = max(elapsed - self.latency.get(hs, 0), 1e-6)
+                self._update(self.throughput, hs, size / transfer)
+                self._update(self._size, None, size)
+                return path
+            if failure == 'missing':
+                self._update(self.latency, hs, elapsed)
+                with self._lock:
+                    self._missing[(hs, sha1)] = time.time() + self.negative_ttl
+            elif failure in ('unreachable', 'interrupted'):
+                self._mark_dead(hs)
+            # corrupt content might be fine at another store
+        return None
+
+# managers of the current process, per set of hash stores
+_mirror_managers = {}
+
+def get_mirror_manager(hash_stores=None):
+    """Return the mirror manager of a set of hash stores
+
+    Parameters
+    ----------
+    hash_stores : sequence or None
+      URLs of the hash stores. If None, the configured hash stores are used.
+    """
+    if hash_stores is None:
+        hash_stores = get_hash_stores()
+    key = tuple(hash_stores)
+    if not key in _mirror_managers:
+        _mirror_managers[key] = MirrorManager(hash_stores)
+    return _mirror_managers[key]
+
+def fetch_into_cache(cache, sha1s, hash_stores=None, nthreads=None):
+    """Download files from hash stores into a file cache
+
+    Files are downloaded concurrently. For each file, the hash stores are
+    tried in the order determined by their ``MirrorManager``. While a file is
+    downloaded its cache entry is locked; anyone else (e.g. on another host
+    sharing the cache) waits for the download instead of repeating it.
+
+    Parameters
+    ----------
+    cache : FileCache
+    sha1s : sequence
+      Hashes of the files to download.
+    hash_stores : sequence or None
+      URLs of the hash stores. If None, the configured hash stores are used.
+    nthreads : int or None
+      Maximum number of concurrent downloads. If None, the 'download
+      threads' setting in the 'data sources' section is used (default: 4).
+
+    Returns
+    -------
+    dict
+      Cache paths of all successfully downloaded files, keyed by hash.
+    """
+    mirrors = get_mirror_manager(hash_stores)
+    if nthreads is None:
+        nthreads = int(cfg.get('data sources', 'download threads',
+                               default='4'))
+    sha1s = list(sha1s)
+    if not len(sha1s) or not len(mirrors.hash_stores):
+        return {}
+
+    def _fetch(sha1):
+        # the lock is held until the file is committed to the cache, and
+        # whoever waited for it finds the file in the cache
+        lock = cache.get_entry_lock(sha1)
+        lock.acquire()
+        try:
+            if sha1 in cache:
+                lgr.debug("'%s' was added to the cache meanwhile" % sha1)
+                return sha1, lock, None, True
+            dst = mirrors.fetch(sha1, cache.get_download_filename(sha1))
+            return sha1, lock, dst, False
+        except:
+            lock.release()
+            raise
+
+    def _commit(sha1, lock, dst, cached):
+        try:
+            if cached:
+                path = cache.get_path(sha1)
+                if not path is None:
+                    fetched[sha1] = path
+            elif not dst is None:
+                fetched[sha1] = cache.commit(sha1, dst)
+        finally:
+            lock.release()
+
+    fetched = {}
+    if nthreads > 1 and len(sha1s) > 1:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(nthreads, len(sha1s)))
+        try:
+            # the cache is only accessed by this thread
+            for result in pool.imap_unordered(_fetch, sha1s):
+                _commit(*result)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for sha1 in sha1s:
+            _commit(*_fetch(sha1))
+    return fetched
@@ -13,14 +13,20 @@ __docformat__ = 'restructuredtext'
 import os
 from os.path import join as opj
 import re
+import stat
 import shutil
 from datetime import datetime
+from six import iteritems
 from uuid import uuid1 as uuid
 from . import utils
 from . import evaluators
-from .utils import run_command, get_shlibdeps, which, sha1sum, \
+from .utils import run_command, get_shlibdeps, which, sha1sum, hash_file, \
+        quicksum, \
         get_script_interpreter, describe_system, get_test_library_paths, \
-        get_filecache_dir, download_file
+        download_file
+from .fileindex import get_file_index
+from .filecache import FileCache, decompress_file
+from .hashstore import fetch_into_cache
 from .pkg_mngr import PkgManager
 from .spec import SPEC
 import testkraut
@@ -33,42 +39,242 @@ def check_file_hash(filespec, filepath):
 
     If not target hash is present in the file SPEC ``None`` is returned.
     Otherwise a boolean return value indicated whether the hash matches.
+    If multiple hashes are present, all of them have to match.
     """
-    for hashtype in ('md5sum', 'sha1sum'):
-        if hashtype in filespec:
-            targethash = filespec[hashtype]
-            hasher = getattr(utils, hashtype)
-            observedhash = hasher(filepath)
-            if targethash != observedhash:
-                lgr.debug("hash for '%s' does not match ('%s' != '%s')"
-                          % (filepath, observedhash, targethash))
-                return False
-            else:
-                lgr.debug("hash for '%s' matches ('%s')"
-                          % (filepath, observedhash))
-                return True
-    lgr.debug("no hash for '%s' found" % filepath)
-    return None
+    targets = dict([(hashtype[:-3], filespec[hashtype])
+                        for hashtype in ('md5sum', 'sha1sum')
+                            if hashtype in filespec])
+    if not len(targets):
+        lgr.debug("no hash for '%s' found" % filepath)
+        return None
+    if not _precheck_file(filespec, filepath):
+        return False
+    # single read pass for all hash types
+    observed = hash_file(filepath, targets.keys())
+    for hashtype, targethash in iteritems(targets):
+        if targethash != observed[hashtype]:
+            lgr.debug("hash for '%s' does not match ('%s' != '%s')"
+                      % (filepath, observed[hashtype], targethash))
+            return False
+    lgr.debug("hash for '%s' matches ('%s')"
+              % (filepath, ', '.join(targets.values())))
+    return True
+
+def _precheck_file(filespec, filepath):
+    # cheap checks to rule out a file before computing a full hash: size
+    # and quicksum (hash of the first and the last MB) if present in the SPEC
+    if 'size' in filespec and os.path.getsize(filepath) != filespec['size']:
+        lgr.debug("size of '%s' does not match" % filepath)
+        return False
+    if 'quicksum' in filespec and quicksum(filepath) != filespec['quicksum']:
+        lgr.debug("quicksum of '%s' does not match" % filepath)
+        return False
+    return True
+
+def _check_indexed_file_hash(index, filespec, filepath):
+    # like check_file_hash(), but uses a recorded hash if possible
+    if 'sha1sum' in filespec:
+        if 'size' in filespec \
+           and os.path.getsize(filepath) != filespec['size']:
+            return False
+        return index.get_sha1(filepath) == filespec['sha1sum']
+    return check_file_hash(filespec, filepath)
 
 def locate_file_in_cache(filespec, cache):
-    """Very simple cache lookup -- to be replaced with proper cache object"""
+    """Look up a file in a file cache by its sha1sum
+
+    Parameters
+    ----------
+    filespec : SPEC dict
+    cache : FileCache or path
+
+    Returns
+    -------
+    None or path
+      Path of the cached file, or None if the file is not cached.
+    """
     if filespec is None:
         filespec = dict()
     if not 'sha1sum' in filespec:
         # nothing we can do
         lgr.debug("cannot lookup file in cache without sha1sum")
         return None
+    if not isinstance(cache, FileCache):
+        cache = FileCache(cache)
+        flush = True
+    else:
+        # up to the owner of the cache
+        flush = False
     sha1 = filespec['sha1sum']
-    cand_filename = opj(cache, sha1)
-    if os.path.isfile(cand_filename):
+    cand_filename = cache.get_path(sha1)
+    if flush:
+        cache.flush()
+    if not cand_filename is None:
         lgr.debug("found file with sha1sum %s in cache" % sha1)
         return cand_filename
     lgr.debug("hash '%s' not present in cache '%s'"
-              % (sha1, cache))
+              % (sha1, cache.path))
     return None
 
+# ioctl request code for cloning a file (from linux/fs.h)
+_FICLONE = 0x40049409
+
+staging_modes = ('copy', 'reflink', 'hardlink', 'symlink')
+
+_write_bits = stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH
+
+def _make_read_only(path):
+    # remove all write permissions of a file, return whether it is read-only
+    # (for this process) afterwards
+    mode = stat.S_IMODE(os.stat(path).st_mode)
+    if mode & _write_bits:
+        try:
+            os.chmod(path, mode & ~_write_bits)
+        except OSError:
+            # e.g. not owned by us
+            return not os.access(path, os.W_OK)
+    return True
+
+def _make_writable(path):
+    # copies are private to the testbed, even of read-only files
+    mode = stat.S_IMODE(os.stat(path).st_mode)
+    if not mode & stat.S_IWUSR:
+        os.chmod(path, mode | stat.S_IWUSR)
+
+def _reflink(src, dst):
+    import fcntl
+    with open(src, 'rb') as srcfile, open(dst, 'wb') as dstfile:
+        fcntl.ioctl(dstfile.fileno(), _FICLONE, srcfile.fileno())
+    shutil.copymode(src, dst)
+
+def stage_file(src, dst, mode='copy'):
+    """Place a file at a destination, possibly without copying its content
+
+    Parameters
+    ----------
+    src : path
+      Source file.
+    dst : path
+      Destination path. Any existing file is replaced.
+    mode : {'copy', 'reflink', 'hardlink', 'symlink'}
+      'reflink' creates a copy-on-write clone (on file systems supporting
+      it, e.g. btrfs or XFS). 'hardlink' and 'symlink' share the file with
+      the source, which is made read-only for that purpose (if this is not
+      possible, the file is copied). Note that file permissions do not stop
+      the superuser (or the owner, after a ``chmod``) from modifying a
+      shared file -- see ``get_modified_shared_files()``. If the desired
+      mode is not possible (e.g. a hard link across file systems), the file
+      is copied. Copies are always writable by their owner.
+
+    Returns
+    -------
+    str
+      The staging mode that was actually used.
+    """
+    if not mode in staging_modes:
+        raise ValueError("unknown staging mode '%s'" % mode)
+    # stage the actual file, not any link to it
+    src = os.path.realpath(src)
+    if os.path.lexists(dst):
+        # never write through an existing link
+        os.remove(dst)
+    try:
+        if mode in ('symlink', 'hardlink'):
+            # share read-only
+            if not _make_read_only(src):
+                raise OSError("'%s' cannot be made read-only" % src)
+            if mode == 'symlink':
+                os.symlink(src, dst)
+            else:
+                os.link(src, dst)
+            return mode
+        elif mode == 'reflink':
+            _reflink(src, dst)
+            _make_writable(dst)
+            return mode
+    except (OSError, IOError) as e:
+        lgr.debug("cannot %s '%s' to '%s' (%s), copying instead"
+                  % (mode, src, dst, str(e)))
+        if os.path.lexists(dst):
+            os.remove(dst)
+    shutil.copy(src, dst)
+    _make_writable(dst)
+    return 'copy'
+
+def get_shared_files_state(filenames):
+    """Record the state of files that are shared with their origin
+
+    Shared files are symlinks and files with multiple hard links. For all
+    those, size and modification time are recorded, to be able to detect
+    modifications with ``get_modified_shared_files()``.
+    """
+    state = {}
+    for fname in filenames:
+        if not os.path.lexists(fname):
+            continue
+        st = os.stat(fname)
+        if os.path.islink(fname) or st.st_nlink > 1:
+            state[fname] = (st.st_size, st.st_mtime)
+    return state
+
+def get_modified_shared_files(state):
+    """Return the names of all shared files that were modified
+
+    Parameters
+    ----------
+    state : dict
+      As returned by ``get_shared_files_state()``.
+    """
+    modified = []
+    for fname, fstate in iteritems(state):
+        if not os.path.exists(fname):
+            # the file was removed or replaced, the origin is unaffected
+            continue
+        st = os.stat(fname)
+        if (os.path.islink(fname) or st.st_nlink > 1) \
+           and (st.st_size, st.st_mtime) != fstate:
+            modified.append(fname)
+    return sorted(modified)
+
+def _place_file(fpath, dest_fname, cache, force_overwrite, staging):
+    # get a file into its destination
+    if not fpath == dest_fname \
+       and (force_overwrite or not os.path.isfile(dest_fname)):
+        dest_dir = os.path.dirname(dest_fname)
+        if not os.path.exists(dest_dir):
+            os.makedirs(dest_dir)
+        if cache.is_compressed(fpath):
+            if os.path.lexists(dest_fname):
+                os.remove(dest_fname)
+            decompress_file(fpath, dest_fname)
+            used = 'decompress'
+        else:
+            used = stage_file(fpath, dest_fname, staging)
+        lgr.debug("%s '%s'->'%s'" % (used, fpath, dest_fname))
+    else:
+        lgr.debug("skip copying already present file '%s'"
+                  % os.path.basename(dest_fname))
+
+def _place_from_cache(filespec, cache, dest_fname, force_overwrite, staging):
+    # place a file from the cache, if it is cached
+    if not 'sha1sum' in filespec:
+        return False
+    # the entry must not be evicted (or quarantined) before it is staged
+    with cache.get_entry_lock(filespec['sha1sum'], shared=True):
+        fpath = locate_file_in_cache(filespec, cache)
+        if fpath is None:
+            return False
+        if staging == 'symlink' and not os.path.islink(fpath):
+            # the entry's content is owned by the cache -- a symlink would
+            # dangle once the entry is evicted, while a hard link keeps the
+            # content (and its disk space) until the testbed is removed
+            staging = 'hardlink'
+        _place_file(fpath, dest_fname, cache, force_overwrite, staging)
+    return True
+
 def place_file_into_dir(filespec, dest_dir, search_dirs=None, cache=None,
-                        force_overwrite=True, symlink_to_cache=True):
+                        force_overwrite=True, symlink_to_cache=True,
+                        staging='copy', fetch=True):
     """Search for a file given a SPEC and place it into a destination directory
 
     Parameters
@@ -82,26 +288,38 @@ def place_file_into_dir(filespec, dest_dir, search_dirs=None, cache=None,
       If not None, a sequence of additional local directories to be searched for
       the desired file (tetskraut configuration might provide more locations
       that will also be searched afterwards)
-    cache : None or path
-      If not None, a path to a file cache directory where the desired file is
-      searched by its sha1sum (if present in the SPEC)
-    """
-    # TODO refactor from simple cachedir to cache object that could also obtain
-    # a file from remote locations
+    cache : None or FileCache or path
+      File cache where the desired file is searched by its sha1sum (if
+      present in the SPEC), and where files found locally or in a hash store
+      are added. If None, the configured file cache is used.
+    staging : str
+      How the file is placed into the destination directory (see
+      ``stage_file()``).
+    fetch : bool
+      Whether to download the file from a hash store, if it cannot be found
+      otherwise.
 
+    Returns
+    -------
+    str
+      Path of the file in the destination directory.
+    """
     # sanity
     if not 'type' in filespec or filespec['type'] != 'file':
         raise ValueError("expected SPEC is not a file SPEC, got : '%s'"
                          % filespec)
     # have a default cache
-    if cache is None:
-        cache = get_filecache_dir()
-    if not os.path.exists(cache):
-        os.makedirs(cache)
+    if not isinstance(cache, FileCache):
+        cache = FileCache(cache)
+        flush = True
+    else:
+        # up to the owner of the cache
+        flush = False
     # search path
     if search_dirs is None:
         search_dirs = []
-    search_dirs += cfg.get('data sources', 'local dirs', default='').split()
+    search_dirs = list(search_dirs) \
+            + cfg.get('data sources', 'local dirs', default='').split()
 
     fname = filespec['value']
     # where the file needs to end up in the testbed
@@ -109,21 +327,22 @@ def place_file_into_dir(filespec, dest_dir, search_dirs=None, cache=None,
     # this will be the discovered file path
     fpath = None
     # first try the cache
-    fpath = locate_file_in_cache(filespec, cache)
+    if _place_from_cache(filespec, cache, dest_fname, force_overwrite,
+                         staging):
+        if flush:
+            cache.flush()
+        return dest_fname
     # do a local search
     if fpath is None and len(search_dirs):
         lgr.debug("cache lookup for '%s' unsuccessful, trying local search"
                   % fname)
-        # do a two-pass scan: first try locating the file by name to avoid
+        # do a two-pass search: first try locating the file by name to avoid
         # sha1-summing all files
-        for search_dir in search_dirs:
-            for root, dirnames, filenames in os.walk(search_dir):
-                cand_path = opj(root, fname)
-                if not os.path.isfile(cand_path):
-                    lgr.debug("could not find file '%s' at '%s'"
-                              % (fname, cand_path))
-                    continue
-                hashmatch = check_file_hash(filespec, cand_path)
+        indices = [get_file_index(d) for d in search_dirs if os.path.isdir(d)]
+        for index in indices:
+            for cand_path in index.find_by_name(fname):
+                hashmatch = _check_indexed_file_hash(index, filespec,
+                                                     cand_path)
                 if hashmatch in (True, None):
                     lgr.debug("found matching file '%s' at '%s'"
                               % (fname, cand_path))
@@ -136,18 +355,20 @@ def place_file_into_dir(filespec, dest_dir, search_dirs=None, cache=None,
             lgr.debug("could not find file '%s' by its name, doing hash lookup"
                       % fname)
             # 2nd pass if we have a hash try locating by hash
-            for search_dir in search_dirs:
-                for root, dirnames, filenames in os.walk(search_dir):
-                    for cand_name in filenames:
-                        cand_path = opj(root, cand_name)
+            for index in indices:
+                if 'sha1sum' in filespec:
+                    fpath = index.find_by_sha1(
+                                filespec['sha1sum'],
+                                size=filespec.get('size', None),
+                                quicksum=filespec.get('quicksum', None))
+                else:
+                    for cand_path in index:
                         if check_file_hash(filespec, cand_path) is True:
-                            lgr.debug("found matching file '%s' at '%s'"
-                                      % (fname, cand_path))
                             fpath = cand_path
                             break
-                    if not fpath is None:
-                        break
                 if not fpath is None:
+                    lgr.debug("found matching file '%s' at '%s'"
+                              % (fname, fpath))
                     break
         if not fpath is None and ('md5sum' in filespec or 'sha1sum' in filespec):
             # place in cache -- but only if any hash is given in the file spec
@@ -157,64 +378,88 @@ def place_file_into_dir(filespec, dest_dir, search_dirs=None, cache=None,
                 sha1 = sha1sum(fpath)
             else:
                 sha1 = filespec['sha1sum']
-            dst_path = opj(cache, sha1)
-            if os.path.exists(dst_path) or os.path.lexists(dst_path):
-                os.remove(dst_path)
-                lgr.debug("removing existing cache entry '%s'" % dst_path)
             if symlink_to_cache:
-                os.symlink(fpath, dst_path)
-                lgr.debug("symlink to cache '%s'->'%s'" % (fpath, dst_path))
-            elif hasattr(os, 'link'):
-                # be nice and try hard-linking
-                try:
-                    os.link(fpath, dst_path)
-                    lgr.debug("hardlink to cache '%s'->'%s'" % (fpath, dst_path))
-                except OSError:
-                    # silently fail if linking doesn't work (e.g.
-                    # cross-device link ... will recover later
-                    shutil.copy(fpath, dst_path)
-                    lgr.debug("copy to cache '%s'->'%s'" % (fpath, dst_path))
+                mode = 'symlink'
             else:
-                shutil.copy(fpath, dst_path)
-                lgr.debug("copy to cache '%s'->'%s'" % (fpath, dst_path))
+                # be nice and try hard-linking
+                mode = 'hardlink'
+            with cache.get_entry_lock(sha1):
+                if not sha1 in cache:
+                    cache.insert(sha1, fpath, mode=mode)
+                    lgr.debug("%s to cache '%s'->'%s'" % (mode, fpath, sha1))
     # trying external data sources
     if fpath is None and 'url' in filespec:
         # url is given
-        fpath = download_file(filespec['url'], dest_fname)
-    if fpath is None and 'sha1sum' in filespec:
+        fpath = download_file(filespec['url'], dest_fname,
+                              sha1=filespec.get('sha1sum', None))
+    if fpath is None and 'sha1sum' in filespec and fetch:
         # lookup in any configured hash store
-        hashpots = cfg.get('data sources', 'hash stores').split()
         sha1 = filespec['sha1sum']
         lgr.debug("local search '%s' unsuccessful, trying hash stores"
                   % fname)
-        dst_path = opj(cache, sha1)
-        for hp in hashpots:
-            fpath = download_file('%s%s' % (hp, sha1), dst_path)
-            if not fpath is None:
-                break
+        if sha1 in fetch_into_cache(cache, [sha1]) \
+           and _place_from_cache(filespec, cache, dest_fname,
+                                 force_overwrite, staging):
+            if flush:
+                cache.flush()
+            return dest_fname
     if fpath is None:
         # out of ideas
         raise LookupError("cannot find file matching spec %s" % filespec)
-    # get the file into the dest_dir
-    if not fpath == dest_fname \
-       and (force_overwrite or not os.path.isfile(dest_fname)):
-        if not os.path.exists(dest_dir):
-            os.makedirs(dest_dir)
-        shutil.copy(fpath, dest_fname)
-    else:
-        lgr.debug("skip copying already present file '%s'" % fname)
+    _place_file(fpath, dest_fname, cache, force_overwrite, staging)
+    if flush:
+        cache.flush()
+    return dest_fname
 
 
 def prepare_local_testbed(spec, dst, search_dirs, cache=None,
-                          force_overwrite=True):
+                          force_overwrite=True, staging=None):
+    """Place all test input files of a SPEC into a testbed
+
+    Parameters
+    ----------
+    staging : str or None
+      How input files are placed into the testbed (see ``stage_file()``).
+      If None, the configured mode is used.
+
+    Returns
+    -------
+    list
+      Paths of all input files in the testbed.
+    """
+    if staging is None:
+        staging = cfg.get('testrun', 'staging', default='reflink')
+    if not isinstance(cache, FileCache):
+        cache = FileCache(cache)
     inspecs = spec.get('inputs', {})
-    # locate and copy test input into testbed
+    placed = {}
+    # inputs to be downloaded
+    missing = {}
+    # locate and stage test input into testbed
     for inspec_id in inspecs:
         inspec = inspecs[inspec_id]
         type_ = inspec['type']
-        if type_ == 'file':
-            place_file_into_dir(inspec, dst,
-                                search_dirs=search_dirs, cache=cache,
-                                force_overwrite=force_overwrite)
-        else:
+        if type_ != 'file':
             raise ValueError("unknown input spec type '%s'" % type_)
+        try:
+            placed[inspec_id] = place_file_into_dir(
+                    inspec, dst, search_dirs=search_dirs, cache=cache,
+                    force_overwrite=force_overwrite, staging=staging,
+                    fetch=False)
+        except LookupError:
+            if not 'sha1sum' in inspec:
+                raise
+            missing[inspec_id] = inspec
+    if len(missing):
+        # download all at once, concurrently
+        lgr.debug("local search for %i input(s) unsuccessful, trying hash "
+                  "stores" % len(missing))
+        fetch_into_cache(cache, set([inspec['sha1sum']
+                                        for inspec in missing.values()]))
+        for inspec_id, inspec in iteritems(missing):
+            placed[inspec_id] = place_file_into_dir(
+                    inspec, dst, search_dirs=search_dirs, cache=cache,
+                    force_overwrite=force_overwrite, staging=staging,
+                    fetch=False)
+    cache.flush()
+    return [placed[inspec_id] for inspec_id in inspecs]
@@ -11,3 +11,4 @@
 __docformat__ = 'restructuredtext'
 
 from .volumeimages import *
+from .resources import *
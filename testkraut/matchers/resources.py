@@ -0,0 +1,46 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the testkraut package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Matchers for resource usage of tests"""
+
+__docformat__ = 'restructuredtext'
+
+from testtools.matchers import Mismatch
+
+class DoesNotExceedBaseline(object):
+    """Matches if a value does not exceed a baseline by more than a tolerance
+
+    Typically used to detect regressions of runtime or memory consumption,
+    e.g. with ``@exec:<test id>:resources:wallclock`` as the value of an
+    assertion.
+
+    Parameters
+    ----------
+    baseline : float
+      Reference value, e.g. the runtime observed for a known-good
+      installation.
+    tolerance : float
+      Acceptable excess relative to the baseline, e.g. 0.5 for 50%.
+    """
+    def __init__(self, baseline, tolerance=0.1):
+        self.baseline = baseline
+        self.tolerance = tolerance
+
+    def __str__(self):
+        return 'DoesNotExceedBaseline(%r, tolerance=%r)' \
+                % (self.baseline, self.tolerance)
+
+    def match(self, value):
+        limit = self.baseline * (1 + self.tolerance)
+        if value > limit:
+            return Mismatch("%r exceeds the baseline %r by more than %g%% "
+                            "(%+.1f%%)"
+                            % (value, self.baseline, self.tolerance * 100,
+                               (float(value) / self.baseline - 1) * 100
+                                    if self.baseline else float('inf')))
+        return None
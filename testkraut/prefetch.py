@@ -0,0 +1,211 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the testkraut package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Staging of test input files ahead of test execution"""
+
+__docformat__ = 'restructuredtext'
+
+import os
+import shutil
+import tempfile
+import threading
+from os.path import join as opj
+
+from .spec import SPEC
+
+import logging
+lgr = logging.getLogger(__name__)
+
+
+class Prefetcher(object):
+    """Prepare the testbeds of upcoming SPECs in a background thread
+
+    Testbeds are prepared in the order in which SPECs will be executed,
+    while earlier SPECs run. A test takes over its prepared testbed with
+    ``claim()``.
+
+    Parameters
+    ----------
+    spec_filenames : sequence
+      SPECs in the order of their execution.
+    search_dirs : list or None
+      Additional directories to search for test input files.
+    depth : int
+      Maximum number of testbeds prepared ahead (and not claimed yet).
+    disk_budget : int or None
+      Maximum size of all input files in prepared testbeds, in bytes. SPECs
+      whose inputs would not fit at all are not prefetched.
+    """
+    def __init__(self, spec_filenames, search_dirs=None, depth=2,
+                 disk_budget=None):
+        self._spec_filenames = list(spec_filenames)
+        self._search_dirs = [] if search_dirs is None else search_dirs
+        self.depth = max(1, depth)
+        self.disk_budget = disk_budget
+        self._cond = threading.Condition()
+        # per SPEC: 'staging', 'claimed', or (testbed, placed files, size)
+        self._state = {}
+        self._nstaged = 0
+        self._staged_bytes = 0
+        self._stopped = False
+        # the SPEC to be prepared next, and the size of its inputs (None
+        # while unknown)
+        self._next = self._spec_filenames[0] \
+                if len(self._spec_filenames) else None
+        self._next_size = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """Stop prefetching and remove all unclaimed testbeds"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self._thread.join()
+        for state in self._state.values():
+            if isinstance(state, tuple) and not state[0] is None:
+                shutil.rmtree(state[0], ignore_errors=True)
+        self._state = {}
+
+    def _get_expected_size(self, spec):
+        # input size as far as recorded in the SPEC
+        return sum([inspec.get('size', 0)
+                        for inspec in spec.get('inputs', {}).values()])
+
+    def _has_room(self, size):
+        if self._nstaged >= self.depth:
+            return False
+        if self.disk_budget is None or not self._nstaged:
+            return True
+        return self._staged_bytes + size <= self.disk_budget
+
+    def _run(self):
+        from .lookup import prepare_local_testbed
+        for i, spec_filename in enumerate(self._spec_filenames):
+            # advanced together with any change of the state of a SPEC, so a
+            # test never sees its SPEC as neither done nor next in line
+            following = self._spec_filenames[i + 1] \
+                    if i + 1 < len(self._spec_filenames) else None
+            try:
+                spec = SPEC(open(spec_filename))
+            except Exception as e:
+                lgr.debug("cannot prefetch '%s' (%s)" % (spec_filename, str(e)))
+                self._advance(following)
+                continue
+            size = self._get_expected_size(spec)
+            with self._cond:
+                self._next_size = size
+                self._cond.notify_all()
+                while not self._stopped and not self._has_room(size):
+                    self._cond.wait()
+                if self._stopped:
+                    break
+                if spec_filename in self._state:
+                    # the test did not wait for us
+                    self._advance(following)
+                    continue
+                if not self.disk_budget is None and size > self.disk_budget:
+                    lgr.debug("inputs of '%s' exceed the prefetch budget"
+                              % spec_filename)
+                    self._state[spec_filename] = (None, None, 0)
+                    self._advance(following)
+                    continue
+                self._state[spec_filename] = 'staging'
+                self._nstaged += 1
+                self._cond.notify_all()
+            testbed = tempfile.mkdtemp(prefix='testkraut')
+            try:
+                placed = prepare_local_testbed(
+                        spec, testbed,
+                        search_dirs=[os.path.dirname(spec_filename)]
+                                        + self._search_dirs,
+                        force_overwrite=True)
+                size = sum([os.path.getsize(p) for p in placed
+                                if not os.path.islink(p)])
+                lgr.debug("prefetched inputs of '%s'" % spec_filename)
+            except Exception as e:
+                # the test will run into the same problem and report it
+                lgr.debug("cannot prefetch inputs of '%s' (%s)"
+                          % (spec_filename, str(e)))
+                shutil.rmtree(testbed, ignore_errors=True)
+                testbed, placed, size = None, None, 0
+            with self._cond:
+                self._state[spec_filename] = (testbed, placed, size)
+                if testbed is None:
+                    self._nstaged -= 1
+                else:
+                    self._staged_bytes += size
+                self._advance(following)
+        self._advance(None)
+
+    def _advance(self, spec_filename):
+        # set the SPEC to be prepared next
+        with self._cond:
+            self._next = spec_filename
+            self._next_size = None
+            self._cond.notify_all()
+
+    def claim(self, spec_filename, dst):
+        """Take over the prepared testbed of a SPEC
+
+        Waits for the preparation to finish, if it is in progress or about to
+        start.
+
+        Parameters
+        ----------
+        spec_filename : path
+        dst : path
+          Testbed location. Must be an empty directory or not exist, and
+          has to be on the same file system as the temporary directory.
+
+        Returns
+        -------
+        None or list
+          Paths of all input files in the testbed, or None if no testbed was
+          prepared. In this case the testbed has to be prepared by the
+          caller.
+        """
+        with self._cond:
+            # the SPEC in line is worth waiting for, unless it has to wait
+            # for room
+            while not spec_filename in self._state \
+                  and spec_filename == self._next \
+                  and (self._next_size is None
+                       or self._has_room(self._next_size)) \
+                  and not self._stopped and self._thread.is_alive():
+                self._cond.wait()
+            if not spec_filename in self._state:
+                # not started -- skip it
+                self._state[spec_filename] = 'claimed'
+                return None
+            while self._state[spec_filename] == 'staging':
+                self._cond.wait()
+            if self._state[spec_filename] == 'claimed':
+                return None
+            testbed, placed, size = self._state[spec_filename]
+            self._state[spec_filename] = 'claimed'
+            if testbed is None:
+                return None
+            self._nstaged -= 1
+            self._staged_bytes -= size
+            self._cond.notify_all()
+        try:
+            if os.path.exists(dst):
+                os.rmdir(dst)
+            os.rename(testbed, dst)
+        except OSError as e:
+            lgr.debug("cannot claim prefetched testbed '%s' (%s)"
+                      % (testbed, str(e)))
+            shutil.rmtree(testbed, ignore_errors=True)
+            if not os.path.exists(dst):
+                os.makedirs(dst)
+            return None
+        return [opj(dst, os.path.relpath(p, testbed)) for p in placed]
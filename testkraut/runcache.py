@@ -0,0 +1,106 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the testkraut package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Persistent cache for the results of passing test runs
+
+Results are stored as JSON files, keyed by a hash of everything that
+determines a test run: the SPEC, the test input files, the test
+dependencies, and the relevant environment variables.
+"""
+
+__docformat__ = 'restructuredtext'
+
+import os
+import json
+import tempfile
+from hashlib import sha1
+from os.path import join as opj
+
+from .utils import get_runcache_dir
+from .spec import SPECJSONEncoder
+
+import logging
+lgr = logging.getLogger(__name__)
+
+
+def get_run_key(spec_hash, input_hashes, dep_hashes, env=None):
+    """Compute the cache key for a test run
+
+    Parameters
+    ----------
+    spec_hash : str
+      As returned by ``SPEC.get_hash()``.
+    input_hashes : dict
+      Mapping of input IDs to the sha1sums of the respective input files.
+    dep_hashes : sequence
+      Hashes of all test dependencies, as computed by ``describe_binary()``
+      or ``describe_python_module()``.
+    env : dict or None
+      Values of relevant environment variables.
+
+    Returns
+    -------
+    str
+      Hex digest.
+    """
+    key = dict(spec=spec_hash,
+               inputs=input_hashes,
+               dependencies=sorted(dep_hashes),
+               env=env if not env is None else {})
+    return sha1(json.dumps(key, separators=(',', ':'),
+                           sort_keys=True).encode('utf-8')).hexdigest()
+
+def _get_record_filename(key, cachedir=None):
+    if cachedir is None:
+        cachedir = get_runcache_dir()
+    return opj(cachedir, key[:2], '%s.json' % key)
+
+def load_run(key, cachedir=None):
+    """Return the stored results of a test run, or None if there are none"""
+    filename = _get_record_filename(key, cachedir)
+    if not os.path.exists(filename):
+        return None
+    try:
+        with open(filename) as record:
+            return json.load(record)
+    except ValueError:
+        lgr.warning("ignoring corrupt run cache record '%s'" % filename)
+        return None
+
+def store_run(key, results, cachedir=None):
+    """Store the results of a test run
+
+    Parameters
+    ----------
+    key : str
+      As returned by ``get_run_key()``.
+    results : dict
+      JSON-serializable test run results.
+    cachedir : path or None
+      Defaults to the configured run cache.
+    """
+    filename = _get_record_filename(key, cachedir)
+    dirname = os.path.dirname(filename)
+    if not os.path.exists(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            # created concurrently
+            if not os.path.isdir(dirname):
+                raise
+    # write to a temp file and move into place to prevent concurrent test
+    # runs from seeing partial records
+    fd, tmpname = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as record:
+            json.dump(results, record, sort_keys=True, cls=SPECJSONEncoder)
+        os.rename(tmpname, filename)
+    except:
+        os.unlink(tmpname)
+        raise
+    lgr.debug("stored run results at '%s'" % filename)
@@ -16,12 +16,18 @@ import re
 import shutil
 from datetime import datetime
 from uuid import uuid1 as uuid
+from six import iteritems
+from testtools import TestResult
 from . import utils
 from . import evaluators
 from .utils import run_command, get_shlibdeps, which, sha1sum, \
         get_script_interpreter, describe_system, get_test_library_paths
 from .pkg_mngr import PkgManager
 from .spec import SPEC
+from .execution import get_zygote
+from .prefetch import Prefetcher
+from .filecache import parse_size
+from .utils import get_process_budget
 import testkraut
 from testkraut import cfg
 import logging
@@ -88,3 +94,238 @@ def get_eval_input(inspec, testspec):
                 % inspec['value'])
     else:
         raise NotImplementedError("dunno how to handle anything but output references")
+
+#
+# Parallel execution of test SPECs
+#
+def _serialize_details(details):
+    # testtools Content objects hold callables -- turn them into plain data
+    # that can be shipped back from a worker process
+    if details is None:
+        return {}
+    sdetails = {}
+    for name, content in iteritems(details):
+        ctype = content.content_type
+        sdetails[name] = (ctype.type, ctype.subtype, dict(ctype.parameters),
+                          b''.join(content.iter_bytes()))
+    return sdetails
+
+def _deserialize_details(sdetails):
+    from testtools.content import Content
+    from testtools.content_type import ContentType
+    details = {}
+    for name, (type_, subtype, params, data) in iteritems(sdetails):
+        details[name] = Content(ContentType(type_, subtype, params),
+                                lambda data=data: [data])
+    return details
+
+
+class _OutcomeRecorder(TestResult):
+    """Record the outcome of a single test in a picklable form"""
+    def __init__(self):
+        TestResult.__init__(self)
+        self.record = None
+        self._start_time = None
+
+    def startTest(self, test):
+        TestResult.startTest(self, test)
+        self._start_time = self._now()
+
+    def _record(self, test, outcome, details):
+        self.record = dict(test_id=test.id(),
+                           outcome=outcome,
+                           details=_serialize_details(details),
+                           timestamps=(self._start_time, self._now()))
+
+    def _err_details(self, test, err, details):
+        if details is None and not err is None:
+            from testtools.content import TracebackContent
+            details = {'traceback': TracebackContent(err, test)}
+        return details
+
+    def addSuccess(self, test, details=None):
+        TestResult.addSuccess(self, test, details=details)
+        self._record(test, 'addSuccess', details)
+
+    def addFailure(self, test, err=None, details=None):
+        TestResult.addFailure(self, test, err=err, details=details)
+        self._record(test, 'addFailure', self._err_details(test, err, details))
+
+    def addError(self, test, err=None, details=None):
+        TestResult.addError(self, test, err=err, details=details)
+        self._record(test, 'addError', self._err_details(test, err, details))
+
+    def addSkip(self, test, reason=None, details=None):
+        TestResult.addSkip(self, test, reason=reason, details=details)
+        if details is None:
+            from testtools.content import text_content
+            details = {'reason': text_content(reason)}
+        self._record(test, 'addSkip', details)
+
+    def addExpectedFailure(self, test, err=None, details=None):
+        TestResult.addExpectedFailure(self, test, err=err, details=details)
+        self._record(test, 'addExpectedFailure',
+                     self._err_details(test, err, details))
+
+    def addUnexpectedSuccess(self, test, details=None):
+        TestResult.addUnexpectedSuccess(self, test, details=details)
+        self._record(test, 'addUnexpectedSuccess', details)
+
+
+def _get_spec_test(spec_id, spec_filename, search_dirs, force=False,
+                   process_budget=None):
+    from .testcase import generate_testkraut_tests, TestArgs
+    testclass = generate_testkraut_tests(
+            search_dirs, [], {spec_id: TestArgs(spec_filename)})
+    test = testclass('test_%s' % spec_id)
+    test.reuse_results = not force
+    test.process_budget = process_budget
+    return test
+
+def _run_spec_worker(task):
+    # executed in a worker process: run a single SPEC and report back
+    result = _OutcomeRecorder()
+    _get_spec_test(*task).run(result)
+    return result.record
+
+def _replay_outcome(record, result):
+    from testtools import PlaceHolder
+    PlaceHolder(record['test_id'],
+                details=_deserialize_details(record['details']),
+                outcome=record['outcome'],
+                timestamps=record['timestamps']).run(result)
+
+def _run_worker_process(task, conn):
+    # executed in a worker process: send the outcome of a single SPEC back
+    try:
+        conn.send(_run_spec_worker(task))
+    finally:
+        conn.close()
+
+def _get_lost_worker_record(task, exitcode):
+    # error outcome of a SPEC whose worker process died without reporting
+    from testtools.content import text_content
+    return dict(test_id=_get_spec_test(*task).id(),
+                outcome='addError',
+                details=_serialize_details(
+                    {'error': text_content(
+                        "worker process died with exit code %s before "
+                        "reporting a result" % exitcode)}),
+                timestamps=(None, None))
+
+def _run_in_pool(tasks, nprocs, result):
+    import select
+    from multiprocessing import Process, Pipe
+    pending = list(tasks)
+    # receiving end of a worker's pipe -> (process, task)
+    running = {}
+    try:
+        while len(pending) or len(running):
+            # one SPEC per worker process, to not carry over any state a test
+            # might leave behind in the interpreter
+            while len(pending) and len(running) < nprocs:
+                task = pending.pop(0)
+                rconn, wconn = Pipe(duplex=False)
+                proc = Process(target=_run_worker_process, args=(task, wconn))
+                proc.start()
+                # only the worker may hold the sending end, or a dead worker
+                # would go unnoticed
+                wconn.close()
+                running[rconn] = (proc, task)
+            # report results in the order they become available, but check
+            # regularly for workers that died (e.g. killed for lack of memory)
+            ready = select.select(list(running), [], [], 1.0)[0]
+            for rconn, (proc, task) in list(running.items()):
+                if not rconn in ready and proc.is_alive():
+                    continue
+                try:
+                    record = rconn.recv() if rconn.poll() else None
+                except EOFError:
+                    record = None
+                del running[rconn]
+                rconn.close()
+                proc.join()
+                if record is None:
+                    lgr.warning("lost worker process for '%s' (exit code %s)"
+                                % (task[0], proc.exitcode))
+                    record = _get_lost_worker_record(task, proc.exitcode)
+                lgr.debug("received result for '%s'" % record['test_id'])
+                _replay_outcome(record, result)
+    finally:
+        for proc, task in running.values():
+            proc.terminate()
+            proc.join()
+
+def run_specs(specs, result, search_dirs=None, nprocs=1, force=False):
+    """Run test SPECs and report all outcomes to a single test result
+
+    Parameters
+    ----------
+    specs : dict
+      Mapping of test IDs to SPEC filenames wrapped in ``TestArgs``, as
+      returned by ``testcase.discover_specs()``.
+    result : TestResult
+      Any (testtools-compatible) test result instance, e.g. a subunit
+      protocol client. Outcomes are reported as soon as a test finishes.
+    search_dirs : list or None
+      Additional directories to search for test input files.
+    nprocs : int
+      Number of worker processes. If 1, all tests are executed in the
+      current process. Otherwise SPECs are distributed across a pool of
+      worker processes, except for SPECs with a true ``exclusive`` flag.
+      These are executed one at a time, after all other tests completed.
+      SPECs running in parallel share the configured process budget
+      evenly. In a serial run, the testbeds of upcoming SPECs are prepared
+      while a SPEC runs (see the 'prefetch depth' and 'prefetch disk budget'
+      settings in the 'testrun' section).
+    force : bool
+      If True, all SPECs are executed, even if the results of a previous
+      run could be reused.
+    """
+    if search_dirs is None:
+        search_dirs = []
+    if cfg.getboolean('testrun', 'isolate python tests', default=True):
+        # start before any worker process, all workers share it
+        get_zygote()
+    # SPECs executed in parallel share the process budget, exclusive ones
+    # get it all
+    budget = get_process_budget()
+    tasks = [(spec_id, args[0][0], search_dirs, force,
+              max(1, budget // nprocs))
+                for spec_id, args in sorted(specs.items())]
+    if nprocs == 1:
+        # prepare the testbeds of upcoming SPECs while a SPEC runs
+        prefetcher = None
+        depth = int(cfg.get('testrun', 'prefetch depth', default='2'))
+        if depth > 0 and len(tasks) > 1 and get_zygote() is None:
+            # test processes would have to be forked from this process, which
+            # is unsafe while the prefetch thread runs
+            lgr.warning("no zygote process, testbeds are not prepared ahead")
+        elif depth > 0 and len(tasks) > 1:
+            disk_budget = cfg.get('testrun', 'prefetch disk budget',
+                                  default='')
+            prefetcher = Prefetcher(
+                    [task[1] for task in tasks], search_dirs, depth=depth,
+                    disk_budget=parse_size(disk_budget)
+                                    if len(disk_budget.strip()) else None)
+            prefetcher.start()
+        try:
+            for task in tasks:
+                test = _get_spec_test(*task)
+                test.prefetcher = prefetcher
+                test.run(result)
+        finally:
+            if not prefetcher is None:
+                prefetcher.stop()
+        return
+    shared = []
+    exclusive = []
+    for task in tasks:
+        if SPEC(open(task[1])).get('exclusive', False):
+            exclusive.append(task[:-1] + (budget,))
+        else:
+            shared.append(task)
+    lgr.debug("run %i SPECs with %i workers, and %i exclusive SPECs"
+              % (len(shared), nprocs, len(exclusive)))
+    _run_in_pool(shared, nprocs, result)
+    _run_in_pool(exclusive, 1, result)
@@ -0,0 +1,249 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the testkraut package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Fast differences between long sequences
+
+A replacement for ``difflib.SequenceMatcher(None, a, b).get_opcodes()``
+that stays fast for sequences with 10^5 and more elements, and does not
+apply difflib's "autojunk" heuristic, which ignores frequent elements of
+long sequences.
+
+Sequences of equal length whose elements only changed in place are
+compared element-wise, in linear time. All other sequences are aligned
+with a patience diff: elements that are unique in both sequences anchor the
+alignment, and the remaining gaps are aligned with Myers' O(ND) algorithm.
+The runtime of the latter grows with the number of edits, hence it gives up
+on gaps that need more than ``max_edit_distance`` insertions and deletions
+(``default_max_edit_distance`` unless specified). Such a gap is reported as
+a single 'replace' (or 'delete'/'insert'), even if it contains elements that
+match, i.e. the result is no longer a minimal difference.
+"""
+
+__docformat__ = 'restructuredtext'
+
+from bisect import bisect_left
+
+from six.moves import xrange
+
+# maximum number of insertions and deletions in a gap between anchors that
+# is aligned with Myers' algorithm -- larger gaps are considered replaced
+default_max_edit_distance = 1000
+
+def _get_elementwise_opcodes(a, b):
+    # opcodes of two sequences of equal length, or None if elements moved
+    mismatched = [i for i in xrange(len(a)) if a[i] != b[i]]
+    if len(mismatched):
+        try:
+            if not set([a[i] for i in mismatched]).isdisjoint(
+                    [b[i] for i in mismatched]):
+                # values might have moved, do a proper alignment
+                return None
+        except TypeError:
+            # unhashable values can only be compared in place
+            pass
+    opcodes = []
+    start = 0
+    for i in mismatched + [len(a)]:
+        if i > start:
+            opcodes.append(('equal', start, i, start, i))
+        if i < len(a):
+            if len(opcodes) and opcodes[-1][0] == 'replace' \
+               and opcodes[-1][2] == i:
+                opcodes[-1] = ('replace', opcodes[-1][1], i + 1,
+                               opcodes[-1][3], i + 1)
+            else:
+                opcodes.append(('replace', i, i + 1, i, i + 1))
+        start = i + 1
+    return opcodes
+
+def _get_unique_anchors(a, alo, ahi, b, blo, bhi):
+    # longest increasing sequence of (i, j) with a[i] == b[j] unique in both
+    # ranges
+    in_a = {}
+    for i in xrange(alo, ahi):
+        # None for duplicates
+        in_a[a[i]] = None if a[i] in in_a else i
+    in_b = {}
+    for j in xrange(blo, bhi):
+        in_b[b[j]] = None if b[j] in in_b else j
+    pairs = sorted([(i, in_b[value]) for value, i in in_a.iteritems()
+                        if not i is None and not in_b.get(value, None) is None])
+    if not len(pairs):
+        return []
+    # patience sorting
+    tails = []
+    tail_idx = []
+    prev = [None] * len(pairs)
+    for n, (i, j) in enumerate(pairs):
+        pos = bisect_left(tails, j)
+        if pos == len(tails):
+            tails.append(j)
+            tail_idx.append(n)
+        else:
+            tails[pos] = j
+            tail_idx[pos] = n
+        prev[n] = tail_idx[pos - 1] if pos else None
+    anchors = []
+    n = tail_idx[-1]
+    while not n is None:
+        anchors.append(pairs[n])
+        n = prev[n]
+    anchors.reverse()
+    return anchors
+
+def _get_myers_blocks(a, alo, ahi, b, blo, bhi, max_edit_distance):
+    # matching blocks of a shortest edit script, or None if it has more than
+    # max_edit_distance edits
+    n, m = ahi - alo, bhi - blo
+    v = {1: 0}
+    trace = []
+    for d in xrange(min(n + m, max_edit_distance) + 1):
+        vd = {}
+        for k in xrange(-d, d + 1, 2):
+            if k == -d or (k != d and v[k - 1] < v[k + 1]):
+                # insertion
+                x = v[k + 1]
+            else:
+                # deletion
+                x = v[k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[alo + x] == b[blo + y]:
+                x += 1
+                y += 1
+            vd[k] = x
+            if x >= n and y >= m:
+                trace.append(vd)
+                return _backtrack(trace, x, y, alo, blo)
+        trace.append(vd)
+        v = vd
+    return None
+
+def _backtrack(trace, x, y, alo, blo):
+    # matching blocks along the path found by _get_myers_blocks()
+    blocks = []
+    for d in xrange(len(trace) - 1, 0, -1):
+        v = trace[d - 1]
+        k = x - y
+        if k == -d or (k != d and v[k - 1] < v[k + 1]):
+            prev_k = k + 1
+            prev_x = v[prev_k]
+            mid_x = prev_x
+        else:
+            prev_k = k - 1
+            prev_x = v[prev_k]
+            mid_x = prev_x + 1
+        if x > mid_x:
+            blocks.append((alo + mid_x, blo + mid_x - k, x - mid_x))
+        x, y = prev_x, prev_x - prev_k
+    if x > 0:
+        blocks.append((alo, blo, x))
+    return blocks
+
+def get_matching_blocks(a, b, max_edit_distance=None):
+    """Return the matching blocks of two sequences
+
+    See ``difflib.SequenceMatcher.get_matching_blocks()``. Elements have to
+    be hashable. Gaps between unique anchors that need more than
+    ``max_edit_distance`` insertions and deletions contain no matching
+    blocks (see ``get_opcodes()``).
+    """
+    if max_edit_distance is None:
+        max_edit_distance = default_max_edit_distance
+    blocks = []
+    regions = [(0, len(a), 0, len(b))]
+    while len(regions):
+        alo, ahi, blo, bhi = regions.pop()
+        # common prefix and suffix
+        n = 0
+        while alo + n < ahi and blo + n < bhi and a[alo + n] == b[blo + n]:
+            n += 1
+        if n:
+            blocks.append((alo, blo, n))
+            alo += n
+            blo += n
+        n = 0
+        while alo < ahi - n and blo < bhi - n \
+              and a[ahi - n - 1] == b[bhi - n - 1]:
+            n += 1
+        if n:
+            blocks.append((ahi - n, bhi - n, n))
+            ahi -= n
+            bhi -= n
+        if alo == ahi or blo == bhi:
+            continue
+        anchors = _get_unique_anchors(a, alo, ahi, b, blo, bhi)
+        if len(anchors):
+            for i, j in anchors:
+                if i > alo or j > blo:
+                    regions.append((alo, i, blo, j))
+                blocks.append((i, j, 1))
+                alo, blo = i + 1, j + 1
+            regions.append((alo, ahi, blo, bhi))
+            continue
+        myers = _get_myers_blocks(a, alo, ahi, b, blo, bhi,
+                                  max_edit_distance)
+        if not myers is None:
+            blocks.extend(myers)
+    # join adjacent blocks
+    joined = []
+    for i, j, n in sorted(blocks):
+        if len(joined) and joined[-1][0] + joined[-1][2] == i \
+           and joined[-1][1] + joined[-1][2] == j:
+            joined[-1] = (joined[-1][0], joined[-1][1], joined[-1][2] + n)
+        else:
+            joined.append((i, j, n))
+    joined.append((len(a), len(b), 0))
+    return joined
+
+def get_opcodes(a, b, max_edit_distance=None):
+    """Return opcodes that turn one sequence into another
+
+    Compatible with ``difflib.SequenceMatcher(None, a, b).get_opcodes()``.
+    Sequences of equal length, whose differing elements are no elements of
+    the other sequence's differing elements, are compared element-wise. This
+    also works for unhashable elements.
+
+    Otherwise, differing regions between elements that are unique in both
+    sequences are aligned with Myers' algorithm, which is given up on after
+    ``max_edit_distance`` insertions and deletions. The whole region is then
+    reported as replaced, even if some of its elements match.
+
+    Parameters
+    ----------
+    a : sequence
+    b : sequence
+    max_edit_distance : int or None
+      Maximum number of insertions and deletions to align a region with. If
+      None, the module's ``default_max_edit_distance`` (1000) is used.
+
+    Returns
+    -------
+    list
+      Tuples of tag ('equal', 'replace', 'delete', or 'insert') and start
+      and end index in ``a`` and ``b``.
+    """
+    if len(a) == len(b):
+        opcodes = _get_elementwise_opcodes(a, b)
+        if not opcodes is None:
+            return opcodes
+    i = j = 0
+    opcodes = []
+    for ai, bj, size in get_matching_blocks(a, b, max_edit_distance):
+        tag = ''
+        if i < ai and j < bj:
+            tag = 'replace'
+        elif i < ai:
+            tag = 'delete'
+        elif j < bj:
+            tag = 'insert'
+        if tag:
+            opcodes.append((tag, i, ai, j, bj))
+        i, j = ai + size, bj + size
+        if size:
+            opcodes.append(('equal', ai, i, bj, j))
+    return opcodes
@@ -12,10 +12,14 @@ __docformat__ = 'restructuredtext'
 
 import json
 import difflib
+import weakref
+from hashlib import sha1
 from uuid import uuid1 as uuid
 
-from six import string_types, iteritems
-from six.moves import xrange
+from six import string_types, iteritems, text_type
+from six.moves import xrange, copyreg
+
+from .seqdiff import get_opcodes
 
 __allowed_spec_keys__ = [
         'assertions',
@@ -23,6 +27,7 @@ __allowed_spec_keys__ = [
         'dependencies',
         'description',
         'environment',
+        'exclusive',
         'id',
         'inputs',
         'metrics',
@@ -55,7 +60,36 @@ def _verify_spec_tags(specs, tags, name):
         os = specs[os_id]
         _verify_tags(os, tags, '%s: %s' % (name, os_id))
 
+def _get_json_compliant(o):
+    # copy of a container tree with non-finite floats replaced by their
+    # (JavaScript) names
+    if isinstance(o, float):
+        if o != o:
+            return 'NaN'
+        elif o in (float('inf'), float('-inf')):
+            return 'Infinity' if o > 0 else '-Infinity'
+        return o
+    elif isinstance(o, dict):
+        return dict([(k, _get_json_compliant(v)) for k, v in iteritems(o)])
+    elif isinstance(o, (list, tuple)):
+        return [_get_json_compliant(v) for v in o]
+    elif hasattr(o, 'tolist'):
+        # numpy arrays and scalars
+        return _get_json_compliant(o.tolist())
+    return o
+
 class SPECJSONEncoder(json.JSONEncoder):
+    """JSON encoder for SPECs and the numpy arrays they may contain
+
+    With ``allow_nan=False`` non-finite floats are encoded as the strings
+    'NaN', 'Infinity', and '-Infinity' instead of raising ``ValueError``,
+    hence the output is always valid JSON.
+    """
+    def iterencode(self, o, _one_shot=False):
+        if not self.allow_nan:
+            o = _get_json_compliant(o)
+        return super(SPECJSONEncoder, self).iterencode(o, _one_shot)
+
     def default(self, o):
         try:
             import numpy as np
@@ -70,13 +104,249 @@ class SPECJSONEncoder(json.JSONEncoder):
             pass
         return super(SPECJSONEncoder, self).default(o)
 
-class SPEC(dict):
+#
+# Merkle hashing of SPEC trees
+#
+# Containers of SPECs loaded from JSON are HashedDict and HashedList
+# instances. They cache the hash of their content, computed from the hashes
+# of their items, and drop it (and the one of all containers they are part
+# of) when they are modified. Plain containers and other mutable values
+# (e.g. arrays) inside a SPEC are hashed, but never cached.
+#
+
+_immutable_types = (int, long, float, bool, type(None))
+_leaf_types = string_types + _immutable_types
+
+def _serialize_leaf(obj):
+    # type-tagged byte representation of a value that is no container
+    if isinstance(obj, text_type):
+        # str and unicode are the same text
+        return 's' + obj.encode('utf-8')
+    elif isinstance(obj, string_types):
+        return 's' + obj
+    elif isinstance(obj, _immutable_types):
+        return '%s:%r' % (type(obj).__name__, obj)
+    return '%s:%s' % (type(obj).__name__,
+                      json.dumps(obj, separators=(',', ':'), sort_keys=True,
+                                 cls=SPECJSONEncoder))
+
+def _get_tree_hash(obj):
+    # returns the hash, and whether it may be cached
+    if isinstance(obj, _HashedContainer):
+        return obj._get_tree_hash()
+    if isinstance(obj, dict):
+        return _hash_items('dict', iteritems(obj))[0], False
+    elif isinstance(obj, (list, tuple)):
+        return _hash_items(type(obj).__name__, obj)[0], False
+    return sha1(_serialize_leaf(obj)).digest(), isinstance(obj, _leaf_types)
+
+def _hash_items(tag, items):
+    # hash of a container, computed from the hashes of contained containers
+    # and the representations of all other values
+    parts = [tag]
+    cacheable = True
+    if tag == 'dict':
+        # independent of the order of the keys
+        items = sorted([(_serialize_leaf(k), v) for k, v in items],
+                       key=lambda i: i[0])
+    for item in items:
+        if tag == 'dict':
+            key, item = item
+            parts.append('k%i:%s' % (len(key), key))
+        if isinstance(item, _leaf_types):
+            value = _serialize_leaf(item)
+            parts.append('v%i:%s' % (len(value), value))
+        else:
+            hash_, cacheable_ = _get_tree_hash(item)
+            parts.append('h' + hash_)
+            cacheable = cacheable and cacheable_
+    return sha1(''.join(parts)).digest(), cacheable
+
+def _make_hashed(obj):
+    # replace the plain containers of a freshly loaded JSON tree
+    if isinstance(obj, dict):
+        return HashedDict([(k, _make_hashed(v)) for k, v in iteritems(obj)])
+    elif isinstance(obj, list):
+        return HashedList([_make_hashed(v) for v in obj])
+    return obj
+
+
+class _HashedContainer(object):
+    # cached hash of the content, or None
+    _hash = None
+
+    def _adopt(self, value):
+        if isinstance(value, _HashedContainer):
+            if not '_parents' in value.__dict__:
+                value._parents = weakref.WeakValueDictionary()
+            value._parents[id(self)] = self
+        return value
+
+    def _invalidate(self):
+        # whenever a container has a cached hash, all its items have one too,
+        # hence there is no need to go beyond containers without one
+        stack = [self]
+        while len(stack):
+            node = stack.pop()
+            if node._hash is None:
+                continue
+            node._hash = None
+            if '_parents' in node.__dict__:
+                stack.extend(node._parents.values())
+
+    def _get_tree_hash(self):
+        if not self._hash is None:
+            return self._hash, True
+        hash_, cacheable = self._hash_content()
+        if cacheable:
+            self._hash = hash_
+        return hash_, cacheable
+
+    def __reduce__(self):
+        # copies get their own parents and hashes (and no __init__() call,
+        # which might validate the content)
+        return (copyreg.__newobj__, (type(self),), self._get_content())
+
+
+class HashedDict(_HashedContainer, dict):
+    """Dictionary that caches a hash of its content"""
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        for value in self.itervalues():
+            self._adopt(value)
+
+    def _hash_content(self):
+        return _hash_items('dict', iteritems(self))
+
+    def _get_content(self):
+        return dict(self)
+
+    def __setstate__(self, state):
+        dict.update(self, state)
+        for value in self.itervalues():
+            self._adopt(value)
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, self._adopt(value))
+        self._invalidate()
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._invalidate()
+
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        for value in self.itervalues():
+            self._adopt(value)
+        self._invalidate()
+
+    def setdefault(self, key, default=None):
+        value = dict.setdefault(self, key, self._adopt(default))
+        self._invalidate()
+        return value
+
+    def pop(self, *args):
+        value = dict.pop(self, *args)
+        self._invalidate()
+        return value
+
+    def popitem(self):
+        item = dict.popitem(self)
+        self._invalidate()
+        return item
+
+    def clear(self):
+        dict.clear(self)
+        self._invalidate()
+
+
+class HashedList(_HashedContainer, list):
+    """List that caches a hash of its content"""
+    def __init__(self, *args):
+        list.__init__(self, *args)
+        for value in self:
+            self._adopt(value)
+
+    def _hash_content(self):
+        return _hash_items('list', self)
+
+    def _get_content(self):
+        return list(self)
+
+    def __setstate__(self, state):
+        list.extend(self, state)
+        for value in self:
+            self._adopt(value)
+
+    def _modified(self, values=()):
+        for value in values:
+            self._adopt(value)
+        self._invalidate()
+
+    def __setitem__(self, index, value):
+        list.__setitem__(self, index, value)
+        self._modified(value if isinstance(index, slice) else (value,))
+
+    def __setslice__(self, i, j, values):
+        list.__setslice__(self, i, j, values)
+        self._modified(values)
+
+    def __delitem__(self, index):
+        list.__delitem__(self, index)
+        self._modified()
+
+    def __delslice__(self, i, j):
+        list.__delslice__(self, i, j)
+        self._modified()
+
+    def __iadd__(self, values):
+        list.__iadd__(self, values)
+        self._modified(values)
+        return self
+
+    def __imul__(self, n):
+        list.__imul__(self, n)
+        self._modified()
+        return self
+
+    def append(self, value):
+        list.append(self, value)
+        self._modified((value,))
+
+    def extend(self, values):
+        values = list(values)
+        list.extend(self, values)
+        self._modified(values)
+
+    def insert(self, index, value):
+        list.insert(self, index, value)
+        self._modified((value,))
+
+    def pop(self, *args):
+        value = list.pop(self, *args)
+        self._modified()
+        return value
+
+    def remove(self, value):
+        list.remove(self, value)
+        self._modified()
+
+    def reverse(self):
+        list.reverse(self)
+        self._modified()
+
+    def sort(self, *args, **kwargs):
+        list.sort(self, *args, **kwargs)
+        self._modified()
+
+
+class SPEC(HashedDict):
     def __init__(self, src=None):
-        dict.__init__(self)
+        HashedDict.__init__(self)
         if isinstance(src, file):
-            self.update(json.load(src))
+            self.update(_make_hashed(json.load(src)))
         elif isinstance(src, string_types):
-            self.update(json.loads(src))
+            self.update(_make_hashed(json.loads(src)))
         elif isinstance(src, dict):
             self.update(src)
         # charge with sane defaults
@@ -103,7 +373,7 @@ class SPEC(dict):
                 _raise(ValueError,
                     "version needs to be a non-negative integer value "
                     "(got: %s)." % value)
-        dict.__setitem__(self, key, value)
+        super(SPEC, self).__setitem__(key, value)
 
     def get(self, *args):
         # check for proper field names
@@ -111,10 +381,26 @@ class SPEC(dict):
             raise ValueError("refuse to access unsupported key", args[0])
         return super(SPEC, self).get(*args)
 
-    def get_hash(self):
-        from hashlib import sha1
-        str_repr = json.dumps(self, separators=(',',':'), sort_keys=True)
-        return sha1(str_repr).hexdigest()
+    def get_hash(self, *keys):
+        """Return the hash of the SPEC content, or of any part of it
+
+        Hashes of unchanged parts of a SPEC loaded from JSON are cached,
+        hence only modified parts are hashed again.
+
+        Parameters
+        ----------
+        *keys
+          Path to a part of the SPEC, e.g. ``('outputs', 'brain')``.
+
+        Returns
+        -------
+        str
+          Hex digest.
+        """
+        obj = self
+        for key in keys:
+            obj = obj[key]
+        return _get_tree_hash(obj)[0].encode('hex')
 
     def save(self, filename, minimize=False):
         from operator import isSequenceType, isMappingType
@@ -149,15 +435,118 @@ class SPEC(dict):
     def diff(self, spec, **kwargs):
         return diff(self, spec, **kwargs)
 
+    def iter_diff(self, spec, **kwargs):
+        return iter_diff(self, spec, **kwargs)
+
+
+def _get_kind(obj):
+    # hashed containers are just containers
+    if type(obj) is HashedDict:
+        return dict
+    elif type(obj) is HashedList:
+        return list
+    return type(obj)
 
 def spec_testoutput_ids(spec):
         return spec.get('outputs', {}).keys()
 
+# number of array elements compared at once
+_arraydiff_chunk_size = 65536
+# number of the largest differences reported for an array
+_arraydiff_top = 10
+
+def _exceeds_tolerance(fr, to, min_abs_numdiff, min_rel_numdiff):
+    # whether two numbers differ by at least the tolerance
+    if fr == to or (fr != fr and to != to):
+        # equal, or both NaN
+        return False
+    tol = (min_abs_numdiff or 0) + (min_rel_numdiff or 0) * abs(fr)
+    # a comparison with NaN is never below the tolerance
+    return not abs(to - fr) < tol
+
+def _get_numeric_chunk(np, seq, start):
+    # numerical array from a part of a sequence, or None
+    arr = np.array(seq[start:start + _arraydiff_chunk_size])
+    if not arr.dtype.kind in 'iuf':
+        # e.g. strings, None, bools, or ragged nested lists
+        return None
+    return arr.astype(float)
+
+def _diff_arrays(fr, to, min_abs_numdiff, min_rel_numdiff):
+    # summary of the differences between two numerical arrays (given as
+    # sequences of equal length), or False if they are not numerical
+    try:
+        import numpy as np
+    except ImportError:
+        return False
+    count = 0
+    max_abs = max_rel = 0.0
+    # (-ranking, flat index, from, to) of the largest differences
+    top = []
+    shape = None
+    for start in xrange(0, len(fr), _arraydiff_chunk_size):
+        arr_fr = _get_numeric_chunk(np, fr, start)
+        arr_to = _get_numeric_chunk(np, to, start)
+        if arr_fr is None or arr_to is None \
+           or not arr_fr.shape == arr_to.shape \
+           or (not shape is None and not arr_fr.shape[1:] == shape[1:]):
+            return False
+        shape = arr_fr.shape
+        # flat index of the first element of the chunk
+        flat_offset = start * (arr_fr.size // shape[0])
+        arr_fr, arr_to = arr_fr.ravel(), arr_to.ravel()
+        absdiff = np.abs(arr_to - arr_fr)
+        with np.errstate(invalid='ignore'):
+            # element-wise _exceeds_tolerance()
+            tol = (min_abs_numdiff or 0) \
+                    + (min_rel_numdiff or 0) * np.abs(arr_fr)
+            exceeds = (arr_fr != arr_to) \
+                      & ~(np.isnan(arr_fr) & np.isnan(arr_to)) \
+                      & ~(absdiff < tol)
+        idx = np.flatnonzero(exceeds)
+        if not len(idx):
+            continue
+        count += len(idx)
+        # NaN mismatches rank first
+        ranking = np.where(np.isnan(absdiff[idx]), np.inf, absdiff[idx])
+        finite = ~np.isnan(absdiff[idx])
+        if finite.any():
+            max_abs = max(max_abs, float(absdiff[idx][finite].max()))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                rel = absdiff[idx][finite] / np.abs(arr_fr[idx][finite])
+            max_rel = max(max_rel, float(rel.max()))
+        if len(idx) > _arraydiff_top:
+            best = np.argpartition(-ranking, _arraydiff_top)[:_arraydiff_top]
+            idx, ranking = idx[best], ranking[best]
+        top = sorted(top + [(-r, flat_offset + i, arr_fr[i], arr_to[i])
+                                for r, i in zip(ranking, idx)])[:_arraydiff_top]
+    if not count:
+        return None
+    # infinite maxima (e.g. relative to a zero) are undefined
+    if np.isinf(max_abs):
+        max_abs = None
+    if np.isinf(max_rel):
+        max_rel = None
+    full_shape = (len(fr),) + shape[1:]
+    size = int(np.prod(full_shape))
+    return {'arraydiff': {
+                'count': count,
+                'size': size,
+                'max_abs': max_abs,
+                'max_rel': max_rel,
+                'top': [(tuple(int(i) for i in np.unravel_index(fi, full_shape))
+                            if len(full_shape) > 1 else int(fi),
+                         float(f), float(t))
+                            for _, fi, f, t in top]},
+            '%%magic%%': 'diff'}
+
 def diff(fr, to, recursive_list=False, min_abs_numdiff=None,
-         min_rel_numdiff=None):
+         min_rel_numdiff=None, max_edit_distance=None):
     """Build a difference tree from two container objects
 
-    Most commonly such objects will be SPECs or components thereof.
+    Most commonly such objects will be SPECs or components thereof. Parts of
+    SPECs loaded from JSON are only compared if their hashes (see
+    ``SPEC.get_hash()``) differ.
 
     Parameters
     ----------
@@ -174,13 +563,32 @@ def diff(fr, to, recursive_list=False, min_abs_numdiff=None,
       Analog to ``min_abs_numdiff``, but differences will evaluated relative to
       the corresponding ``fr`` value. Specifying 0.1 here, would cause any
       numerical difference to be ignored that is not at least 10% of the
-      corresponding numerical value in the first SPEC.
+      corresponding numerical value in the first SPEC. If both thresholds are
+      given, they add up to a single tolerance (as in ``numpy.isclose()``).
+    max_edit_distance: int or None
+      Maximum number of insertions and deletions with which shifted
+      sequences are aligned, see ``seqdiff.get_opcodes()``. Regions that
+      need more are reported as replaced as a whole. If None, the default
+      of the ``seqdiff`` module is used.
+
+    Numerical arrays (lists of equal length with numerical, possibly nested,
+    values) are compared element-wise in chunks, with the thresholds applied
+    to each element. Their difference is summarized in an 'arraydiff'
+    record: the number of elements that differ ('count') out of all
+    elements ('size'), the maximum absolute and relative difference of those
+    ('max_abs', 'max_rel'), and the index, 'from', and 'to' value of the
+    largest differences ('top'). A maximum is None if it is infinite, e.g.
+    the relative difference to a zero.
     """
-    if not type(fr) == type(to):
+    if not _get_kind(fr) == _get_kind(to):
         # different type
         return {'from': fr, 'to': to, '%%magic%%': 'diff'}
     elif fr is None and to is None:
         return None
+    elif isinstance(fr, _HashedContainer) and isinstance(to, _HashedContainer) \
+         and _get_tree_hash(fr)[0] == _get_tree_hash(to)[0]:
+        # identical subtrees
+        return None
     elif isinstance(fr, dict):
         dtree = {}
         # a dict
@@ -188,16 +596,17 @@ def diff(fr, to, recursive_list=False, min_abs_numdiff=None,
         to_keys = set(to.keys())
         # keys in fr but not in to
         for missing in fr_keys - to_keys:
-            dtree[missing] = {'from': fr, '%%magic%%': 'diff'}
+            dtree[missing] = {'from': fr[missing], '%%magic%%': 'diff'}
         # keys in to but not in fr
         for missing in to_keys - fr_keys:
-            dtree[missing] = {'to': to, '%%magic%%': 'diff'}
+            dtree[missing] = {'to': to[missing], '%%magic%%': 'diff'}
         # compare intersecting keys
         for key in fr_keys.intersection(to_keys):
             value_diff = diff(fr[key], to[key],
                               recursive_list=recursive_list,
                               min_abs_numdiff=min_abs_numdiff,
-                              min_rel_numdiff=min_rel_numdiff)
+                              min_rel_numdiff=min_rel_numdiff,
+                              max_edit_distance=max_edit_distance)
             if not value_diff is None:
                 dtree[key] = value_diff
         if len(dtree):
@@ -213,53 +622,19 @@ def diff(fr, to, recursive_list=False, min_abs_numdiff=None,
         else:
             return None
     elif isinstance(fr, float) or isinstance(fr, int):
-        numdiff = to - fr
-        if numdiff and \
-           (
-               (    min_abs_numdiff is None and
-                    min_rel_numdiff is None) \
-            or (not min_abs_numdiff is None and
-                    min_rel_numdiff is None and
-                    abs(numdiff) >= min_abs_numdiff) \
-            or (    min_abs_numdiff is None and
-                not min_rel_numdiff is None and
-                    (fr == 0 or abs(float(numdiff)/fr) >= min_rel_numdiff))):
-            return {'numdiff': numdiff, '%%magic%%': 'diff'}
+        if _exceeds_tolerance(fr, to, min_abs_numdiff, min_rel_numdiff):
+            return {'numdiff': to - fr, '%%magic%%': 'diff'}
         else:
             return None
     elif isinstance(fr, list):
         if isinstance(to, list) and len(fr) == len(to) and len(fr) > 0:
             # two sequences of the same length: maybe two numerical arrays?
-            try:
-                # if we have numpy, try converting it into an array and attempt 
-                # to compute an element-wise difference
-                import numpy as np
-                arr_fr = np.array(fr)
-                arr_to = np.array(to)
-                numdiff = arr_to - arr_fr
-                absnumdiff = np.abs(numdiff)
-                absmaxdiff = float(absnumdiff.max())
-                fr_base = arr_fr.ravel()[absnumdiff.argmax()]
-                if absmaxdiff > 0 and \
-                   (
-                       (min_abs_numdiff is None and
-                        min_rel_numdiff is None) \
-                    or (not min_abs_numdiff is None and
-                            min_rel_numdiff is None and
-                            absmaxdiff >= min_abs_numdiff) \
-                    or (    min_abs_numdiff is None and
-                        not min_rel_numdiff is None and
-                            (fr_base == 0 or absmaxdiff / fr_base) >= min_rel_numdiff)):
-                    return {'numdiff': numdiff, '%%magic%%': 'diff'}
-                return None
-            except ImportError:
-                # silently fail and do a non-array diff
-                pass
-            except TypeError:
-                # probably not an array with numeric values
-                pass
+            arraydiff = _diff_arrays(fr, to, min_abs_numdiff, min_rel_numdiff)
+            if not arraydiff is False:
+                return arraydiff
         try:
-            seqmatch = difflib.SequenceMatcher(None, fr, to).get_opcodes()
+            seqmatch = get_opcodes(fr, to,
+                                   max_edit_distance=max_edit_distance)
         except TypeError:
             raise NotImplementedError(
                 "comparing sequences with unhashable values is not supported")
@@ -293,7 +668,8 @@ def diff(fr, to, recursive_list=False, min_abs_numdiff=None,
                         out.append(diff(fr[i], to[i],
                                         recursive_list=recursive_list,
                                         min_abs_numdiff=min_abs_numdiff,
-                                        min_rel_numdiff=min_rel_numdiff))
+                                        min_rel_numdiff=min_rel_numdiff,
+                                        max_edit_distance=max_edit_distance))
                 else:
                     # all other conditions should be caught by top-level IF
                     raise RuntimeError('impossible opcode in sequence match')
@@ -303,4 +679,88 @@ def diff(fr, to, recursive_list=False, min_abs_numdiff=None,
             return {'seqmatch': seqmatch, '%%magic%%': 'diff'}
     raise RuntimeError('unhandled condition is SPEC diff')
 
+def _iter_difftree(dtree, fr, to, path):
+    # the records of a difference tree built by diff()
+    if isinstance(dtree, dict) and dtree.get('%%magic%%', None) == 'diff':
+        yield path, dtree, fr, to
+    elif isinstance(dtree, dict):
+        for key in sorted(dtree):
+            for record in _iter_difftree(dtree[key], fr.get(key, None),
+                                         to.get(key, None), path + (key,)):
+                yield record
+    elif isinstance(dtree, list):
+        for i, value in enumerate(dtree):
+            if value is fr[i]:
+                # unchanged element of a recursively compared list
+                continue
+            for record in _iter_difftree(value, fr[i], to[i], path + (i,)):
+                yield record
+
+def iter_diff(fr, to, recursive_list=False, min_abs_numdiff=None,
+              min_rel_numdiff=None, max_edit_distance=None, prune=None,
+              _path=()):
+    """Generate the differences between two container objects one by one
+
+    Compares like ``diff()``, but instead of building a difference tree,
+    dictionaries are walked in order of their keys, and each difference is
+    yielded as soon as it is found. Values that are not dictionaries are
+    compared with ``diff()``.
+
+    Parameters
+    ----------
+    fr: dict or list or tuple or float or int or str or None
+      "from" input into the diff algorithm.
+    to: dict or list or tuple or float or int or str or None
+      "to" input into the diff algorithm.
+    recursive_list: bool
+    min_abs_numdiff: float or None
+      See ``diff()``.
+    min_rel_numdiff: float or None
+      See ``diff()``.
+    max_edit_distance: int or None
+      See ``diff()``.
+    prune: callable or None
+      If not None, this is called with the location (see below) of every
+      dictionary value before it is compared. If it returns True, the value
+      and all its elements are skipped.
 
+    Returns
+    -------
+    generator
+      Tuples of location, difference record (as in a difference tree), and
+      the "from" and "to" value at this location. A location is a tuple of
+      dictionary keys and list indices, a missing value is None.
+    """
+    if len(_path) and not prune is None and prune(_path):
+        return
+    if not (isinstance(fr, dict) and _get_kind(fr) == _get_kind(to)):
+        for record in _iter_difftree(
+                diff(fr, to, recursive_list=recursive_list,
+                     min_abs_numdiff=min_abs_numdiff,
+                     min_rel_numdiff=min_rel_numdiff,
+                     max_edit_distance=max_edit_distance),
+                fr, to, _path):
+            yield record
+        return
+    if isinstance(fr, _HashedContainer) and isinstance(to, _HashedContainer) \
+       and _get_tree_hash(fr)[0] == _get_tree_hash(to)[0]:
+        # identical subtrees
+        return
+    for key in sorted(set(fr.keys()).union(to.keys())):
+        path = _path + (key,)
+        if not key in to:
+            if prune is None or not prune(path):
+                yield path, {'from': fr[key], '%%magic%%': 'diff'}, \
+                      fr[key], None
+        elif not key in fr:
+            if prune is None or not prune(path):
+                yield path, {'to': to[key], '%%magic%%': 'diff'}, \
+                      None, to[key]
+        else:
+            for record in iter_diff(fr[key], to[key],
+                                    recursive_list=recursive_list,
+                                    min_abs_numdiff=min_abs_numdiff,
+                                    min_rel_numdiff=min_rel_numdiff,
+                                    max_edit_distance=max_edit_distance,
+                                    prune=prune, _path=path):
+                yield record
@@ -0,0 +1,201 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the testkraut package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Persistent index of the test SPECs in test libraries
+
+Discovering tests requires loading and validating every SPEC file in all
+test libraries. An SQLite database records path, size, modification time,
+inode, SHA1 hash, and test ID of every SPEC file. Entries are revalidated by
+comparing the recorded state with ``stat()`` results, and SPEC files are only
+loaded again when they changed.
+"""
+
+__docformat__ = 'restructuredtext'
+
+import os
+import stat
+import sqlite3
+import threading
+from hashlib import sha1 as _sha1
+from os.path import join as opj
+
+from .spec import SPEC
+from .utils import get_specindex_filename
+
+import logging
+lgr = logging.getLogger(__name__)
+
+# indices of the current process, per thread
+_indices = {}
+
+def get_spec_index():
+    """Return the SPEC index of the current process and thread"""
+    # database connections cannot be shared across threads
+    key = (os.getpid(), threading.current_thread().ident)
+    if not key in _indices:
+        _indices[key] = SpecIndex()
+    return _indices[key]
+
+def _get_state(path):
+    # size, mtime, and inode of a regular file, or None
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    return (st.st_size, st.st_mtime, st.st_ino)
+
+
+class SpecIndex(object):
+    """Index of test ID, path, size, mtime, inode, and sha1sum of all SPECs
+
+    A test library contains SPECs as ``spec.json`` files in subdirectories
+    (named after the test), and as plain JSON files.
+
+    Parameters
+    ----------
+    dbfilename : path or None
+      Location of the index database. By default, the configured location
+      is used. If it cannot be used, the index is kept in memory.
+    """
+    def __init__(self, dbfilename=None):
+        if dbfilename is None:
+            dbfilename = get_specindex_filename()
+        try:
+            dirname = os.path.dirname(dbfilename)
+            if len(dirname) and not os.path.exists(dirname):
+                os.makedirs(dirname)
+            self._db = sqlite3.connect(dbfilename, timeout=60)
+            self._create_tables()
+        except (OSError, sqlite3.Error) as e:
+            lgr.debug("cannot use SPEC index at '%s', using a temporary one "
+                      "(%s)" % (dbfilename, str(e)))
+            self._db = sqlite3.connect(':memory:')
+            self._create_tables()
+
+    def _create_tables(self):
+        # paths are byte strings
+        self._db.text_factory = str
+        with self._db:
+            # 'name' is the name of a test's subdirectory, 'error' the reason
+            # why a file is not a valid SPEC
+            self._db.execute("CREATE TABLE IF NOT EXISTS specs "
+                             "(path TEXT PRIMARY KEY, library TEXT, "
+                             "name TEXT, id TEXT, size INTEGER, mtime REAL, "
+                             "inode INTEGER, sha1 TEXT, error TEXT)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS specs_library "
+                             "ON specs (library)")
+
+    def _get_candidates(self, library):
+        # (path, name) of all potential SPEC files in a library
+        cands = []
+        for fname in sorted(os.listdir(library)):
+            path = opj(library, fname)
+            if os.path.isdir(path):
+                cands.append((opj(path, 'spec.json'), fname))
+            elif fname.endswith('.json'):
+                cands.append((path, None))
+        return cands
+
+    def _index(self, path, library, name, state):
+        # (re-)load a SPEC file
+        content = open(path, 'rb').read()
+        try:
+            spec_id, error = SPEC(content)['id'], None
+        # swallow everything, a broken SPEC must not break the discovery of
+        # all others
+        except Exception as e:
+            spec_id, error = None, '%s (%s)' % (str(e), e.__class__.__name__)
+        with self._db:
+            self._db.execute("INSERT OR REPLACE INTO specs VALUES "
+                             "(?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                             (path, library, name, spec_id) + state
+                                + (_sha1(content).hexdigest(), error))
+        return spec_id, error
+
+    def refresh(self, libraries):
+        """Bring the index in sync with test libraries
+
+        Only SPEC files that were added, or whose size, modification time or
+        inode changed are (re-)loaded.
+
+        Parameters
+        ----------
+        libraries : sequence
+          Paths of test library directories.
+
+        Returns
+        -------
+        list
+          (path, test ID, error) of all SPEC files in the given libraries, in
+          library order. For files that are not valid SPECs the ID is None
+          and the error is a description of the problem.
+        """
+        specs = []
+        for library in libraries:
+            library = os.path.abspath(library)
+            known = dict([(row[0], tuple(row[1:])) for row in self._db.execute(
+                            "SELECT path, size, mtime, inode, id, error "
+                            "FROM specs WHERE library=?", (library,))])
+            nupdated = 0
+            for path, name in self._get_candidates(library):
+                state = _get_state(path)
+                if state is None:
+                    lgr.debug("ignoring '%s' in library path '%s': contains "
+                              "no SPEC file" % (name, library))
+                    continue
+                entry = known.pop(path, None)
+                if entry is None or entry[:3] != state:
+                    spec_id, error = self._index(path, library, name, state)
+                    nupdated += 1
+                else:
+                    spec_id, error = entry[3:]
+                specs.append((path, spec_id, error))
+            # whatever is left is gone
+            with self._db:
+                self._db.executemany("DELETE FROM specs WHERE path=?",
+                                     [(p,) for p in known])
+            lgr.debug("refreshed SPEC index of '%s' (%i updated, %i removed)"
+                      % (library, nupdated, len(known)))
+        return specs
+
+    def find(self, spec_def, libraries):
+        """Return the path of a SPEC file in any test library, or None
+
+        The index is refreshed only if no up-to-date entry is found.
+
+        Parameters
+        ----------
+        spec_def : str
+          Name of a test's subdirectory in a library, or a test ID. Earlier
+          libraries take precedence, and within a library, subdirectory
+          names take precedence over IDs. A subdirectory name also matches
+          if its SPEC is not valid.
+        libraries : sequence
+          Paths of test library directories.
+        """
+        libraries = [os.path.abspath(l) for l in libraries]
+        for refresh in (False, True):
+            if refresh:
+                self.refresh(libraries)
+            for library in libraries:
+                for row in self._db.execute(
+                        "SELECT path, size, mtime, inode FROM specs "
+                        "WHERE library=? AND (name=? OR id=?) "
+                        "ORDER BY name=? DESC, path",
+                        (library, spec_def, spec_def, spec_def)).fetchall():
+                    if _get_state(row[0]) == tuple(row[1:]):
+                        return row[0]
+        return None
+
+    def get_sha1(self, path):
+        """Return the recorded SHA1 hash of an indexed SPEC file, or None"""
+        row = self._db.execute("SELECT sha1 FROM specs WHERE path=?",
+                               (os.path.abspath(path),)).fetchone()
+        return None if row is None else row[0]
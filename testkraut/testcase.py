@@ -12,9 +12,10 @@ __docformat__ = 'restructuredtext'
 
 import os
 import re
+import time
 from os.path import join as opj
 from json import dumps as jds
-from functools import wraps
+from functools import wraps, partial
 
 from six import string_types, iteritems, text_type
 
@@ -44,12 +45,34 @@ import testtools.matchers as tt_matchers
 from . import matchers as tk_matchers
 
 from .utils import get_test_library_paths, describe_system, describe_binary, \
-        run_command, which, describe_python_module, _resolve_metric_value
+        run_command, which, describe_python_module, _resolve_metric_value, \
+        sha1sum, get_process_budget, get_workflowcache_dir
 from .spec import SPEC, SPECJSONEncoder
+from .execution import ExecutionContext, summarize_output, \
+        wait_for_process, record_resource_usage, get_limits, get_preexec_fn, \
+        identify_limit_violation, run_forked, ProcessGroupTimeout, \
+        exec_python_code, get_zygote, match_output_file
+from .runcache import get_run_key, load_run, store_run
+from .specindex import get_spec_index
 from .fingerprints import get_fingerprinters, proc_fingerprint
 from testkraut import cfg
 from . import metrics
 
+# details of a passing test run that are stored in the run cache
+_cached_run_details = ('exec_info', 'metric_info', 'output_info')
+
+def _get_input_hashes(inputs, ctx):
+    # sha1sums of all test inputs in a testbed
+    hashes = {}
+    for inid, inspec in iteritems(inputs):
+        if 'sha1sum' in inspec:
+            # inputs are verified against a recorded sha1sum when placed into
+            # the testbed
+            hashes[inid] = inspec['sha1sum']
+        else:
+            hashes[inid] = sha1sum(ctx.abspath(inspec['value']))
+    return hashes
+
 #
 # Utility code for template-based test cases
 #
@@ -107,44 +130,28 @@ class TemplateTestCase(type):
 
 def discover_specs(paths=None):
     """Helper function to discover test SPECs in configured library locations
+
+    SPEC files are looked up in the SPEC index (see ``specindex``), hence
+    only new or modified SPEC files are loaded.
     """
     discovered = {}
     # for all configured test library locations
     if paths is None:
         paths = get_test_library_paths()
-    cands = []
-    for tld in paths:
-        # look for 'spec.json' in all subdirs
-        cands.extend([opj(tld, d, 'spec.json')
-                        for d in os.listdir(tld)
-                            if os.path.isdir(opj(tld, d))])
-        # and all plain JSON files
-        cands.extend([opj(tld, d)
-                        for d in os.listdir(tld)
-                            if d.endswith('.json')])
-    for spec_fname in cands:
-        if not os.path.isfile(spec_fname):
-            # not a test spec
-            lgr.debug("ignoring '%s' directory in library path '%s': contains no SPEC file"
-                      % (subdir, tld))
-            continue
-        try:
-            spec = SPEC(open(spec_fname))
-            spec_id = spec['id'].replace('-', '_')
-            if spec_id in discovered:
-                lgr.warning("found duplicate test ID '%s' in %s: ignoring the latter test"
-                            % (spec_id, (discovered[spec_id], spec_fname)))
-                continue
-            # we actually found a new one
-            lgr.debug("discovered test SPEC '%s'" % spec_id)
-            discovered[spec_id] = spec_fname
-        # TODO: provide configuration variable allowing to avoid this
-        # swallow-everything catcher to troubleshoot problems in the code
-        # inside
-        except Exception as e:
+    for spec_fname, spec_id, error in get_spec_index().refresh(paths):
+        if not error is None:
             # not a valid SPEC
-            lgr.warning("ignoring '%s': no a valid SPEC file: %s (%s)"
-                      % (spec_fname, str(e), e.__class__.__name__))
+            lgr.warning("ignoring '%s': no a valid SPEC file: %s"
+                        % (spec_fname, error))
+            continue
+        spec_id = spec_id.replace('-', '_')
+        if spec_id in discovered:
+            lgr.warning("found duplicate test ID '%s' in %s: ignoring the latter test"
+                        % (spec_id, (discovered[spec_id], spec_fname)))
+            continue
+        # we actually found a new one
+        lgr.debug("discovered test SPEC '%s'" % spec_id)
+        discovered[spec_id] = spec_fname
     # wrap spec file locations in TestArgs
     return dict([(k, TestArgs(v)) for k, v in iteritems(discovered)])
 
@@ -159,10 +166,22 @@ class TestFromSPEC(TestCase):
     # ascending order
     search_dirs = []
 
+    # whether to reuse the results of a previous passing run of an unchanged
+    # SPEC (see the 'reuse results' setting in the 'testrun' section)
+    reuse_results = True
+
+    # maximum number of processes a test may use for parallel execution. If
+    # None, the configured process budget is used
+    process_budget = None
+
+    # Prefetcher that might have prepared the testbed already
+    prefetcher = None
+
     def __init__(self, *args, **kwargs):
         TestCase.__init__(self, *args, **kwargs)
         self._workdir = None
-        self._environ_restore = None
+        # environment and working directory for the test execution
+        self._ctx = None
 
 # derived classes should have this
 #    @template_case(discover_specs())
@@ -183,37 +202,74 @@ class TestFromSPEC(TestCase):
         # fingerprints
         fingerprints = {}
         self._details['output_info'] = fingerprints
+        # prepare the testbed, place test input into testbed
+        from .lookup import prepare_local_testbed, get_shared_files_state, \
+                get_modified_shared_files
+        inputs = None
+        if not self.prefetcher is None:
+            # claimed before anything can skip or fail the test, a testbed
+            # left with the prefetcher would take its room
+            inputs = self.prefetcher.claim(spec_filename, wdir)
         # get the environment in shape, accoridng to SPEC
         env_info.update(self._prepare_environment(spec))
-        # prepare the testbed, place test input into testbed
-        from .lookup import prepare_local_testbed
-        prepare_local_testbed(
+        if inputs is None:
+            inputs = prepare_local_testbed(
                 spec, wdir,
                 search_dirs=[os.path.dirname(spec_filename)] + self.search_dirs,
                 cache=None, force_overwrite=True)
+        # inputs that are linked into the testbed must not be modified
+        shared_inputs = get_shared_files_state(inputs)
         # final test: do we have all dependencies
         # NEEDS to be done after testbed setup, in case custom scripts are
         # listed
         self._verify_dependencies(spec)
+        # reuse the results of a previous passing run, if nothing changed
+        run_key = self._get_run_key(spec)
+        if not run_key is None:
+            cached = load_run(run_key)
+            self._details['cache_info'] = dict(run_key=run_key,
+                                               reused=not cached is None)
+            if not cached is None:
+                lgr.info("reuse results of a previous run of '%s'" % spec_id)
+                self._details.update(cached)
+                return
         for idx, testspec in enumerate(spec['tests']):
-            os.environ['TESTKRAUT_SUBTEST_IDX'] = str(idx)
+            self._ctx.env['TESTKRAUT_SUBTEST_IDX'] = str(idx)
             if not 'id' in testspec:
                 subtestid = str(idx)
             else:
                 subtestid = testspec['id']
             # execute the actual test implementation
             self._execute_any_test_implementation(subtestid, testspec)
-            del os.environ['TESTKRAUT_SUBTEST_IDX']
+            del self._ctx.env['TESTKRAUT_SUBTEST_IDX']
+        self.assertThat(get_modified_shared_files(shared_inputs),
+            Annotate("test modified input files that are shared with their "
+                     "origin (consider 'copy' or 'reflink' staging)",
+                     Equals([])))
         # check for expected output
-        initial_cwd = os.getcwdu()
-        os.chdir(self._workdir)
-        try:
-            self._check_output_presence(spec)
-            self._compute_metrics(spec, metric_info)
-            self._fingerprint_output(spec, fingerprints)
-            self._check_assertions(spec, metric_info)
-        finally:
-            os.chdir(initial_cwd)
+        self._check_output_presence(spec)
+        self._compute_metrics(spec, metric_info)
+        self._fingerprint_output(spec, fingerprints)
+        self._check_assertions(spec, metric_info, self._details['exec_info'])
+        # all good
+        if not run_key is None:
+            store_run(run_key, dict([(d, self._details[d])
+                                        for d in _cached_run_details]))
+
+    def _get_run_key(self, spec):
+        # key of a test run in the run cache, or None if the cache is not
+        # to be used
+        if not self.reuse_results \
+           or not cfg.getboolean('testrun', 'reuse results', default=True) \
+           or cfg.getboolean('testrun', 'skip dependency description',
+                             default=False):
+            return None
+        # dependency info is reported in any case, hence gather it now
+        self._get_dep_info()
+        input_hashes = _get_input_hashes(spec.get('inputs', {}), self._ctx)
+        return get_run_key(spec.get_hash(), input_hashes,
+                           self._details['dep_info'].keys(),
+                           self._details['env_info'])
 
     def setUp(self):
         """Runs prior each test run"""
@@ -228,15 +284,17 @@ class TestFromSPEC(TestCase):
         assert(self._workdir is None)
         self._workdir = tempfile.mkdtemp(prefix='testkraut')
         lgr.debug("created work dir at '%s'" % self._workdir)
+        self._ctx = ExecutionContext(cwd=self._workdir)
         # post testbed path into the environment
-        os.environ['TESTKRAUT_TESTBED_PATH'] = self._workdir
+        self._ctx.env['TESTKRAUT_TESTBED_PATH'] = self._workdir
 
     def tearDown(self):
         """Runs after each test run"""
         super(TestFromSPEC, self).tearDown()
         ct = ContentType('application', 'json')
         # information on test dependencies mentioned in the SPEC
-        self._get_dep_info()
+        if not 'dep_info' in self._details:
+            self._get_dep_info()
         # configure default set of information to be reported for any test run
         # still can figure out why this can't be a loop
         self.addDetail('spec_info',
@@ -253,11 +311,11 @@ class TestFromSPEC(TestCase):
                 Content(ct, lambda: [self._jds(self._details['output_info'])]))
         self.addDetail('sys_info',
                 Content(ct, lambda: [self._jds(self._get_system_info())]))
-        # restore environment to its previous state
-        self._restore_environment()
+        if 'cache_info' in self._details:
+            self.addDetail('cache_info',
+                    Content(ct, lambda: [self._jds(self._details['cache_info'])]))
         # after EVERYTHING is done
-        # remove status var again
-        del os.environ['TESTKRAUT_TESTBED_PATH']
+        self._ctx = None
         # wipe out testbed
         if not self._workdir is None:
             lgr.debug("remove work dir at '%s'" % self._workdir)
@@ -275,52 +333,88 @@ class TestFromSPEC(TestCase):
             raise ValueError("unsupported test type '%s'" % type_)
         lgr.info("run test '%s' via %s()"
                  % (testid, test_exec.__name__))
-        # move into testbed
-        initial_cwd = os.getcwdu()
-        os.chdir(self._workdir)
-        # run the test
-        try:
-            self._details['exec_info'][testid] = dict(
-                    type=testspec['type']
-                )
-            ret = test_exec(testid, testspec)
-        finally:
-            os.chdir(initial_cwd)
+        # run the test (in the testbed)
+        self._details['exec_info'][testid] = dict(
+                type=testspec['type']
+            )
+        test_exec(testid, testspec)
 
     def _execute_python_test(self, testid, testspec):
+        run_code = partial(exec_python_code, testspec.get('code', None),
+                           testspec.get('file', None))
+        zygote = None
+        if cfg.getboolean('testrun', 'isolate python tests', default=True):
+            zygote = get_zygote()
+        exception = self._run_python_code(testid, testspec, run_code,
+                                          zygote=zygote)
+        if not exception is None:
+            if not 'shouldfail' in testspec or testspec['shouldfail'] == False:
+                lgr.error("%s: %s" % (exception['type'], exception['info']))
+                self.assertThat(exception,
+                    Annotate("exception occured while executing Python test code in test '%s': %s (%s)"
+                             % (testid, exception['info'], exception['type']),
+                             Equals(None)))
+            return
+        if 'shouldfail' in testspec and testspec['shouldfail'] == True:
+            self.fail("an expected failure did not occur in test '%s'" % testid)
+
+    def _run_python_code(self, testid, testspec, func, zygote=None):
+        # execute Python code in a child process forked from a zygote, or
+        # from this process if the test declares any limits, or in-process
+        # otherwise. Returns info on a raised exception, or None
+        execinfo = self._details['exec_info'][testid]
+        limits = get_limits(testspec)
+        timeout = testspec.get('timeout', None)
+        if not zygote is None or len(limits) or not timeout is None:
+            if zygote is None and not self.prefetcher is None:
+                # never fork this process while the prefetch thread runs
+                zygote = get_zygote()
+            spool = dict([(chan, self._get_output_spool_filename(testid, chan))
+                            for chan in ('stderr', 'stdout')])
+            exception, returncode, resources, timed_out = \
+                    (run_forked if zygote is None else zygote.run_forked)(
+                        func, self._ctx, spool['stdout'], spool['stderr'],
+                        limits=limits, timeout=timeout)
+            execinfo['resources'] = resources
+            execinfo['exitcode'] = returncode
+            self._store_output_summary(execinfo, spool)
+            violation = identify_limit_violation(
+                    limits, timeout, returncode, resources,
+                    timed_out=timed_out, exception=exception,
+                    stderr=spool['stderr'])
+            if not violation is None:
+                execinfo['limit_violation'] = violation
+                exception = dict(type='LimitViolation',
+                                 info="exceeded %s limit" % violation)
+            elif exception is None and returncode != 0:
+                exception = dict(type='ChildProcessError',
+                                 info="test process terminated with exit code %i"
+                                      % returncode)
+            if not exception is None:
+                execinfo['exception'] = exception
+            return exception
         from cStringIO import StringIO
         import sys
-        execinfo = self._details['exec_info'][testid]
         try:
             rescue_stdout = sys.stdout
             rescue_stderr = sys.stderr
             sys.stdout = capture_stdout = StringIO()
             sys.stderr = capture_stderr = StringIO()
             try:
-                if 'code' in testspec:
-                    exec(testspec['code'], {}, {})
-                elif 'file' in testspec:
-                    execfile(testspec['file'], {}, {})
-                else:
-                    raise ValueError("no test code found")
+                # in-process code relies on os.environ and relative paths
+                with self._ctx.activate(), \
+                     record_resource_usage(execinfo.setdefault('resources', {})):
+                    func()
             except Exception as e:
                 execinfo['exception'] = dict(type=e.__class__.__name__,
                                              info=str(e))
-                if not 'shouldfail' in testspec or testspec['shouldfail'] == False:
-                    lgr.error("%s: %s" % (e.__class__.__name__, str(e)))
-                    self.assertThat(e,
-                        Annotate("exception occured while executing Python test code in test '%s': %s (%s)"
-                                 % (testid, str(e), e.__class__.__name__), Equals(None)))
-                return
-            if 'shouldfail' in testspec and testspec['shouldfail'] == True:
-                self.assertThat(e,
-                    Annotate("an expected failure did not occur in test '%s': %s (%s)"
-                                 % (testid, str(e), e.__class__.__name__), Equals(None)))
+                return execinfo['exception']
         finally:
             execinfo['stdout'] = capture_stdout.getvalue()
             execinfo['stderr'] = capture_stderr.getvalue()
             sys.stdout = rescue_stdout
             sys.stderr = rescue_stderr
+        return None
 
     def _execute_shell_test(self, testid, testspec):
         import subprocess
@@ -330,24 +424,46 @@ class TestFromSPEC(TestCase):
             # convert into a cmd string to execute via shell
             # to get all envvar expansion ...
             cmd = subprocess.list2cmdline(cmd)
+        # output is streamed into spool files in the testbed
+        spool = dict([(chan, self._get_output_spool_filename(testid, chan))
+                        for chan in ('stderr', 'stdout')])
+        limits = get_limits(testspec)
+        timeout = testspec.get('timeout', None)
         # for the rest we need to execute stuff in the root of the testbed
         try:
             lgr.debug("attempting to execute command '%s'" % cmd)
-            texec = subprocess.Popen(cmd,
-                                    stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE,
-                                    shell=True)
-            texec.wait()
+            start_time = time.time()
+            with open(spool['stdout'], 'wb') as stdout, \
+                 open(spool['stderr'], 'wb') as stderr:
+                texec = self._ctx.popen(cmd,
+                                        stdout=stdout,
+                                        stderr=stderr,
+                                        shell=True,
+                                        preexec_fn=get_preexec_fn(limits))
+                timer = ProcessGroupTimeout(texec.pid, timeout)
+                try:
+                    _, resources = wait_for_process(texec)
+                finally:
+                    timer.cancel()
+            resources['wallclock'] = time.time() - start_time
+            execinfo['resources'] = resources
             # record the exit code
             execinfo['exitcode'] = texec.returncode
-            # store test output
-            for chan in ('stderr', 'stdout'):
-                execinfo[chan] = getattr(texec, chan).read()
-                #lgr.debug('%s: %s' % (chan, execinfo[chan]))
+            # store a summary of the test output
+            self._store_output_summary(execinfo, spool)
+            violation = identify_limit_violation(
+                    limits, timeout, texec.returncode, resources,
+                    timed_out=timer.expired, stderr=spool['stderr'])
+            if not violation is None:
+                execinfo['limit_violation'] = violation
             if texec.returncode != 0 and 'shouldfail' in testspec \
                and testspec['shouldfail'] == True:
                    # failure is expected
                    return
+            self.assertThat(
+                violation,
+                Annotate("test shell command '%s' exceeded its %s limit"
+                         % (cmd, violation), Equals(None)))
             self.assertThat(
                 texec.returncode,
                 Annotate("test shell command '%s' yielded non-zero exit code" % cmd,
@@ -358,16 +474,29 @@ class TestFromSPEC(TestCase):
                 self.assertThat(e,
                     Annotate("test command execution failed: %s (%s)"
                              % (e.__class__.__name__, str(e)), Equals(None)))
+            return
         if 'shouldfail' in testspec and testspec['shouldfail'] == True:
-            self.assertThat(e,
-                Annotate("an expected failure did not occur in test '%s': %s (%s)"
-                             % (testid, str(e), e.__class__.__name__), Equals(None)))
+            self.fail("an expected failure did not occur in test '%s'" % testid)
+
+    def _store_output_summary(self, execinfo, spool):
+        preview_size = int(cfg.get('testrun', 'output preview size',
+                                   default='4096'))
+        for chan in ('stderr', 'stdout'):
+            summary = summarize_output(spool[chan], preview_size)
+            execinfo[chan] = summary['preview']
+            execinfo['%s_bytes' % chan] = summary['bytes']
+            execinfo['%s_sha1sum' % chan] = summary['sha1sum']
+            execinfo['%s_file' % chan] = os.path.relpath(spool[chan],
+                                                         self._workdir)
+
+    def _get_output_spool_filename(self, testid, channel):
+        spool_dir = opj(self._workdir, '.testkraut', 'output')
+        if not os.path.exists(spool_dir):
+            os.makedirs(spool_dir)
+        return opj(spool_dir, '%s.%s' % (re.sub(r'[^\w.-]', '_', testid),
+                                         channel))
 
     def _execute_nipype_test(self, testid, testspec):
-        # TODO merge/refactor this one with the plain python code method
-        from cStringIO import StringIO
-        import sys
-        execinfo = self._details['exec_info'][testid]
         try:
             import nipype
         except ImportError:
@@ -382,7 +511,8 @@ class TestFromSPEC(TestCase):
         # execute the script and extract the workflow
         locals = dict()
         try:
-            execfile(testwffilepath, dict(), locals)
+            with self._ctx.activate():
+                execfile(testwffilepath, dict(), locals)
         except Exception as e:
             lgr.error("%s: %s" % (e.__class__.__name__, str(e)))
             self.assertThat(e,
@@ -393,49 +523,62 @@ class TestFromSPEC(TestCase):
                      Contains('test_workflow')))
         workflow = locals['test_workflow']
         # make sure nipype executes it in the right place
-        workflow.base_dir=os.path.abspath(opj(os.curdir, '_workflow_exec'))
+        exec_dir = opj(self._ctx.cwd, '_workflow_exec')
+        if testspec.get('persistent_exec_dir', False):
+            # keep results across test runs, nipype only recomputes nodes
+            # with changed inputs
+            persistent_dir = opj(get_workflowcache_dir(),
+                                 self._cur_spec.get_hash(),
+                                 re.sub(r'[^\w.-]', '_', testid))
+            if not os.path.exists(persistent_dir):
+                os.makedirs(persistent_dir)
+            lgr.debug("using persistent workflow execution directory '%s'"
+                      % persistent_dir)
+            os.symlink(persistent_dir, exec_dir)
+        workflow.base_dir = exec_dir
         # we want content, not time based hashing
         if 'execution' in workflow.config:
             workflow.config['execution']['hash_method'] = "content"
         else:
             workflow.config['execution'] = dict(hash_method="content")
-        # execution
-        try:
-            rescue_stdout = sys.stdout
-            rescue_stderr = sys.stderr
-            sys.stdout = capture_stdout = StringIO()
-            sys.stderr = capture_stderr = StringIO()
+        run_args = self._get_nipype_run_args(testspec)
+        self._details['exec_info'][testid].update(run_args)
+        def run_workflow():
+            exec_graph = workflow.run(**run_args)
+            # try dumping provenance info
             try:
-                exec_graph = workflow.run()
-            except Exception as e:
-                execinfo['exception'] = dict(type=e.__class__.__name__,
-                                             info=str(e))
-                if not 'shouldfail' in testspec or testspec['shouldfail'] == False:
-                    lgr.error("%s: %s" % (e.__class__.__name__, str(e)))
-                    self.assertThat(e,
-                        Annotate("exception occured while executing Nipype workflow in test '%s': %s (%s)"
-                                 % (testid, str(e), e.__class__.__name__),
-                                 Equals(None)))
-                return
-            if 'shouldfail' in testspec and testspec['shouldfail'] == True:
-                self.assertThat(e,
-                    Annotate("an expected failure did not occur in test '%s': %s (%s)"
-                                 % (testid, str(e), e.__class__.__name__),
-                                 Equals(None)))
-        finally:
-            execinfo['stdout'] = capture_stdout.getvalue()
-            execinfo['stderr'] = capture_stderr.getvalue()
-            sys.stdout = rescue_stdout
-            sys.stderr = rescue_stderr
-
-        # try dumping provenance info
-        try:
-            from nipype.pipeline.utils import write_prov
-            write_prov(exec_graph,
-                       filename=opj(workflow.base_dir, 'provenance.json'))
-        except ImportError:
-            lgr.debug("local nipype version doesn't support provenance capture")
-
+                from nipype.pipeline.utils import write_prov
+                write_prov(exec_graph,
+                           filename=opj(workflow.base_dir, 'provenance.json'))
+            except ImportError:
+                lgr.debug("local nipype version doesn't support provenance capture")
+        # execution
+        exception = self._run_python_code(testid, testspec, run_workflow)
+        if not exception is None:
+            if not 'shouldfail' in testspec or testspec['shouldfail'] == False:
+                lgr.error("%s: %s" % (exception['type'], exception['info']))
+                self.assertThat(exception,
+                    Annotate("exception occured while executing Nipype workflow in test '%s': %s (%s)"
+                             % (testid, exception['info'], exception['type']),
+                             Equals(None)))
+            return
+        if 'shouldfail' in testspec and testspec['shouldfail'] == True:
+            self.fail("an expected failure did not occur in test '%s'" % testid)
+
+    def _get_nipype_run_args(self, testspec):
+        # execution plugin selection, with the number of processes limited
+        # to the process budget of this test
+        if not 'plugin' in testspec:
+            return {}
+        plugin = testspec['plugin']
+        run_args = dict(plugin=plugin)
+        if plugin == 'MultiProc':
+            budget = self.process_budget
+            if budget is None:
+                budget = get_process_budget()
+            n_procs = min(int(testspec.get('n_procs', budget)), budget)
+            run_args['plugin_args'] = dict(n_procs=n_procs)
+        return run_args
 
     def _check_output_presence(self, spec):
         outspec = spec.get('outputs', {})
@@ -445,15 +588,23 @@ class TestFromSPEC(TestCase):
             ospectype = ospec['type']
             if ospectype == 'file':
                 self.assertThat(
-                    ospec['value'],
+                    self._ctx.abspath(ospec['value']),
                     Annotate('expected output file missing', FileExists()))
             elif ospectype == 'directory':
                 self.assertThat(
-                    ospec['value'],
+                    self._ctx.abspath(ospec['value']),
                     Annotate('expected output directory missing', DirExists()))
             elif ospectype == 'string' and ospec_id.startswith('tests'):
                 execinfo = self._details['exec_info']
                 sec, idx, field = ospec_id.split('::')
+                spool_filename = None
+                if '%s_file' % field in execinfo[idx]:
+                    # complete output is only available in the spool file,
+                    # which is checked without loading it
+                    spool_filename = self._ctx.abspath(
+                                        execinfo[idx]['%s_file' % field])
+                else:
+                    output = execinfo[idx][field]
                 for f, matcher in iteritems(__spec_matchers__):
                     if f in ospec:
                         # allow for multiple target values (given a matcher) being
@@ -466,8 +617,17 @@ class TestFromSPEC(TestCase):
                             # to have a general solution. It's now affecting string-type only.
                             # Additionally, "<NEWLINE>" may appear in some output intentionally,
                             # so let's find sth closer to be 'unique'.
+                            if not spool_filename is None:
+                                matched = match_output_file(spool_filename,
+                                                            f, target)
+                                self.assertThat(
+                                    matched,
+                                    Annotate("unexpected output for '%s' (%s %r)"
+                                             % (ospec_id, f, target),
+                                             Equals(True)))
+                                continue
                             self.assertThat(
-                                 execinfo[idx][field],
+                                 output,
                                  Annotate("unexpected output for '%s'" % ospec_id,
                                            matcher(target)))
             else:
@@ -491,17 +651,19 @@ class TestFromSPEC(TestCase):
                 continue
             # metric instance
             args = mspec.get('args', None)
-            if args is None:
-                val = metric()
-            elif isinstance(args, list):
-                val = metric(*args)
-            elif isinstance(args, dict):
-                val = metric(**args)
-            else:
-                val = metric(args)
+            # metrics may take file names relative to the testbed
+            with self._ctx.activate():
+                if args is None:
+                    val = metric()
+                elif isinstance(args, list):
+                    val = metric(*args)
+                elif isinstance(args, dict):
+                    val = metric(**args)
+                else:
+                    val = metric(args)
             info[mid] = val
 
-    def _check_assertions(self, spec, metric_info):
+    def _check_assertions(self, spec, metric_info, exec_info=None):
         specs = spec.get('assertions', {})
         for aid, aspec in iteritems(specs):
             lgr.debug("check assertion '%s'" % aid)
@@ -522,18 +684,21 @@ class TestFromSPEC(TestCase):
             if args is None:
                 assertion = matcher()
             elif isinstance(args, list):
-                assertion = matcher(*[_resolve_metric_value(v, metric_info)
+                assertion = matcher(*[_resolve_metric_value(v, metric_info,
+                                                            exec_info)
                                             for v in args])
             elif isinstance(args, dict):
                 assertion = matcher(
-                        **dict(
-                            zip([(k, _resolve_metric_value(v, metric_info))
-                                            for k, v in iteritems(args)])))
+                        **dict([(k, _resolve_metric_value(v, metric_info,
+                                                          exec_info))
+                                    for k, v in iteritems(args)]))
             else:
-                assertion = matcher(_resolve_metric_value(args, metric_info))
+                assertion = matcher(_resolve_metric_value(args, metric_info,
+                                                          exec_info))
             # value to match
             value = aspec['value']
-            self.assertThat(_resolve_metric_value(value, metric_info),
+            self.assertThat(_resolve_metric_value(value, metric_info,
+                                                  exec_info),
                             assertion)
             lgr.debug("verified assertion '%s'" % aid)
 
@@ -547,7 +712,8 @@ class TestFromSPEC(TestCase):
         for oname in sorted(ofilespecs.keys()):
             ospec = ofilespecs[oname]
             filename = ospec['value']
-            sha1 = sha1sum(filename)
+            filepath = self._ctx.abspath(filename)
+            sha1 = sha1sum(filepath)
             fingerprints = {}
             oinfo = {'type': 'file', 'name': filename, 'sha1sum': sha1,
                      'fingerprints': fingerprints}
@@ -565,7 +731,7 @@ class TestFromSPEC(TestCase):
                 fingerprinters = fingerprinters.union(get_fingerprinters(tag))
             # for the unique set of fingerprinting functions
             for fingerprinter in fingerprinters:
-                proc_fingerprint(fingerprinter, fingerprints, filename,
+                proc_fingerprint(fingerprinter, fingerprints, filepath,
                                  ospec.get('tags', []))
 
     def _get_system_info(self):
@@ -585,8 +751,8 @@ class TestFromSPEC(TestCase):
             loc = depspec['location']
             type_ = depspec['type']
             if type_ == 'executable':
-                if not (os.path.exists(os.path.expandvars(loc))
-                        or not which(loc) is None):
+                if not (os.path.exists(self._ctx.expandvars(loc))
+                        or not self._ctx.which(loc) is None):
                     self.skipTest("cannot find required executable '%s'" % loc)
             elif type_ == 'python_module':
                 try:
@@ -599,45 +765,30 @@ class TestFromSPEC(TestCase):
     def _prepare_environment(self, spec):
         # returns the relevant bits of the environment
         info = {}
-        self._environ_restore = {}
+        environ = self._ctx.env
         env_spec = spec.get('environment', {})
         for env in env_spec:
-            # store the current value
-            self._environ_restore[env] = os.environ.get(env, None)
             if env_spec[env] is None:
                 # unset if null
-                if env in os.environ:
-                    del os.environ[env]
+                if env in environ:
+                    del environ[env]
             elif isinstance(env_spec[env], string_types):
                 # set if string
                 # set the new one
-                os.environ[env] = str(env_spec[env])
+                environ[env] = str(env_spec[env])
             elif env_spec[env] is True:
                 # this variable is required to be present
                 if not cfg.getboolean('testrun', 'fail on missing environment',
                                       default=False) \
-                   and not env in os.environ:
+                   and not env in environ:
                     self.skipTest("required environment variable '%s' not set"
                                   % env)
                 else:
-                    self.assertThat(os.environ, Contains(env))
+                    self.assertThat(environ, Contains(env))
             # grab envvar values if anyhow listed
-            info[env] = os.environ.get(env, None)
-        if not len(self._environ_restore):
-            self._environ_restore = None
+            info[env] = environ.get(env, None)
         return info
 
-    def _restore_environment(self):
-        if self._environ_restore is None:
-            return
-        for env, val in iteritems(self._environ_restore):
-            if val is None:
-                if env in os.environ:
-                    del os.environ[env]
-            else:
-                os.environ[env] = str(val)
-        self._environ_restore = None
-
     def _get_dep_info(self):
         info = {}
         self._details['dep_info'] = info
@@ -653,7 +804,8 @@ class TestFromSPEC(TestCase):
             deploc = depspec['location']
             # TODO implement support for more dependency types
             if deptype == 'executable':
-                dephash = describe_binary(deptype, deploc, info)
+                dephash = describe_binary(deptype, deploc, info,
+                                          env=self._ctx.env)
             elif deptype == 'python_module':
                 from imp import find_module
                 try:
@@ -678,7 +830,7 @@ class TestFromSPEC(TestCase):
                 if isinstance(verfilename, list):
                     verfilename, extract_regex = verfilename
                 # expand the filename
-                verfilename = os.path.realpath(os.path.expandvars(verfilename))
+                verfilename = os.path.realpath(self._ctx.expandvars(verfilename))
                 try:
                     file_content = open(verfilename).read().strip()
                     version = re.findall(extract_regex, file_content)[0]
@@ -693,7 +845,7 @@ class TestFromSPEC(TestCase):
                 extract_regex = r'.*'
                 if isinstance(vercmd, list):
                     vercmd, extract_regex = vercmd
-                ret = run_command(vercmd)
+                ret = run_command(vercmd, cwd=self._ctx.cwd, env=self._ctx.env)
                 try:
                     # this will throw an exception if nothing is found
                     version = re.findall(extract_regex, '\n'.join(ret['stderr']))[0]
@@ -714,12 +866,27 @@ class TestFromSPEC(TestCase):
         return jds(content, indent=2, sort_keys=True, cls=SPECJSONEncoder)
 
 
-def generate_testkraut_tests(search_dirs_, discover_dirs_):
+def generate_testkraut_tests(search_dirs_, discover_dirs_, specs_=None):
+    """Build a test case class with one test per discovered SPEC
+
+    Parameters
+    ----------
+    search_dirs_ : list
+      Additional directories to search for test input files.
+    discover_dirs_ : list
+      Test library locations to discover SPECs in.
+    specs_ : dict or None
+      If not None, a mapping of test IDs to SPEC filenames wrapped in
+      ``TestArgs`` (as returned by ``discover_specs()``). No discovery
+      is performed in this case.
+    """
+    if specs_ is None:
+        specs_ = discover_specs(discover_dirs_)
 
     class TestKrautTests(TestFromSPEC):
         __metaclass__ = TemplateTestCase
         search_dirs = search_dirs_
-        @template_case(discover_specs(discover_dirs_))
+        @template_case(specs_)
         def _run_spec_test(self, spec_filename):
             return TestFromSPEC._run_spec_test(self, spec_filename)
 
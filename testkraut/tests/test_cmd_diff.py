@@ -0,0 +1,40 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the testkraut package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+""""""
+
+__docformat__ = 'restructuredtext'
+
+import sys
+import argparse
+from os.path import join as opj
+from six import StringIO
+from nose.tools import *
+from testkraut.cmdline import cmd_diff
+from .utils import with_tempdir
+
+def _run_diff(*args):
+    parser = argparse.ArgumentParser()
+    cmd_diff.setup_parser(parser)
+    out = StringIO()
+    stdout, sys.stdout = sys.stdout, out
+    try:
+        cmd_diff.run(parser.parse_args(args))
+    finally:
+        sys.stdout = stdout
+    return out.getvalue()
+
+@with_tempdir()
+def test_arraydiff_from_zero(wdir):
+    fr, to = opj(wdir, 'fr.json'), opj(wdir, 'to.json')
+    open(fr, 'w').write('{"id": "x", "tests": [], "metrics": [0.0, 1.0, 2.0]}')
+    open(to, 'w').write('{"id": "x", "tests": [], "metrics": [1.0, 1.0, 2.0]}')
+    out = _run_diff(fr, to)
+    # the relative difference to a zero is infinite
+    assert_true('1 of 3 values differ (max abs: 1, max rel: inf)' in out)
+    assert_true('@@ 0 @@' in out)
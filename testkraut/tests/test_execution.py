@@ -0,0 +1,171 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the testkraut package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+""""""
+
+__docformat__ = 'restructuredtext'
+
+import os
+import json
+import time
+import subprocess
+from nose.tools import *
+from testkraut.execution import ExecutionContext, run_forked, \
+        identify_limit_violation, Zygote, exec_python_code
+from .utils import with_tempdir
+
+@with_tempdir()
+def test_execution_context(wdir):
+    initial_cwd = os.getcwd()
+    ctx = ExecutionContext(cwd=wdir, env=dict(PATH=os.environ['PATH']))
+    ctx.env['TESTKRAUT_TESTVAR'] = 'some'
+    assert_false('TESTKRAUT_TESTVAR' in os.environ)
+    assert_equal(ctx.expandvars('$TESTKRAUT_TESTVAR/${TESTKRAUT_TESTVAR}/$NONE'),
+                 'some/some/$NONE')
+    assert_equal(ctx.abspath('file'), os.path.join(wdir, 'file'))
+    # subprocesses see the context
+    proc = ctx.popen('echo $TESTKRAUT_TESTVAR; pwd', shell=True,
+                     stdout=subprocess.PIPE)
+    out = proc.communicate()[0].split()
+    assert_equal(out[0], 'some')
+    assert_equal(os.path.realpath(out[1]), os.path.realpath(wdir))
+    # in-process code, temporarily
+    with ctx.activate():
+        assert_equal(os.environ['TESTKRAUT_TESTVAR'], 'some')
+        assert_equal(os.path.realpath(os.getcwd()), os.path.realpath(wdir))
+    assert_false('TESTKRAUT_TESTVAR' in os.environ)
+    assert_equal(os.getcwd(), initial_cwd)
+
+@with_tempdir()
+def test_run_forked(wdir):
+    import time
+    ctx = ExecutionContext(cwd=wdir, env=dict(TESTKRAUT_TESTVAR='some'))
+    out, err = [os.path.join(wdir, chan) for chan in ('stdout', 'stderr')]
+    def write_env():
+        print(os.environ['TESTKRAUT_TESTVAR'])
+        open('cwd', 'w').write(os.getcwd())
+    exc, rc, resources, timed_out = run_forked(write_env, ctx, out, err)
+    assert_equal((exc, rc, timed_out), (None, 0, False))
+    assert_equal(open(out).read(), 'some\n')
+    assert_equal(os.path.realpath(open(os.path.join(wdir, 'cwd')).read()),
+                 os.path.realpath(wdir))
+    assert_true('wallclock' in resources)
+    # exceptions are reported
+    def fail():
+        raise ValueError('broken')
+    exc, rc, resources, timed_out = run_forked(fail, ctx, out, err)
+    assert_equal(exc, dict(type='ValueError', info='broken'))
+    # timeout kills the child
+    start = time.time()
+    exc, rc, resources, timed_out = run_forked(lambda: time.sleep(30), ctx,
+                                               out, err, timeout=0.2)
+    assert_true(timed_out)
+    assert_true(rc < 0)
+    assert_true(time.time() - start < 10)
+    assert_equal(identify_limit_violation({}, 0.2, rc, resources, timed_out),
+                 'timeout')
+    # limits apply to the child only
+    def open_files():
+        [open(os.path.join(wdir, 'f%i' % i), 'w') for i in range(50)]
+    exc, rc, resources, timed_out = run_forked(
+            open_files, ctx, out, err, limits=dict(max_open_files=20))
+    assert_equal(exc['type'], 'IOError')
+    assert_equal(identify_limit_violation(dict(max_open_files=20), None, rc,
+                                          resources, exception=exc),
+                 'open files')
+    # but no violation without a limit
+    assert_equal(identify_limit_violation({}, None, rc, resources,
+                                          exception=exc), None)
+    open_files()
+
+@with_tempdir()
+def test_zygote(wdir):
+    from functools import partial
+    zygote = Zygote(preload=['json', 'nonexisting_module']).start()
+    try:
+        ctx = ExecutionContext(cwd=wdir, env=dict(TESTKRAUT_TESTVAR='some'))
+        out, err = [os.path.join(wdir, chan) for chan in ('stdout', 'stderr')]
+        code = "import os, sys; print(os.environ['TESTKRAUT_TESTVAR']); " \
+               "sys.modules['json'].dumps; open('pid', 'w').write(str(os.getpid()))"
+        exc, rc, resources, timed_out = zygote.run_forked(
+                partial(exec_python_code, code), ctx, out, err)
+        assert_equal((exc, rc, timed_out), (None, 0, False))
+        assert_equal(open(out).read(), 'some\n')
+        # executed in a child process
+        pid = int(open(os.path.join(wdir, 'pid')).read())
+        assert_false(pid in (os.getpid(), zygote.pid))
+        # failures are reported, and do not affect the zygote
+        exc, rc, resources, timed_out = zygote.run_forked(
+                partial(exec_python_code, "import os; os._exit(3)"),
+                ctx, out, err)
+        assert_equal((exc, rc), (None, 3))
+        exc, rc, resources, timed_out = zygote.run_forked(
+                partial(exec_python_code, None, 'missing.py'), ctx, out, err)
+        assert_equal(exc['type'], 'IOError')
+        exc, rc, resources, timed_out = zygote.run_forked(
+                partial(exec_python_code, "import time; time.sleep(30)"),
+                ctx, out, err, timeout=0.2)
+        assert_true(timed_out)
+        # descendants of the test process do not hold up the result
+        start = time.time()
+        exc, rc, resources, timed_out = zygote.run_forked(
+                partial(exec_python_code,
+                        "import os, time, subprocess\n"
+                        "subprocess.Popen(['sleep', '3'])\n"
+                        "if os.fork() == 0:\n"
+                        "    time.sleep(3)\n"
+                        "    os._exit(0)\n"),
+                ctx, out, err)
+        assert_equal((exc, rc), (None, 0))
+        assert_true(time.time() - start < 2)
+        # the zygote runs no threads, hence can be forked safely
+        if os.path.exists('/proc/%i/task' % zygote.pid):
+            assert_equal(len(os.listdir('/proc/%i/task' % zygote.pid)), 1)
+    finally:
+        zygote.stop()
+    assert_true(zygote.pid is None)
+    # the zygote terminates once its lifeline is cut
+    zygote = Zygote().start()
+    pid = zygote.pid
+    zygote._cleanup()
+    for i in range(50):
+        if os.waitpid(pid, os.WNOHANG)[0] == pid:
+            break
+        time.sleep(0.1)
+    else:
+        zygote.stop()
+        raise AssertionError("zygote survived its lifeline")
+
+@with_tempdir()
+def test_output_file(wdir):
+    from testkraut.execution import summarize_output, match_output_file
+    fname = os.path.join(wdir, 'output')
+    # two-byte characters, cut in the middle by an odd preview size
+    content = u'\u00e4' * 10000
+    open(fname, 'wb').write(content.encode('utf-8'))
+    for preview_size in (4095, 4096):
+        summary = summarize_output(fname, preview_size=preview_size)
+        assert_equal(summary['bytes'], 20000)
+        assert_true(summary['preview'].startswith(u'\u00e4' * 2047))
+        assert_true(summary['preview'].endswith(u'\u00e4' * 2047))
+        assert_false(u'\ufffd' in summary['preview'])
+        # can be stored as JSON
+        json.dumps(summary)
+    open(fname, 'wb').write(b'line 1\n' + b'x' * (3 * 1024 * 1024) + b'end\n')
+    for test, target, expected in (('startswith', u'line 1\n', True),
+                                   ('startswith', 'line 2', False),
+                                   ('endswith', 'xend\n', True),
+                                   ('contains', 'xxxe', True),
+                                   ('contains', 'x\nx', False),
+                                   ('matches', 'line \\d\nx+end', True),
+                                   ('matches', 'x+', False),
+                                   ('value', 'line 1\n', False)):
+        assert_equal(match_output_file(fname, test, target), expected)
+    open(fname, 'wb').write(b'')
+    assert_true(match_output_file(fname, 'value', ''))
+    assert_false(match_output_file(fname, 'endswith', 'x'))
@@ -0,0 +1,299 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the testkraut package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+""""""
+
+__docformat__ = 'restructuredtext'
+
+import os
+import time
+from os.path import join as opj
+from nose.tools import *
+from testkraut.filecache import FileCache, parse_size
+from testkraut.utils import sha1sum
+from .utils import with_tempdir
+
+def _make_file(path, content):
+    open(path, 'w').write(content)
+    return sha1sum(path)
+
+def test_parse_size():
+    assert_equal(parse_size('100'), 100)
+    assert_equal(parse_size('2k'), 2048)
+    assert_equal(parse_size(' 3 GB'), 3 * 1024 ** 3)
+    assert_raises(ValueError, parse_size, 'lots')
+
+@with_tempdir()
+def test_file_cache(wdir):
+    cachedir = opj(wdir, 'cache')
+    cache = FileCache(cachedir, quota=25)
+    hashes = [_make_file(opj(wdir, 'file%i' % i), str(i) * 10)
+                for i in range(3)]
+    assert_equal(cache.get_path(hashes[0]), None)
+    path = cache.insert(hashes[0], opj(wdir, 'file0'))
+    # sharded layout
+    assert_equal(path, opj(cachedir, hashes[0][:2], hashes[0][2:4],
+                           hashes[0]))
+    assert_equal(open(path).read(), '0' * 10)
+    assert_equal(cache.get_path(hashes[0]), path)
+    # symlinks take no space
+    cache.insert(hashes[1], opj(wdir, 'file1'), mode='symlink')
+    assert_true(os.path.islink(cache.get_path(hashes[1])))
+    assert_equal(cache.get_size(), 10)
+    time.sleep(0.01)
+    cache.insert(hashes[2], opj(wdir, 'file2'), mode='hardlink')
+    assert_equal(cache.get_size(), 20)
+    # no temporary files are left behind
+    assert_equal(os.listdir(opj(cachedir, '.tmp')), [])
+    # the oldest file entry gets evicted when exceeding the quota
+    time.sleep(0.01)
+    cache.get_path(hashes[0])
+    fourth = _make_file(opj(wdir, 'file3'), '3' * 10)
+    tmpname = cache.get_temp_filename()
+    os.rename(opj(wdir, 'file3'), tmpname)
+    cache.commit(fourth, tmpname)
+    assert_equal(sorted(cache), sorted(hashes[:2] + [fourth]))
+    assert_false(hashes[2] in cache)
+    assert_equal(cache.get_size(), 20)
+    assert_equal(cache.stats, dict(hits=3, misses=1, insertions=4,
+                                   evictions=1))
+    # counters are shared by all users of a cache
+    cache = FileCache(cachedir)
+    assert_equal(cache.stats['hits'], 0)
+    assert_equal(cache.get_counters()['hits'], 3)
+    # a dangling entry is a miss
+    os.remove(opj(wdir, 'file1'))
+    assert_equal(cache.get_path(hashes[1]), None)
+    assert_false(hashes[1] in list(cache))
+
+@with_tempdir()
+def test_file_cache_migration(wdir):
+    cachedir = opj(wdir, 'cache')
+    os.makedirs(cachedir)
+    # entries of the flat layout
+    plain = _make_file(opj(cachedir, 'tmp'), 'plain')
+    os.rename(opj(cachedir, 'tmp'), opj(cachedir, plain))
+    linked = _make_file(opj(wdir, 'linked'), 'linked')
+    os.symlink(opj(os.pardir, 'linked'), opj(cachedir, linked))
+    os.symlink(opj(wdir, 'gone'), opj(cachedir, '0' * 40))
+    cache = FileCache(cachedir)
+    assert_equal(sorted(cache), sorted([plain, linked]))
+    assert_equal(open(cache.get_path(plain)).read(), 'plain')
+    assert_equal(open(cache.get_path(linked)).read(), 'linked')
+    assert_false(os.path.lexists(opj(cachedir, '0' * 40)))
+
+@with_tempdir()
+def test_file_cache_verify(wdir):
+    cachedir = opj(wdir, 'cache')
+    cache = FileCache(cachedir)
+    hashes = [_make_file(opj(wdir, 'file%i' % i), str(i) * 10)
+                for i in range(4)]
+    for i, sha1 in enumerate(hashes):
+        cache.insert(sha1, opj(wdir, 'file%i' % i),
+                     mode='symlink' if i > 1 else 'copy')
+    report = cache.verify()
+    assert_equal(report, dict(ok=sorted(hashes), unchanged=[], corrupt={},
+                              dangling={}))
+    # bit-rot, a moved source file, and a modified source file
+    open(cache.get_path(hashes[0]), 'w').write('rotten')
+    os.rename(opj(wdir, 'file2'), opj(wdir, 'moved'))
+    open(opj(wdir, 'file3'), 'w').write('modified')
+    report = cache.verify()
+    assert_equal(report['ok'], [])
+    assert_equal(report['unchanged'], [hashes[1]])
+    assert_equal(report['dangling'], {hashes[2]: opj(wdir, 'file2')})
+    assert_equal(sorted(report['corrupt']), sorted([hashes[0], hashes[3]]))
+    assert_equal(open(report['corrupt'][hashes[0]]).read(), 'rotten')
+    # symlinks are quarantined, not their targets
+    assert_true(os.path.islink(report['corrupt'][hashes[3]]))
+    assert_equal(list(cache), [hashes[1]])
+    # a full check does not skip anything
+    assert_equal(cache.verify(full=True)['ok'], [hashes[1]])
+
+@with_tempdir()
+def test_entry_lock(wdir):
+    import signal
+    import threading
+    cache = FileCache(opj(wdir, 'cache'), quota=5)
+    sha1 = _make_file(opj(wdir, 'file'), 'content')
+    lock = cache.get_entry_lock(sha1)
+    # held by another process
+    rpipe, wpipe = os.pipe()
+    pid = os.fork()
+    if not pid:
+        try:
+            lock.acquire()
+            os.write(wpipe, 'x')
+            time.sleep(60)
+        finally:
+            os._exit(0)
+    os.read(rpipe, 1)
+    assert_false(lock.acquire(blocking=False))
+    # a held lock is not cleaned up
+    cache.cleanup()
+    assert_true(os.path.exists(lock.path))
+    # a crash releases the lock
+    os.kill(pid, signal.SIGKILL)
+    os.waitpid(pid, 0)
+    assert_true(lock.acquire(blocking=False))
+    # threads of a process exclude each other as well
+    acquired = []
+    thread = threading.Thread(
+            target=lambda: acquired.append(
+                    cache.get_entry_lock(sha1).acquire(blocking=False)))
+    thread.start()
+    thread.join()
+    assert_equal(acquired, [False])
+    # entries in use are not evicted
+    cache.insert(sha1, opj(wdir, 'file'))
+    other = _make_file(opj(wdir, 'other'), 'other content')
+    cache.insert(other, opj(wdir, 'other'))
+    assert_true(sha1 in cache)
+    lock.release()
+    # stale lock and temporary files are removed
+    tmpname = cache.get_temp_filename()
+    partname = cache.get_download_filename(other) + '.part'
+    open(partname, 'w').write('partial')
+    assert_equal(cache.cleanup(), 1)
+    assert_true(os.path.exists(tmpname))
+    for fname in (tmpname, partname):
+        os.utime(fname, (time.time() - 3600, time.time() - 3600))
+    cache.cleanup(max_age=60)
+    assert_equal(os.listdir(opj(wdir, 'cache', '.tmp')), [])
+    assert_equal(os.listdir(opj(wdir, 'cache', '.locks')), [])
+
+@with_tempdir()
+def test_file_cache_compression(wdir):
+    from testkraut.lookup import place_file_into_dir
+    cachedir = opj(wdir, 'cache')
+    cache = FileCache(cachedir, compression='gzip', hot_size=15)
+    hashes = [_make_file(opj(wdir, 'file%i' % i), str(i) * 10)
+                for i in range(3)]
+    path = cache.insert(hashes[0], opj(wdir, 'file0'))
+    assert_equal(path, opj(cachedir, hashes[0][:2], hashes[0][2:4],
+                           hashes[0] + '.gz'))
+    assert_true(cache.is_compressed(path))
+    assert_true(hashes[0] in cache)
+    # links are not compressed
+    path = cache.insert(hashes[1], opj(wdir, 'file1'), mode='symlink')
+    assert_false(cache.is_compressed(path))
+    # placement decompresses, entries are keyed by the uncompressed content
+    spec = dict(type='file', value='input', sha1sum=hashes[0])
+    dst = place_file_into_dir(spec, opj(wdir, 'testbed'), cache=cache)
+    assert_equal(open(dst).read(), '0' * 10)
+    assert_false(os.path.islink(dst))
+    # a frequently used entry gets a decompressed copy
+    path = cache.get_path(hashes[0])
+    assert_false(cache.is_compressed(path))
+    assert_equal(open(path).read(), '0' * 10)
+    # which is evicted from the hot tier when it is full
+    cache.insert(hashes[2], opj(wdir, 'file2'))
+    cache.get_path(hashes[2])
+    time.sleep(0.01)
+    hotpath = cache.get_path(hashes[2])
+    assert_false(cache.is_compressed(hotpath))
+    compressed = cache.get_path(hashes[0])
+    assert_true(cache.is_compressed(compressed))
+    assert_equal(os.listdir(opj(cachedir, '.tmp')), [])
+    # the decompressed content is verified
+    assert_equal(cache.verify()['ok'], sorted(hashes))
+    # a corrupt decompressed copy, and a truncated compressed file
+    open(hotpath, 'w').write('rotten')
+    open(compressed, 'wb').write(open(compressed, 'rb').read()[:-8])
+    report = cache.verify()
+    assert_equal(report['ok'], [])
+    assert_equal(sorted(report['corrupt']), sorted([hashes[0], hashes[2]]))
+    assert_equal(list(cache), [hashes[1]])
+
+@with_tempdir()
+def test_file_cache_busy_index(wdir):
+    import sqlite3
+    class QuickCache(FileCache):
+        index_timeout = 0.1
+    cachedir = opj(wdir, 'cache')
+    cache = QuickCache(cachedir)
+    hashes = [_make_file(opj(wdir, 'file%i' % i), str(i) * 10)
+                for i in range(2)]
+    cache.insert(hashes[0], opj(wdir, 'file0'))
+    # lookups do not write to the database
+    cache.get_path(hashes[0])
+    assert_equal(FileCache(cachedir).get_counters()['hits'], 0)
+    assert_equal(cache.get_counters()['hits'], 1)
+    # someone else holds the database
+    blocker = sqlite3.connect(opj(cachedir, '.index.sqlite'))
+    blocker.execute('BEGIN EXCLUSIVE')
+    # the file system is enough for opening the cache, lookups, and
+    # insertions
+    assert_equal(list(QuickCache(cachedir)), [hashes[0]])
+    assert_equal(open(cache.get_path(hashes[0])).read(), '0' * 10)
+    path = cache.insert(hashes[1], opj(wdir, 'file1'))
+    assert_equal(cache.get_path(hashes[1]), path)
+    assert_false(cache.flush())
+    blocker.rollback()
+    # postponed updates are written at the next flush
+    assert_true(cache.flush())
+    assert_equal(sorted(FileCache(cachedir)), sorted(hashes))
+    assert_equal(FileCache(cachedir).get_counters(),
+                 dict(hits=3, misses=0, insertions=2, evictions=0))
+
+@with_tempdir()
+def test_shared_entry_lock(wdir):
+    import threading
+    cache = FileCache(opj(wdir, 'cache'), quota=10)
+    sha1 = _make_file(opj(wdir, 'file'), 'content')
+    cache.insert(sha1, opj(wdir, 'file'))
+    # readers of another process
+    rpipe, wpipe = os.pipe()
+    pid = os.fork()
+    if not pid:
+        try:
+            cache.get_entry_lock(sha1, shared=True).acquire()
+            os.write(wpipe, 'x')
+            time.sleep(60)
+        finally:
+            os._exit(0)
+    os.read(rpipe, 1)
+    # and of this process share the entry
+    reader = cache.get_entry_lock(sha1, shared=True)
+    assert_true(reader.acquire(blocking=False))
+    acquired = []
+    thread = threading.Thread(
+            target=lambda: acquired.append(
+                    cache.get_entry_lock(sha1, shared=True).acquire(
+                        blocking=False)))
+    thread.start()
+    thread.join()
+    assert_equal(acquired, [True])
+    # but exclude writers
+    assert_false(cache.get_entry_lock(sha1).acquire(blocking=False))
+    # an entry that is read is not evicted
+    other = _make_file(opj(wdir, 'other'), 'other')
+    cache.insert(other, opj(wdir, 'other'))
+    assert_true(sha1 in cache)
+    # the other thread's lock was never released
+    cache.get_entry_lock(sha1, shared=True).release()
+    reader.release()
+    os.kill(pid, 9)
+    os.waitpid(pid, 0)
+    # nor is it moved into quarantine: verification waits for the readers
+    open(cache.get_path(sha1), 'w').write('rotten')
+    pid = os.fork()
+    if not pid:
+        try:
+            lock = cache.get_entry_lock(sha1, shared=True)
+            lock.acquire()
+            os.write(wpipe, 'x')
+            time.sleep(0.5)
+            lock.release()
+        finally:
+            os._exit(0)
+    os.read(rpipe, 1)
+    start = time.time()
+    assert_equal(list(cache.verify()['corrupt']), [sha1])
+    assert_true(time.time() - start > 0.3)
+    os.waitpid(pid, 0)
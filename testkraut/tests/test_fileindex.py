@@ -0,0 +1,115 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the testkraut package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+""""""
+
+__docformat__ = 'restructuredtext'
+
+import os
+from os.path import join as opj
+from nose.tools import *
+from testkraut.fileindex import FileIndex
+from testkraut.utils import sha1sum
+from .utils import with_tempdir
+
+@with_tempdir()
+def test_file_index(wdir):
+    root = opj(wdir, 'data')
+    os.makedirs(opj(root, 'sub', 'deeper'))
+    for fname, content in (('one', '1'), ('sub/one', 'sub1'),
+                           ('sub/deeper/two', '2')):
+        open(opj(root, fname), 'w').write(content)
+    dbfilename = opj(wdir, 'index.sqlite')
+    index = FileIndex(root, dbfilename)
+    index.refresh()
+    assert_equal(sorted(index), [opj(root, 'one'), opj(root, 'sub', 'deeper', 'two'),
+                                 opj(root, 'sub', 'one')])
+    # lookup by name, shallow files first
+    assert_equal(index.find_by_name('one'), [opj(root, 'one'),
+                                             opj(root, 'sub', 'one')])
+    assert_equal(index.find_by_name('sub/one'), [opj(root, 'sub', 'one')])
+    assert_equal(index.find_by_name('deeper/two'),
+                 [opj(root, 'sub', 'deeper', 'two')])
+    assert_equal(index.find_by_name('ne'), [])
+    # lookup by hash
+    two_hash = sha1sum(opj(root, 'sub', 'deeper', 'two'))
+    assert_equal(index.find_by_sha1(two_hash),
+                 opj(root, 'sub', 'deeper', 'two'))
+    assert_equal(index.find_by_sha1('0' * 40), None)
+    # hashes are persistent
+    index = FileIndex(root, dbfilename)
+    assert_equal(index._db.execute(
+                    "SELECT COUNT(*) FROM files WHERE sha1 IS NULL").fetchone()[0],
+                 0)
+    # changes are picked up
+    os.remove(opj(root, 'one'))
+    open(opj(root, 'sub', 'deeper', 'two'), 'w').write('changed')
+    index.refresh()
+    assert_equal(index.find_by_name('one'), [opj(root, 'sub', 'one')])
+    assert_equal(index.find_by_sha1(two_hash), None)
+    assert_equal(index.get_sha1(opj(root, 'sub', 'deeper', 'two')),
+                 sha1sum(opj(root, 'sub', 'deeper', 'two')))
+
+@with_tempdir()
+def test_size_gated_lookup(wdir):
+    from testkraut.utils import quicksum
+    root = opj(wdir, 'data')
+    os.makedirs(root)
+    for i in range(10):
+        open(opj(root, 'file%i' % i), 'w').write('x' * i)
+    # larger than two quicksum blocks, differing in the middle only
+    open(opj(root, 'big1'), 'w').write('a' * 3000 + 'b' + 'a' * 3000)
+    open(opj(root, 'big2'), 'w').write('a' * 3000 + 'c' + 'a' * 3000)
+    assert_equal(quicksum(opj(root, 'big1'), 1024),
+                 quicksum(opj(root, 'big2'), 1024))
+    assert_not_equal(quicksum(opj(root, 'big1')), quicksum(opj(root, 'big2')))
+    # small files are hashed entirely
+    assert_equal(quicksum(opj(root, 'file5')), sha1sum(opj(root, 'file5')))
+    index = FileIndex(root, opj(wdir, 'index.sqlite'))
+    index.refresh()
+    def count_unhashed():
+        return index._db.execute(
+                "SELECT COUNT(*) FROM files WHERE sha1 IS NULL").fetchone()[0]
+    target = sha1sum(opj(root, 'file7'))
+    # nothing of this size, nothing gets hashed
+    assert_equal(index.find_by_sha1(target, size=100), None)
+    assert_equal(count_unhashed(), 12)
+    # only the file of matching size is hashed
+    assert_equal(index.find_by_sha1(target, size=7), opj(root, 'file7'))
+    assert_equal(count_unhashed(), 11)
+    # quicksum mismatch rules out files of identical size
+    assert_equal(index.find_by_sha1(sha1sum(opj(root, 'big2')), size=6001,
+                                    quicksum='0' * 40), None)
+    assert_equal(count_unhashed(), 11)
+    assert_equal(index.find_by_sha1(sha1sum(opj(root, 'big2')), size=6001,
+                                    quicksum=quicksum(opj(root, 'big2'))),
+                 opj(root, 'big2'))
+
+@with_tempdir()
+def test_stale_index(wdir):
+    root = opj(wdir, 'data')
+    os.makedirs(root)
+    fpath = opj(root, 'file')
+    open(fpath, 'w').write('orig')
+    orig_hash = sha1sum(fpath)
+    index = FileIndex(root, opj(wdir, 'index.sqlite'))
+    index.refresh()
+    assert_equal(index.find_by_sha1(orig_hash), fpath)
+    # modified after the refresh, with the same size
+    st = os.stat(fpath)
+    open(fpath, 'w').write('new!')
+    os.utime(fpath, (st.st_atime, st.st_mtime + 1))
+    # a stale hash is not trusted
+    assert_equal(index.find_by_sha1(orig_hash), None)
+    assert_equal(index.get_sha1(fpath), sha1sum(fpath))
+    assert_equal(index.find_by_sha1(sha1sum(fpath), size=4), fpath)
+    # a file that is gone is not reported
+    new_hash = sha1sum(fpath)
+    os.remove(fpath)
+    assert_equal(index.find_by_sha1(new_hash), None)
+    assert_equal(list(index), [])
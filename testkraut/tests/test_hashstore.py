@@ -0,0 +1,167 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the testkraut package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+""""""
+
+__docformat__ = 'restructuredtext'
+
+import os
+import time
+import hashlib
+from os.path import join as opj
+from nose.tools import *
+from testkraut import hashstore
+from testkraut.hashstore import fetch, fetch_into_cache, ConnectionPool
+from testkraut.filecache import FileCache
+from .utils import with_tempdir, HashStoreServer
+
+def _sha1(content):
+    return hashlib.sha1(content).hexdigest()
+
+@with_tempdir()
+def test_fetch(wdir):
+    content = os.urandom(5000)
+    sha1 = _sha1(content)
+    server = HashStoreServer({sha1: content, 'bogus': 'bogus'})
+    try:
+        pool = ConnectionPool()
+        dst = opj(wdir, 'file')
+        assert_equal(fetch(server.url + sha1, dst, sha1=sha1, pool=pool), dst)
+        assert_equal(open(dst, 'rb').read(), content)
+        assert_false(os.path.exists(dst + '.part'))
+        # content is verified
+        assert_equal(fetch(server.url + 'bogus', dst, sha1=sha1, pool=pool),
+                     None)
+        assert_false(os.path.exists(dst + '.part'))
+        assert_equal(fetch(server.url + 'missing', dst, pool=pool), None)
+        # all requests went through a single connection
+        assert_equal(server.connections, 1)
+        # an interrupted download is resumed
+        server.truncate = 2000
+        os.remove(dst)
+        assert_equal(fetch(server.url + sha1, dst, sha1=sha1, pool=pool),
+                     None)
+        assert_equal(os.path.getsize(dst + '.part'), 2000)
+        server.truncate = None
+        assert_equal(fetch(server.url + sha1, dst, sha1=sha1, pool=pool), dst)
+        assert_equal(server.requests[-1], (sha1, 'bytes=2000-'))
+        assert_equal(open(dst, 'rb').read(), content)
+        # a complete, but unverified partial download
+        os.rename(dst, dst + '.part')
+        assert_equal(fetch(server.url + sha1, dst, sha1=sha1, pool=pool), dst)
+        assert_equal(open(dst, 'rb').read(), content)
+    finally:
+        pool.close()
+        server.stop()
+
+@with_tempdir()
+def test_fetch_into_cache(wdir):
+    contents = [os.urandom(1000 + i) for i in range(6)]
+    files = dict([(_sha1(c), c) for c in contents])
+    # the first store has only some of the files
+    servers = [HashStoreServer(dict(list(files.items())[:2])),
+               HashStoreServer(files)]
+    try:
+        cache = FileCache(opj(wdir, 'cache'))
+        fetched = fetch_into_cache(cache, list(files) + ['0' * 40],
+                                   hash_stores=[s.url for s in servers],
+                                   nthreads=3)
+        assert_equal(sorted(fetched), sorted(files))
+        for sha1, path in fetched.items():
+            assert_equal(cache.get_path(sha1), path)
+            assert_equal(open(path, 'rb').read(), files[sha1])
+        assert_equal(os.listdir(opj(wdir, 'cache', '.tmp')), [])
+    finally:
+        # do not keep connections to the stand-ins
+        hashstore._pool.close()
+        for s in servers:
+            s.stop()
+
+def _get_dead_url():
+    # a port nobody listens on
+    import socket
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return 'http://127.0.0.1:%i/' % port
+
+@with_tempdir()
+def test_mirror_manager(wdir):
+    from testkraut.hashstore import MirrorManager
+    content = os.urandom(1000)
+    sha1 = _sha1(content)
+    only_slow = os.urandom(1000)
+    slow = HashStoreServer({sha1: content, _sha1(only_slow): only_slow},
+                           delay=0.2)
+    fast = HashStoreServer({sha1: content})
+    dead = _get_dead_url()
+    pool = ConnectionPool()
+    try:
+        mirrors = MirrorManager([dead, slow.url, fast.url], pool=pool)
+        # the dead store is excluded, the fast one comes first
+        assert_equal(mirrors.get_live_stores(), [fast.url, slow.url])
+        dst = opj(wdir, 'file')
+        assert_equal(mirrors.fetch(sha1, dst), dst)
+        assert_equal(open(dst, 'rb').read(), content)
+        assert_equal(fast.requests[-1], (sha1, None))
+        assert_false((sha1, None) in slow.requests)
+        assert_true(fast.url in mirrors.throughput)
+        # failover to the slow store, if the fast one lacks a file
+        assert_equal(mirrors.fetch(_sha1(only_slow), dst), dst)
+        assert_equal(open(dst, 'rb').read(), only_slow)
+        nrequests = len(fast.requests)
+        # the fast store is not asked again for the missing file
+        assert_equal(mirrors.get_live_stores(_sha1(only_slow)), [slow.url])
+        assert_equal(mirrors.fetch(_sha1(only_slow), dst), dst)
+        assert_equal(len(fast.requests), nrequests)
+        # a store that goes away is skipped
+        fast.stop()
+        pool.close()
+        assert_equal(mirrors.fetch(sha1, dst), dst)
+        assert_equal(mirrors.get_live_stores(), [slow.url])
+        # nothing at all
+        assert_equal(mirrors.fetch('0' * 40, dst), None)
+        # no requests at all for a file known to be missing, not even probes
+        nrequests = len(slow.requests)
+        assert_equal(mirrors.fetch('0' * 40, dst), None)
+        assert_equal(len(slow.requests), nrequests)
+    finally:
+        pool.close()
+        slow.stop()
+        fast.stop()
+
+@with_tempdir()
+def test_fetch_deduplication(wdir):
+    import threading
+    content = os.urandom(1000)
+    sha1 = _sha1(content)
+    server = HashStoreServer({sha1: content})
+    try:
+        cache = FileCache(opj(wdir, 'cache'))
+        # someone else is downloading
+        lock = cache.get_entry_lock(sha1)
+        lock.acquire()
+        fetched = []
+        thread = threading.Thread(
+                target=lambda: fetched.append(fetch_into_cache(
+                                    FileCache(opj(wdir, 'cache')), [sha1],
+                                    hash_stores=[server.url])))
+        thread.start()
+        time.sleep(0.2)
+        assert_equal(fetched, [])
+        open(opj(wdir, 'file'), 'wb').write(content)
+        cache.insert(sha1, opj(wdir, 'file'))
+        lock.release()
+        thread.join()
+        # the file was not downloaded again
+        assert_equal(fetched, [{sha1: cache.get_path(sha1)}])
+        assert_false((sha1, None) in server.requests)
+    finally:
+        hashstore._pool.close()
+        server.stop()
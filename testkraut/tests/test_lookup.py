@@ -0,0 +1,124 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the testkraut package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+""""""
+
+__docformat__ = 'restructuredtext'
+
+import os
+from os.path import join as opj
+from nose.tools import *
+from testkraut.lookup import stage_file, staging_modes, \
+        get_shared_files_state, get_modified_shared_files
+from testkraut.utils import sha1sum
+from .utils import with_tempdir
+
+@with_tempdir()
+def test_stage_file(wdir):
+    src = opj(wdir, 'src')
+    open(src, 'w').write('content')
+    # a link to the source, like a cache entry
+    os.symlink(src, opj(wdir, 'cached'))
+    for mode in staging_modes:
+        dst = opj(wdir, mode)
+        used = stage_file(opj(wdir, 'cached'), dst, mode)
+        # reflinks are not supported everywhere
+        assert_true(used in (mode, 'copy'))
+        assert_equal(open(dst).read(), 'content')
+        # staging again replaces the file without touching the source
+        if os.path.exists(opj(wdir, 'other')):
+            # might have been shared read-only
+            os.remove(opj(wdir, 'other'))
+        open(opj(wdir, 'other'), 'w').write('other')
+        stage_file(opj(wdir, 'other'), dst, mode)
+        assert_equal(open(dst).read(), 'other')
+        assert_equal(open(src).read(), 'content')
+        stage_file(src, dst, mode)
+    assert_true(os.path.islink(opj(wdir, 'symlink')))
+    assert_false(os.path.islink(opj(wdir, 'hardlink')))
+    assert_equal(os.stat(src).st_ino, os.stat(opj(wdir, 'hardlink')).st_ino)
+    # shared files are read-only, copies are not
+    assert_false(os.stat(src).st_mode & 0o222)
+    stage_file(src, opj(wdir, 'copy'), 'copy')
+    assert_true(os.stat(opj(wdir, 'copy')).st_mode & 0o200)
+    assert_raises(ValueError, stage_file, src, opj(wdir, 'dst'), 'magic')
+
+@with_tempdir()
+def test_shared_file_modification(wdir):
+    src = opj(wdir, 'src')
+    open(src, 'w').write('content')
+    staged = []
+    for mode in ('copy', 'hardlink', 'symlink'):
+        staged.append(opj(wdir, mode))
+        stage_file(src, staged[-1], mode)
+    state = get_shared_files_state(staged)
+    # copies are not shared
+    assert_equal(sorted(state.keys()), sorted(staged[1:]))
+    assert_equal(get_modified_shared_files(state), [])
+    # replacing a shared file is fine
+    os.remove(staged[2])
+    open(staged[2], 'w').write('new')
+    assert_equal(get_modified_shared_files(state), [])
+    # but writing into it is not (possible despite being read-only, e.g.
+    # for the superuser)
+    os.chmod(staged[1], 0o644)
+    open(staged[1], 'a').write('more')
+    assert_equal(get_modified_shared_files(state), [staged[1]])
+
+@with_tempdir()
+def test_stage_cached_file(wdir):
+    from testkraut.filecache import FileCache
+    from testkraut.lookup import place_file_into_dir
+    src = opj(wdir, 'src')
+    open(src, 'w').write('content')
+    sha1 = sha1sum(src)
+    cache = FileCache(opj(wdir, 'cache'))
+    cache.insert(sha1, src)
+    testbed = opj(wdir, 'testbed')
+    dst = place_file_into_dir(dict(type='file', value='input', sha1sum=sha1),
+                              testbed, cache=cache, staging='symlink')
+    # no symlink into the cache, the file survives the eviction of the entry
+    assert_false(os.path.islink(dst))
+    cache.remove(sha1)
+    assert_equal(open(dst).read(), 'content')
+    assert_false(os.stat(dst).st_mode & 0o222)
+
+@with_tempdir()
+def test_prepare_testbed_fetch(wdir):
+    import hashlib
+    from testkraut import cfg, hashstore
+    from testkraut.filecache import FileCache
+    from testkraut.lookup import prepare_local_testbed
+    from .utils import HashStoreServer
+    contents = [os.urandom(1000 + i) for i in range(4)]
+    files = dict([(hashlib.sha1(c).hexdigest(), c) for c in contents])
+    spec = dict(inputs=dict([('input%i' % i,
+                              dict(type='file', value='input%i' % i,
+                                   sha1sum=hashlib.sha1(c).hexdigest()))
+                                for i, c in enumerate(contents)]))
+    server = HashStoreServer(files, delay=0.2)
+    saved = cfg.get('data sources', 'hash stores', default=None)
+    cfg.set('data sources', 'hash stores', server.url)
+    try:
+        placed = prepare_local_testbed(spec, opj(wdir, 'testbed'), [],
+                                       cache=FileCache(opj(wdir, 'cache')),
+                                       staging='copy')
+        assert_equal(sorted(placed),
+                     [opj(wdir, 'testbed', 'input%i' % i) for i in range(4)])
+        for i, c in enumerate(contents):
+            assert_equal(open(opj(wdir, 'testbed', 'input%i' % i),
+                              'rb').read(), c)
+        # all missing inputs were downloaded concurrently, not one by one
+        assert_true(server.max_active > 1)
+    finally:
+        if saved is None:
+            cfg.remove_option('data sources', 'hash stores')
+        else:
+            cfg.set('data sources', 'hash stores', saved)
+        hashstore._pool.close()
+        server.stop()
@@ -0,0 +1,103 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the testkraut package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+""""""
+
+__docformat__ = 'restructuredtext'
+
+import os
+import json
+import tempfile
+from os.path import join as opj
+from nose.tools import *
+from testkraut.prefetch import Prefetcher
+from testkraut.utils import sha1sum
+from .utils import with_tempdir
+
+def _make_spec(wdir, name, content, **kwargs):
+    specdir = opj(wdir, name)
+    os.makedirs(specdir)
+    open(opj(specdir, 'input.txt'), 'w').write(content)
+    spec = dict(id=name, version=0, tests=[],
+                inputs=dict(input=dict(type='file', value='input.txt',
+                                       size=len(content),
+                                       sha1sum=sha1sum(opj(specdir,
+                                                           'input.txt')))))
+    spec.update(kwargs)
+    spec_filename = opj(specdir, 'spec.json')
+    json.dump(spec, open(spec_filename, 'w'))
+    return spec_filename
+
+@with_tempdir()
+def test_prefetcher(wdir):
+    from testkraut import cfg
+    saved = cfg.get('cache', 'files', default=None)
+    cfg.set('cache', 'files', opj(wdir, 'cache'))
+    try:
+        specs = [_make_spec(wdir, 'spec%i' % i, str(i) * (i + 1) * 10)
+                    for i in range(4)]
+        # the last one does not fit into the budget
+        prefetcher = Prefetcher(specs, depth=2, disk_budget=35)
+        prefetcher.start()
+        testbeds = []
+        for i, spec_filename in enumerate(specs[:3]):
+            testbed = tempfile.mkdtemp(dir=wdir)
+            testbeds.append(testbed)
+            placed = prefetcher.claim(spec_filename, testbed)
+            assert_equal(placed, [opj(testbed, 'input.txt')])
+            assert_equal(open(placed[0]).read(), str(i) * (i + 1) * 10)
+        assert_equal(prefetcher.claim(specs[3], testbeds[-1]), None)
+        # claiming twice gives nothing
+        assert_equal(prefetcher.claim(specs[0], testbeds[0]), None)
+        prefetcher.stop()
+        # a SPEC that was not prefetched yet is skipped
+        prefetcher = Prefetcher(specs[1:], depth=1)
+        testbed = opj(wdir, 'testbed')
+        assert_equal(prefetcher.claim(specs[2], testbed), None)
+        prefetcher.start()
+        assert_equal(prefetcher.claim(specs[1], testbed),
+                     [opj(testbed, 'input.txt')])
+        prefetcher.stop()
+    finally:
+        if saved is None:
+            cfg.remove_option('cache', 'files')
+        else:
+            cfg.set('cache', 'files', saved)
+
+@with_tempdir()
+def test_prefetch_skipped_spec(wdir):
+    from testtools import TestResult
+    from testkraut import cfg
+    from testkraut.runner import _get_spec_test
+    saved = cfg.get('cache', 'files', default=None)
+    cfg.set('cache', 'files', opj(wdir, 'cache'))
+    try:
+        # the first two are skipped for a missing environment variable
+        specs = [_make_spec(wdir, 'spec%i' % i, str(i) * 10,
+                            environment=dict(TESTKRAUT_SURELY_UNSET=True)
+                                            if i < 2 else {})
+                    for i in range(3)]
+        prefetcher = Prefetcher(specs, depth=1)
+        prefetcher.start()
+        result = TestResult()
+        for i, spec_filename in enumerate(specs):
+            test = _get_spec_test('spec%i' % i, spec_filename, [])
+            test.prefetcher = prefetcher
+            test.run(result)
+        assert_equal(len(result.skip_reasons), 1)
+        assert_equal(len(list(result.skip_reasons.values())[0]), 2)
+        assert_true(result.wasSuccessful())
+        # skipped SPECs did not leave their testbeds with the prefetcher
+        assert_equal(prefetcher._nstaged, 0)
+        assert_equal(prefetcher._staged_bytes, 0)
+        prefetcher.stop()
+    finally:
+        if saved is None:
+            cfg.remove_option('cache', 'files')
+        else:
+            cfg.set('cache', 'files', saved)
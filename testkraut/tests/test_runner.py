@@ -0,0 +1,116 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the testkraut package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+""""""
+
+__docformat__ = 'restructuredtext'
+
+import os.path as op
+from nose.tools import *
+from testtools import TestResult
+from testkraut.testcase import discover_specs
+from testkraut.runner import run_specs
+from .utils import with_tempdir
+
+def test_parallel_run():
+    specs = discover_specs([op.join(op.dirname(__file__), 'localtests')])
+    serial = TestResult()
+    run_specs(specs, serial, nprocs=1)
+    parallel = TestResult()
+    run_specs(specs, parallel, nprocs=3)
+    # all tests are reported, with identical outcomes
+    assert_equal(serial.testsRun, len(specs))
+    assert_equal(parallel.testsRun, len(specs))
+    for attr in ('errors', 'failures', 'skip_reasons'):
+        assert_equal(len(getattr(serial, attr)), len(getattr(parallel, attr)))
+    assert_equal(serial.wasSuccessful(), parallel.wasSuccessful())
+
+@with_tempdir()
+def test_run_cache(wdir):
+    from testkraut import cfg
+    from testkraut.runner import _get_spec_test
+    specs = discover_specs([op.join(op.dirname(__file__), 'localtests')])
+    spec_filename = specs['check_multiple_tests'][0][0]
+    saved = [(sec, opt, cfg.get(sec, opt, default=None))
+                for sec, opt in (('cache', 'runs'),
+                                 ('testrun', 'skip dependency description'))]
+    cfg.set('cache', 'runs', wdir)
+    cfg.set('testrun', 'skip dependency description', 'no')
+    try:
+        runs = []
+        for force in (False, False, True):
+            test = _get_spec_test('check_multiple_tests', spec_filename, [],
+                                  force=force)
+            result = TestResult()
+            test.run(result)
+            assert_true(result.wasSuccessful())
+            runs.append(test._details)
+        # first run executes and stores, second one reuses
+        assert_false(runs[0]['cache_info']['reused'])
+        assert_true(runs[1]['cache_info']['reused'])
+        assert_equal(runs[0]['cache_info']['run_key'],
+                     runs[1]['cache_info']['run_key'])
+        assert_equal(sorted(runs[0]['exec_info'].keys()),
+                     sorted(runs[1]['exec_info'].keys()))
+        # force executes again
+        assert_false('cache_info' in runs[2])
+    finally:
+        for sec, opt, value in saved:
+            if value is None:
+                cfg.remove_option(sec, opt)
+            else:
+                cfg.set(sec, opt, value)
+
+@with_tempdir()
+def test_run_key_input_hashes(wdir):
+    from testkraut.execution import ExecutionContext
+    from testkraut.testcase import _get_input_hashes
+    from testkraut.utils import sha1sum
+    open(op.join(wdir, 'volatile'), 'w').write('content')
+    inputs = dict(recorded=dict(type='file', value='recorded',
+                                sha1sum='0' * 40),
+                  volatile=dict(type='file', value='volatile'))
+    # recorded sha1sums are used as is, the file is not even read
+    assert_equal(_get_input_hashes(inputs, ExecutionContext(cwd=wdir)),
+                 dict(recorded='0' * 40,
+                      volatile=sha1sum(op.join(wdir, 'volatile'))))
+
+def test_process_budget():
+    from testkraut.runner import _get_spec_test
+    specs = discover_specs([op.join(op.dirname(__file__), 'localtests')])
+    test = _get_spec_test('check_nipype_workflow',
+                          specs['check_nipype_workflow'][0][0], [],
+                          process_budget=2)
+    assert_equal(test._get_nipype_run_args({}), {})
+    assert_equal(test._get_nipype_run_args(dict(plugin='Linear')),
+                 dict(plugin='Linear'))
+    assert_equal(test._get_nipype_run_args(dict(plugin='MultiProc')),
+                 dict(plugin='MultiProc', plugin_args=dict(n_procs=2)))
+    # capped by the budget
+    for requested, granted in ((1, 1), (8, 2)):
+        assert_equal(test._get_nipype_run_args(dict(plugin='MultiProc',
+                                                    n_procs=requested)),
+                     dict(plugin='MultiProc',
+                          plugin_args=dict(n_procs=granted)))
+
+@with_tempdir()
+def test_lost_worker(wdir):
+    import json
+    for spec_id, command in (('crashing', 'kill -9 $PPID'),
+                             ('fine', 'true')):
+        json.dump(dict(id=spec_id, version=0,
+                       tests=[dict(type='shell', command=command)]),
+                  open(op.join(wdir, '%s.json' % spec_id), 'w'))
+    specs = discover_specs([wdir])
+    result = TestResult()
+    # the run does not hang, a dead worker is an error of its SPEC
+    run_specs(specs, result, nprocs=2)
+    assert_equal(result.testsRun, 2)
+    assert_equal(len(result.errors), 1)
+    assert_true('crashing' in result.errors[0][0].id())
+    assert_true('worker process died' in result.errors[0][1])
@@ -0,0 +1,83 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the testkraut package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+""""""
+
+__docformat__ = 'restructuredtext'
+
+import random
+import difflib
+from nose.tools import *
+from testkraut.seqdiff import get_opcodes
+
+def _apply(opcodes, a, b):
+    # rebuild b from a, checking that the opcodes are consistent
+    out = []
+    i = j = 0
+    for tag, i1, i2, j1, j2 in opcodes:
+        assert_equal((i1, j1), (i, j))
+        if tag == 'equal':
+            assert_equal(a[i1:i2], b[j1:j2])
+            out.extend(a[i1:i2])
+        else:
+            out.extend(b[j1:j2])
+        i, j = i2, j2
+    assert_equal((i, j), (len(a), len(b)))
+    return out
+
+def test_get_opcodes():
+    for a, b in (([], []), ([], [1]), ([1], []), ([1, 2, 3], [1, 2, 3]),
+                 ([1, 2, 3], [4, 5, 6]),
+                 ('abxcd', 'abcd'), (['a', 'b'], ['a', 'c', 'b'])):
+        assert_equal(get_opcodes(a, b),
+                     difflib.SequenceMatcher(None, a, b).get_opcodes())
+    # element-wise, also for unhashable elements
+    assert_equal(get_opcodes([1, 2, 3, 4], [1, 5, 6, 4]),
+                 [('equal', 0, 1, 0, 1), ('replace', 1, 3, 1, 3),
+                  ('equal', 3, 4, 3, 4)])
+    assert_equal(get_opcodes([{'a': 1}, {'b': 2}], [{'a': 1}, {'b': 3}]),
+                 [('equal', 0, 1, 0, 1), ('replace', 1, 2, 1, 2)])
+    # a shift is no element-wise change
+    assert_equal(get_opcodes([1, 2, 3], [0, 1, 2]),
+                 [('insert', 0, 0, 0, 1), ('equal', 0, 2, 1, 3),
+                  ('delete', 2, 3, 3, 3)])
+    random.seed(0)
+    for i in range(200):
+        a = [random.randint(0, 5) for j in range(random.randint(0, 20))]
+        b = [random.randint(0, 5) for j in range(random.randint(0, 20))]
+        assert_equal(_apply(get_opcodes(a, b), a, b), b)
+
+def test_long_sequences():
+    # frequent elements are not ignored, as with difflib's autojunk
+    a = ['same'] * 1000 + ['line%i' % i for i in range(100000)]
+    b = list(a)
+    del b[500]
+    b.insert(50000, 'new')
+    opcodes = get_opcodes(a, b)
+    assert_equal([oc[0] for oc in opcodes],
+                 ['equal', 'delete', 'equal', 'insert', 'equal'])
+    assert_equal(opcodes[3], ('insert', 50001, 50001, 50000, 50001))
+    assert_equal(_apply(opcodes, a, b), b)
+
+def test_max_edit_distance():
+    # a shifted region is aligned up to the maximum number of edits ...
+    a = ['x'] + ['a', 'b'] * 10 + ['y']
+    b = ['x'] + ['b', 'a'] * 10 + ['y']
+    opcodes = get_opcodes(a, b)
+    assert_equal(opcodes[:3], [('equal', 0, 1, 0, 1), ('delete', 1, 2, 1, 1),
+                               ('equal', 2, 21, 1, 20)])
+    assert_equal(get_opcodes(a, b, max_edit_distance=2), opcodes)
+    # ... beyond that, the whole region is considered replaced
+    assert_equal(get_opcodes(a, b, max_edit_distance=1),
+                 [('equal', 0, 1, 0, 1), ('replace', 1, 21, 1, 21),
+                  ('equal', 21, 22, 21, 22)])
+    assert_equal(_apply(get_opcodes(a, b, max_edit_distance=0), a, b), b)
+    # the same for SPEC differences
+    from testkraut.spec import diff
+    assert_equal(diff(a, b, max_edit_distance=1)['seqmatch'][1],
+                 ('replace', 1, 21, 1, 21))
@@ -13,6 +13,7 @@ __docformat__ = 'restructuredtext'
 from testkraut import spec
 from nose.tools import *
 import pkgutil
+import json
 
 def test_spec_io():
     assert_raises(ValueError, spec.SPEC)
@@ -37,6 +38,145 @@ def test_numdiff():
     assert_true('tests' in sp.diff(spec.SPEC('{"tests": 1}'), min_rel_numdiff=0.00001))
     # arrays
     sp = spec.SPEC('{"tests": [1,2,3,4]}')
-    assert_true('numdiff' in sp.diff(spec.SPEC('{"tests": [1,2,2,4]}'))['tests'])
-    assert_false('numdiff' in sp.diff(spec.SPEC('{"tests": [1,2,3]}'))['tests'])
-    assert_false('numdiff' in sp.diff(spec.SPEC('{"tests": [1,2,2,"hello"]}'))['tests'])
+    assert_true('arraydiff' in sp.diff(spec.SPEC('{"tests": [1,2,2,4]}'))['tests'])
+    assert_false('arraydiff' in sp.diff(spec.SPEC('{"tests": [1,2,3]}'))['tests'])
+    assert_false('arraydiff' in sp.diff(spec.SPEC('{"tests": [1,2,2,"hello"]}'))['tests'])
+
+def test_arraydiff():
+    fr = [float(i) for i in range(100000)]
+    to = list(fr)
+    to[3] = 3.5
+    to[70000] = 70007.0
+    to[99999] = float('nan')
+    summary = spec.diff(fr, to)['arraydiff']
+    assert_equal(summary['count'], 3)
+    assert_equal(summary['size'], 100000)
+    assert_equal(summary['max_abs'], 7.0)
+    assert_equal(summary['max_rel'], 0.5 / 3)
+    # NaN mismatches first, then by size of the difference
+    assert_equal([t[0] for t in summary['top']], [99999, 70000, 3])
+    # tolerance applies to every element
+    summary = spec.diff(fr, to, min_rel_numdiff=0.001)['arraydiff']
+    assert_equal([t[0] for t in summary['top']], [99999, 3])
+    summary = spec.diff(fr, to, min_abs_numdiff=1)['arraydiff']
+    assert_equal(summary['count'], 2)
+    # combined tolerance
+    assert_equal(spec.diff([100.0, 0.0], [100.9, 0.4], min_abs_numdiff=0.5,
+                           min_rel_numdiff=0.005), None)
+    # nested arrays
+    summary = spec.diff([[1, 2], [3, 4]], [[1, 2], [3, 5]])['arraydiff']
+    assert_equal(summary['top'], [((1, 1), 4.0, 5.0)])
+    assert_equal(spec.diff([[1, 2], [3, 4]], [[1, 2], [3, 4]]), None)
+    # undefined maxima do not end up as invalid JSON
+    summary = spec.diff([0.0, 1.0, 2.0], [0.5, 1.0, 2.5])['arraydiff']
+    assert_equal(summary['max_abs'], 0.5)
+    assert_equal(summary['max_rel'], None)
+    json.dumps(summary, allow_nan=False)
+    summary = spec.diff([1.0, 2.0], [float('inf'), 2.0])['arraydiff']
+    assert_equal(summary['max_abs'], None)
+
+def test_spec_hash():
+    import copy
+    import pickle
+    sp = spec.SPEC('{"id": "x", "tests": [{"a": [1, 2], "b": "text"}]}')
+    orig = sp.get_hash()
+    # independent of key order and of the kind of containers
+    assert_equal(orig, spec.SPEC(dict(tests=[dict(b='text', a=[1, 2])],
+                                      id='x')).get_hash())
+    assert_equal(sp.get_hash('tests', 0, 'a'),
+                 spec.SPEC('{"id": "y", "tests": [1, 2]}').get_hash('tests'))
+    # nested modifications are noticed
+    sp['tests'][0]['a'].append(3)
+    modified = sp.get_hash()
+    assert_not_equal(modified, orig)
+    assert_equal(modified, spec.SPEC(
+        '{"id": "x", "tests": [{"a": [1, 2, 3], "b": "text"}]}').get_hash())
+    sp['tests'][0]['a'].pop()
+    assert_equal(sp.get_hash(), orig)
+    # so are modifications of plain containers
+    sp['tests'][0]['c'] = {}
+    plain = sp.get_hash()
+    sp['tests'][0]['c']['d'] = 1
+    assert_not_equal(sp.get_hash(), plain)
+    del sp['tests'][0]['c']
+    # copies are independent
+    for cp in (copy.deepcopy(sp), pickle.loads(pickle.dumps(sp)),
+               pickle.loads(pickle.dumps(sp, 2))):
+        assert_equal(cp.get_hash(), orig)
+        cp['tests'][0]['a'][0] = 5
+        assert_not_equal(cp.get_hash(), orig)
+        assert_equal(sp.get_hash(), orig)
+
+def test_diff_subtrees():
+    content = '{"id": "x", "tests": {"a": ["b", "c"], "d": {"e": 1}}}'
+    sp = spec.SPEC(content)
+    other = spec.SPEC(content)
+    assert_equal(sp.diff(other), None)
+    other['tests']['a'][1] = 'x'
+    assert_equal(sp.diff(other)['tests'].keys(), ['a'])
+    # loaded and constructed SPECs are comparable
+    assert_equal(sp.diff(spec.SPEC(dict(id='x', tests=dict(a=['b', 'c'],
+                                                           d=dict(e=1))))),
+                 None)
+
+def test_iter_diff():
+    sp = dict(a='line', b=dict(c=1, d=[1, 2]), e=[3, 'f'], g=True)
+    other = dict(a='other', b=dict(c=1, d=[1, 3]), e=[3, 'h'], h=None)
+    records = list(spec.iter_diff(sp, other))
+    # in order of the locations
+    assert_equal([r[0] for r in records],
+                 [('a',), ('b', 'd'), ('e',), ('g',), ('h',)])
+    assert_true('ndiff' in records[0][1])
+    assert_true('arraydiff' in records[1][1])
+    assert_true('seqmatch' in records[2][1])
+    assert_equal(records[3][1:], ({'from': True, '%%magic%%': 'diff'},
+                                  True, None))
+    assert_equal(records[4][2:], (None, None))
+    # the same records as in a difference tree
+    dtree = spec.diff(sp, other)
+    for path, record, fr, to in records:
+        node = dtree
+        for key in path:
+            node = node[key]
+        assert_equal(sorted(node), sorted(record))
+    # recursively compared lists
+    records = list(spec.iter_diff(sp, other, recursive_list=True))
+    assert_equal([r[0] for r in records],
+                 [('a',), ('b', 'd'), ('e', 1), ('g',), ('h',)])
+    assert_equal(records[2][2:], ('f', 'h'))
+    # pruned subtrees are not compared
+    seen = []
+    def prune(path):
+        seen.append(path)
+        return path[0] in ('b', 'g')
+    assert_equal([r[0] for r in spec.iter_diff(sp, other, prune=prune)],
+                 [('a',), ('e',), ('h',)])
+    assert_false(('b', 'd') in seen)
+    # identical subtrees of SPECs are skipped
+    content = '{"id": "x", "version": 0, "tests": {"a": [1, 2], "b": "c"}}'
+    other = spec.SPEC(content)
+    other['tests']['b'] = 'd'
+    assert_equal([r[0] for r in spec.SPEC(content).iter_diff(other)],
+                 [('tests', 'b')])
+
+def test_json_nonfinite():
+    import sys
+    from six import StringIO
+    from testkraut.cmdline.cmd_diff import print_json
+    fr = [0.0, 1.0, 2.0, 3.0]
+    to = [0.5, float('nan'), float('inf'), 3.0]
+    record = spec.diff(fr, to)
+    out = StringIO()
+    stdout, sys.stdout = sys.stdout, out
+    try:
+        print_json(('tests',), record, fr, to, [])
+    finally:
+        sys.stdout = stdout
+    # valid JSON, even with non-finite values
+    def no_constant(name):
+        raise ValueError("invalid JSON constant '%s'" % name)
+    summary = json.loads(out.getvalue(), parse_constant=no_constant)
+    assert_equal(summary['location'], ['tests'])
+    assert_equal(summary['arraydiff']['max_abs'], None)
+    assert_equal(summary['arraydiff']['top'],
+                 [[1, 1.0, 'NaN'], [2, 2.0, 'Infinity'], [0, 0.0, 0.5]])
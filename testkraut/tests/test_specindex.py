@@ -0,0 +1,61 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the testkraut package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+""""""
+
+__docformat__ = 'restructuredtext'
+
+import os
+from os.path import join as opj
+from nose.tools import *
+from testkraut.specindex import SpecIndex
+from testkraut.utils import sha1sum
+from .utils import with_tempdir
+
+def _write_spec(path, spec_id):
+    open(path, 'w').write('{"id": "%s", "version": 0, "tests": []}'
+                          % spec_id)
+
+@with_tempdir()
+def test_spec_index(wdir):
+    lib = opj(wdir, 'library')
+    os.makedirs(opj(lib, 'first'))
+    os.makedirs(opj(lib, 'empty'))
+    _write_spec(opj(lib, 'first', 'spec.json'), 'one')
+    _write_spec(opj(lib, 'second.json'), 'two')
+    mtime = 1000000000
+    os.utime(opj(lib, 'second.json'), (mtime, mtime))
+    open(opj(lib, 'broken.json'), 'w').write('{')
+    index = SpecIndex(opj(wdir, 'index.sqlite'))
+    specs = index.refresh([lib])
+    assert_equal([s[:2] for s in specs],
+                 [(opj(lib, 'broken.json'), None),
+                  (opj(lib, 'first', 'spec.json'), 'one'),
+                  (opj(lib, 'second.json'), 'two')])
+    assert_false(specs[0][2] is None)
+    assert_equal(index.get_sha1(opj(lib, 'second.json')),
+                 sha1sum(opj(lib, 'second.json')))
+    # lookup by directory name and by ID
+    assert_equal(index.find('first', [lib]), opj(lib, 'first', 'spec.json'))
+    assert_equal(index.find('two', [lib]), opj(lib, 'second.json'))
+    assert_equal(index.find('broken', [lib]), None)
+    # unchanged files are not loaded again -- a content change that keeps
+    # size and mtime goes unnoticed
+    _write_spec(opj(lib, 'second.json'), 'zwo')
+    os.utime(opj(lib, 'second.json'), (mtime, mtime))
+    index = SpecIndex(opj(wdir, 'index.sqlite'))
+    assert_equal(index.refresh([lib])[2][1], 'two')
+    # modified, new, and removed files
+    os.utime(opj(lib, 'second.json'), (mtime, mtime + 10))
+    _write_spec(opj(lib, 'empty', 'spec.json'), 'three')
+    os.remove(opj(lib, 'broken.json'))
+    assert_equal([s[1] for s in index.refresh([lib])], ['three', 'one', 'zwo'])
+    assert_equal(index.find('two', [lib]), None)
+    # a stale entry triggers a refresh
+    os.rename(opj(lib, 'first'), opj(lib, 'moved'))
+    assert_equal(index.find('one', [lib]), opj(lib, 'moved', 'spec.json'))
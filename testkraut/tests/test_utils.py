@@ -63,3 +63,53 @@ def test_strace_wrapper(wdir):
 #    assert_equal(utils.get_debian_pkgname('/etc/deluser.conf'), 'adduser')
 
 
+def test_run_command():
+    ret = utils.run_command('echo out1; echo err1 >&2; printf "out2\\n\\nout3"')
+    assert_equal(ret['retval'], 0)
+    assert_equal(ret['stdout'], ['out1', 'out2', '', 'out3'])
+    assert_equal(ret['stderr'], ['err1'])
+    assert_equal(len(ret['merged']), 5)
+    # lines of both channels, in order of arrival (which is not deterministic
+    # across channels)
+    assert_equal(sorted([m.split(' ')[0] for m in ret['merged']]),
+                 ['stderr'] + ['stdout'] * 4)
+    stdout_lines = [m for m in ret['merged'] if m.startswith('stdout ')]
+    assert_true(stdout_lines[0].endswith(':out1'))
+    ret = utils.run_command('exit 3')
+    assert_equal(ret['retval'], 3)
+    assert_equal(ret['stdout'], [])
+    # much more than a pipe buffer on both channels, spooled
+    ret = utils.run_command(
+            'yes stdout 2> /dev/null | head -n 100000; '
+            'yes stderr 2> /dev/null | head -n 100000 >&2',
+            spool_size=1024)
+    assert_equal(ret['retval'], 0)
+    assert_false('merged' in ret)
+    assert_equal(ret['stdout'].read(), 'stdout\n' * 100000)
+    assert_equal(len(ret['stderr'].read()), 700000)
+
+
+@with_tempdir()
+def test_hash_files(wdir):
+    import hashlib
+    files = []
+    for i in range(20):
+        files.append(opj(wdir, 'file%i' % i))
+        # exceed a single read
+        open(files[-1], 'wb').write(str(i) * (1024 * 1024 + i))
+    progress = []
+    hashes = utils.hash_files(files, digests=('sha1', 'md5'), nthreads=4,
+                              progress=lambda *args: progress.append(args))
+    assert_equal(sorted(hashes.keys()), sorted(files))
+    for fname in files:
+        content = open(fname, 'rb').read()
+        assert_equal(hashes[fname], dict(sha1=hashlib.sha1(content).hexdigest(),
+                                         md5=hashlib.md5(content).hexdigest()))
+        assert_equal(utils.sha1sum(fname), hashes[fname]['sha1'])
+    assert_equal([p[:2] for p in progress], [(i, 20) for i in range(1, 21)])
+    assert_equal(sorted([p[2] for p in progress]), sorted(files))
+    # serial and empty
+    assert_equal(utils.hash_files(files[:3], nthreads=1),
+                 dict([(f, dict(sha1=hashes[f]['sha1'])) for f in files[:3]]))
+    assert_equal(utils.hash_files([]), {})
+    assert_raises(IOError, utils.hash_files, [opj(wdir, 'missing')] + files)
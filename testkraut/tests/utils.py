@@ -30,3 +30,105 @@ def with_tempdir(*targs, **tkwargs):
         newfunc = make_decorator(func)(newfunc)
         return newfunc
     return decorate
+
+class HashStoreServer(object):
+    """Local stand-in for a hash store web server
+
+    Serves the content of a dict (keyed by URL path, without the leading
+    slash) with keep-alive connections and support for range requests.
+
+    Parameters
+    ----------
+    files : dict
+    truncate : int or None
+      If given, responses are cut off after this many bytes.
+    delay : float
+      Seconds to wait before answering a request.
+
+    The number of connections, all requests, and the maximum number of
+    concurrently answered GET requests (``max_active``) are recorded.
+    """
+    def __init__(self, files, truncate=None, delay=0):
+        import time
+        import threading
+        from six.moves import BaseHTTPServer, socketserver
+        store = self
+        self.files = files
+        self.truncate = truncate
+        self.delay = delay
+        self.connections = 0
+        self.requests = []
+        self.max_active = 0
+        active = []
+        active_lock = threading.Lock()
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+                store.connections += 1
+
+            def do_HEAD(self):
+                time.sleep(store.delay)
+                store.requests.append((self.path[1:], 'HEAD'))
+                self.send_response(200 if self.path[1:] in store.files
+                                   else 404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def do_GET(self):
+                with active_lock:
+                    active.append(self)
+                    store.max_active = max(store.max_active, len(active))
+                try:
+                    self._get()
+                finally:
+                    with active_lock:
+                        active.remove(self)
+
+            def _get(self):
+                time.sleep(store.delay)
+                name = self.path[1:]
+                store.requests.append((name, self.headers.get('Range')))
+                if not name in store.files:
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                content = store.files[name]
+                offset = 0
+                if not self.headers.get('Range') is None:
+                    offset = int(self.headers['Range'][6:].rstrip('-'))
+                    if offset >= len(content):
+                        self.send_response(416)
+                        self.send_header('Content-Length', '0')
+                        self.end_headers()
+                        return
+                    self.send_response(206)
+                else:
+                    self.send_response(200)
+                content = content[offset:]
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                if not store.truncate is None:
+                    self.wfile.write(content[:store.truncate])
+                    self.close_connection = 1
+                    return
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        self._server = Server(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%i/' % self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
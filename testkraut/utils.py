@@ -12,34 +12,41 @@ __docformat__ = 'restructuredtext'
 
 import os
 import re
+import errno
 import subprocess
 import logging
 import select
 import datetime
+import time
 import hashlib
+import itertools
 import platform
 import testkraut
 from os.path import join as opj
 
 from six import string_types, iteritems
-from six.moves.urllib.request import urlopen
-from six.moves.urllib.error import URLError, HTTPError
 
 from .pkg_mngr import PkgManager
 from .spec import SPEC
 
 lgr = logging.getLogger(__name__)
 
-def which(program):
+def which(program, env=None):
     """
     http://stackoverflow.com/questions/377017/test-if-executable-exists-in-python
+
+    If ``env`` is given, the search path is taken from this mapping instead
+    of ``os.environ``.
     """
+    if env is None:
+        env = os.environ
+
     def is_exe(fpath):
         return os.path.exists(fpath) and os.access(fpath, os.X_OK)
 
     def ext_candidates(fpath):
         yield fpath
-        for ext in os.environ.get("PATHEXT", "").split(os.pathsep):
+        for ext in env.get("PATHEXT", "").split(os.pathsep):
             yield fpath + ext
 
     fpath, fname = os.path.split(program)
@@ -47,7 +54,7 @@ def which(program):
         if is_exe(program):
             return program
     else:
-        for path in os.environ["PATH"].split(os.pathsep):
+        for path in env.get("PATH", os.defpath).split(os.pathsep):
             exe_file = os.path.join(path, program)
             for candidate in ext_candidates(exe_file):
                 if is_exe(candidate):
@@ -56,63 +63,153 @@ def which(program):
     return None
 
 
+_envvar_regex = re.compile(r'\$(\w+|\{[^}]*\})')
+
+def expandvars(path, env=None):
+    """Like ``os.path.expandvars()``, but with a custom environment mapping
+
+    Unknown variables are left unchanged.
+    """
+    if env is None:
+        return os.path.expandvars(path)
+    if not '$' in path:
+        return path
+
+    def _expand(match):
+        name = match.group(1)
+        if name.startswith('{'):
+            name = name[1:-1]
+        return env.get(name, match.group(0))
+    return _envvar_regex.sub(_expand, path)
+
+
 class Stream(object):
-    # this has been taken from Nipype (BSD-3-clause license)
-    """Function to capture stdout and stderr streams with timestamps
+    """Capture the output of a file descriptor with timestamps
+
+    Data is read in large chunks, and each chunk is stamped with the time it
+    was read. Splitting into lines and formatting of timestamps only happens
+    when the output is requested. If ``spool_size`` is given, captured data
+    is kept in a temporary file that is rolled over to disk once it exceeds
+    this size (in bytes).
 
+    Originally inspired by output capturing code in Nipype (BSD-3-clause
+    license) and
     http://stackoverflow.com/questions/4984549/merge-and-sync-stdout-and-stderr/5188359#5188359
     """
 
-    def __init__(self, name, impl):
+    def __init__(self, name, impl, spool_size=None, bufsize=65536):
         self._name = name
         self._impl = impl
-        self._buf = ''
-        self._rows = []
-        self._lastidx = 0
+        self._bufsize = bufsize
+        self._chunks = []
+        self._spool = None
+        if not spool_size is None:
+            import tempfile
+            self._spool = tempfile.SpooledTemporaryFile(max_size=spool_size)
+        self.eof = False
 
     def fileno(self):
         "Pass-through for file descriptor."
         return self._impl.fileno()
 
-    def read(self, drain=0):
-        "Read from the file descriptor. If 'drain' set, read until EOF."
-        while self._read(drain) is not None:
-            if not drain:
-                break
-
-    def _read(self, drain):
-        "Read from the file descriptor"
-        fd = self.fileno()
-        buf = os.read(fd, 4096)
-        if not buf and not self._buf:
-            return None
-        if '\n' not in buf:
-            if not drain:
-                self._buf += buf
-                return []
-
-        # prepend any data previously read, then split into lines and format
-        buf = self._buf + buf
-        if '\n' in buf:
-            tmp, rest = buf.rsplit('\n', 1)
+    def read(self):
+        "Read whatever is available (at most one buffer). Returns False on EOF."
+        buf = os.read(self.fileno(), self._bufsize)
+        if not buf:
+            self.eof = True
+            return False
+        if self._spool is None:
+            self._chunks.append((time.time(), buf))
         else:
-            tmp = buf
-            rest = None
-        self._buf = rest
-        now = datetime.datetime.now().isoformat()
-        rows = tmp.split('\n')
-        self._rows += [(now, '%s %s:%s' % (self._name, now, r), r) for r in rows]
-        self._lastidx = len(self._rows)
+            self._spool.write(buf)
+        return True
+
+    def get_spool(self):
+        "Return the spool file (rewound), or None if not spooling."
+        if not self._spool is None:
+            self._spool.seek(0)
+        return self._spool
+
+    def get_stamped_lines(self):
+        """Return all captured lines grouped by the time they were read.
+
+        Returns a list of (timestamp, lines) tuples. A line is stamped with
+        the time its end was read.
+        """
+        groups = []
+        pending = b''
+        for tstamp, buf in self._chunks:
+            buf = pending + buf
+            if not b'\n' in buf:
+                pending = buf
+                continue
+            complete, pending = buf.rsplit(b'\n', 1)
+            groups.append((tstamp, _decode_output(complete).split('\n')))
+        if len(pending):
+            groups.append((self._chunks[-1][0], [_decode_output(pending)]))
+        return groups
+
+
+def _decode_output(buf):
+    if isinstance(buf, str):
+        return buf
+    return buf.decode('utf-8', 'replace')
+
+def _wait_for_streams(streams):
+    # block until all streams reached EOF, without any polling interval
+    open_streams = dict([(s.fileno(), s) for s in streams])
+    if hasattr(select, 'poll'):
+        poller = select.poll()
+        for fd in open_streams:
+            poller.register(fd, select.POLLIN | select.POLLPRI)
+
+        def _wait():
+            return [fd for fd, _ in poller.poll()]
+
+        def _forget(fd):
+            poller.unregister(fd)
+    else:
+        def _wait():
+            return select.select(list(open_streams), [], [])[0]
 
+        def _forget(fd):
+            pass
+    while len(open_streams):
+        try:
+            ready = _wait()
+        except (select.error, IOError, OSError) as e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        for fd in ready:
+            if not open_streams[fd].read():
+                _forget(fd)
+                del open_streams[fd]
 
 
-def run_command(cmdline, cwd=None, env=None, timeout=0.01):
-    # this has been taken from Nipype (BSD-3-clause license)
-    """
-    Run a command, read stdout and stderr, prefix with timestamp. The returned
-    runtime contains a merged stdout+stderr log with timestamps
+def run_command(cmdline, cwd=None, env=None, spool_size=None):
+    """Run a command, and capture stdout and stderr with timestamps
 
-    http://stackoverflow.com/questions/4984549/merge-and-sync-stdout-and-stderr/5188359#5188359
+    The returned dictionary contains the exit code of the command
+    (``retval``), and the output of the command as lists of lines for
+    ``stdout`` and ``stderr``. In addition, ``merged`` is a merged
+    stdout+stderr log where each line is prefixed with the channel name
+    and a timestamp.
+
+    Parameters
+    ----------
+    cmdline : str
+      Command to be executed by a shell.
+    cwd : path or None
+      Working directory for the command.
+    env : dict or None
+      Environment for the command.
+    spool_size : int or None
+      If not None, output is not returned as a list of lines. Instead
+      ``stdout`` and ``stderr`` are file-like objects (positioned at the
+      start) with the captured output. Up to ``spool_size`` bytes per
+      channel are kept in memory, anything beyond is written to disk. No
+      ``merged`` log is returned in this case.
     """
     PIPE = subprocess.PIPE
     proc = subprocess.Popen(cmdline,
@@ -122,38 +219,30 @@ def run_command(cmdline, cwd=None, env=None, timeout=0.01):
                             cwd=cwd,
                             env=env)
     streams = [
-        Stream('stdout', proc.stdout),
-        Stream('stderr', proc.stderr)
+        Stream('stdout', proc.stdout, spool_size=spool_size),
+        Stream('stderr', proc.stderr, spool_size=spool_size)
         ]
-
-    def _process(drain=0):
-        try:
-            res = select.select(streams, [], [], timeout)
-        except select.error as e:
-            if e[0] == errno.EINTR:
-                return
-            else:
-                raise
-        else:
-            for stream in res[0]:
-                stream.read(drain)
-
-    while proc.returncode is None:
-        proc.poll()
-        _process()
-    returncode = proc.returncode
-    _process(drain=1)
+    _wait_for_streams(streams)
+    returncode = proc.wait()
 
     # collect results, merge and return
-    result = {}
-    temp = []
-    for stream in streams:
-        rows = stream._rows
-        temp += rows
-        result[stream._name] = [r[2] for r in rows]
-    temp.sort()
-    result['merged'] = [r[1] for r in temp]
-    result['retval'] = returncode
+    result = {'retval': returncode}
+    if not spool_size is None:
+        for stream in streams:
+            result[stream._name] = stream.get_spool()
+        return result
+    merged = []
+    for i, stream in enumerate(streams):
+        groups = stream.get_stamped_lines()
+        result[stream._name] = [l for g in groups for l in g[1]]
+        merged.extend([(g[0], i, stream._name, g[1]) for g in groups])
+    merged.sort(key=lambda g: g[:2])
+    result['merged'] = []
+    for tstamp, _, name, lines in merged:
+        # format timestamps only once per group of lines
+        prefix = '%s %s:' % (name,
+                             datetime.datetime.fromtimestamp(tstamp).isoformat())
+        result['merged'].extend([prefix + l for l in lines])
     return result
 
 def get_shlibdeps(binary):
@@ -182,10 +271,107 @@ def hash(filename, method):
     return hash.hexdigest()
 
 def sha1sum(filename):
-    return hash(filename, hashlib.sha1())
+    return hash_file(filename)['sha1']
 
 def md5sum(filename):
-    return hash(filename, hashlib.md5())
+    return hash_file(filename, ('md5',))['md5']
+
+# bytes read at once when hashing
+_hash_chunk_size = 1024 * 1024
+
+def hash_file(filename, digests=('sha1',), opener=open):
+    """Compute any number of digests of a file in a single read pass
+
+    Parameters
+    ----------
+    filename : path
+    digests : sequence
+      Names of hashlib algorithms, e.g. 'sha1' or 'md5'.
+    opener : callable
+      Called with the filename and the mode to open the file, e.g. to hash
+      the decompressed content of a compressed file.
+
+    Returns
+    -------
+    dict
+      Hex digests, keyed by algorithm name.
+    """
+    hashers = [(d, hashlib.new(d)) for d in digests]
+    with opener(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(_hash_chunk_size), b''):
+            # hashlib releases the GIL for large updates, hence this runs
+            # concurrently in threads
+            for _, hasher in hashers:
+                hasher.update(chunk)
+    return dict([(d, hasher.hexdigest()) for d, hasher in hashers])
+
+def quicksum(filename, nbytes=1024 * 1024):
+    """SHA1 hash of the first and the last ``nbytes`` of a file
+
+    Much cheaper than a full hash of a large file, but still sufficient to
+    rule out most files that do not match. Files no larger than twice
+    ``nbytes`` are hashed entirely, hence for them the quicksum is identical
+    to their sha1sum.
+    """
+    hasher = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size <= 2 * nbytes:
+            for chunk in iter(lambda: f.read(_hash_chunk_size), b''):
+                hasher.update(chunk)
+        else:
+            hasher.update(f.read(nbytes))
+            f.seek(-nbytes, os.SEEK_END)
+            hasher.update(f.read(nbytes))
+    return hasher.hexdigest()
+
+def hash_files(filenames, digests=('sha1',), nthreads=None, progress=None,
+                opener=open):
+    """Compute digests of many files in parallel
+
+    Parameters
+    ----------
+    filenames : sequence
+    digests : sequence
+      Names of hashlib algorithms; all are computed from a single read pass
+      through each file.
+    nthreads : int or None
+      Number of threads reading and hashing files concurrently. By default,
+      the 'threads' setting in the 'hashing' configuration section is used.
+    progress : callable or None
+      Called with the number of hashed files, the total number of files,
+      and the name of the last hashed file, whenever a file is done.
+    opener : callable
+      See ``hash_file()``.
+
+    Returns
+    -------
+    dict
+      For each file a dictionary with the hex digests, keyed by algorithm
+      name (see ``hash_file()``).
+    """
+    filenames = list(filenames)
+    if nthreads is None:
+        nthreads = int(testkraut.cfg.get('hashing', 'threads', default='4'))
+    nthreads = max(1, min(nthreads, len(filenames)))
+    def _hash(filename):
+        return filename, hash_file(filename, digests, opener)
+    if nthreads == 1:
+        results = itertools.imap(_hash, filenames)
+        pool = None
+    else:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(nthreads)
+        results = pool.imap_unordered(_hash, filenames)
+    hashes = {}
+    try:
+        for filename, filehashes in results:
+            hashes[filename] = filehashes
+            if not progress is None:
+                progress(len(hashes), len(filenames), filename)
+    finally:
+        if not pool is None:
+            pool.terminate()
+    return hashes
 
 def _get_next_pid_id(procs, pid):
     base_pid = pid
@@ -529,18 +715,18 @@ def get_spec(spec_def, libraries=None):
     ID that is search for in any configured library location (plus
     additional libraries passed via ``libraries``).
     """
+    from .specindex import get_spec_index
     spec = None
     # look for the SPEC in any possible library
-    for tld in get_test_library_paths(libraries):
-        testlib_filepath = opj(tld, spec_def, 'spec.json')
-        if os.path.isfile(testlib_filepath):
-            lgr.debug("located SPEC for test '%s' in library at '%s'"
-                      % (spec_def, tld))
-            spec = SPEC(open(testlib_filepath))
-            break
-        else:
-            lgr.debug("did not find SPEC for test '%s' in library at '%s'"
-                      % (spec_def, tld))
+    testlib_filepath = get_spec_index().find(spec_def,
+                                             get_test_library_paths(libraries))
+    if not testlib_filepath is None:
+        lgr.debug("located SPEC for test '%s' at '%s'"
+                  % (spec_def, testlib_filepath))
+        spec = SPEC(open(testlib_filepath))
+    else:
+        lgr.debug("did not find SPEC for test '%s' in any library"
+                  % spec_def)
     if spec is None and os.path.isfile(spec_def):
         # open explicit spec file
         spec = SPEC(open(spec_def))
@@ -555,23 +741,87 @@ def get_spec(spec_def, libraries=None):
                              "of a test in any of the configured libraries.")
     return spec
 
-def get_filecache_dir():
-    """Return the path to the file cache.
-
-    Implements XDG Base Directory Specification, hence allows overwriting the
-    config setting with $XDG_CACHE_HOME.
-    """
+def _get_cache_root():
+    # implements the XDG Base Directory Specification
     cacheroot = os.environ.get('XDG_CACHE_HOME',
                                os.path.expanduser(opj('~', '.cache')))
     if not os.path.isabs(cacheroot):
         lgr.debug("freedesktop.org standard dictates to ignore non-absolute "
                   "XDG_CACHE_HOME setting '%s'" % cacheroot)
         cacheroot = os.path.expanduser(opj('~', '.cache'))
+    return cacheroot
+
+def get_filecache_dir():
+    """Return the path to the file cache.
+
+    Implements XDG Base Directory Specification, hence allows overwriting the
+    config setting with $XDG_CACHE_HOME.
+    """
     cachepath = os.path.expandvars(
             testkraut.cfg.get('cache', 'files',
-                              default=opj(cacheroot, 'testkraut', 'filecache')))
+                              default=opj(_get_cache_root(), 'testkraut',
+                                          'filecache')))
+    return cachepath
+
+def get_runcache_dir():
+    """Return the path to the cache of test run results.
+
+    Implements XDG Base Directory Specification, hence allows overwriting the
+    config setting with $XDG_CACHE_HOME.
+    """
+    cachepath = os.path.expandvars(
+            testkraut.cfg.get('cache', 'runs',
+                              default=opj(_get_cache_root(), 'testkraut',
+                                          'runcache')))
     return cachepath
 
+def get_fileindex_dir():
+    """Return the path to the indices of local data directories.
+
+    Implements XDG Base Directory Specification, hence allows overwriting the
+    config setting with $XDG_CACHE_HOME.
+    """
+    cachepath = os.path.expandvars(
+            testkraut.cfg.get('cache', 'file index',
+                              default=opj(_get_cache_root(), 'testkraut',
+                                          'fileindex')))
+    return cachepath
+
+def get_specindex_filename():
+    """Return the path to the index of SPECs in test libraries.
+
+    Implements XDG Base Directory Specification, hence allows overwriting the
+    config setting with $XDG_CACHE_HOME.
+    """
+    cachepath = os.path.expandvars(
+            testkraut.cfg.get('cache', 'spec index',
+                              default=opj(_get_cache_root(), 'testkraut',
+                                          'specindex.sqlite')))
+    return cachepath
+
+def get_workflowcache_dir():
+    """Return the path to the cache of persistent workflow execution dirs.
+
+    Implements XDG Base Directory Specification, hence allows overwriting the
+    config setting with $XDG_CACHE_HOME.
+    """
+    cachepath = os.path.expandvars(
+            testkraut.cfg.get('cache', 'workflows',
+                              default=opj(_get_cache_root(), 'testkraut',
+                                          'workflows')))
+    return cachepath
+
+def get_process_budget():
+    """Return the number of processes all concurrently running tests may use
+
+    Defaults to the number of CPUs in the system.
+    """
+    budget = testkraut.cfg.get('testrun', 'process budget', default='')
+    if not len(budget):
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    return max(1, int(budget))
+
 
 def describe_python_module(type_, location, entities, pkgdb=None):
     from modulefinder import ModuleFinder
@@ -611,12 +861,12 @@ def describe_python_module(type_, location, entities, pkgdb=None):
         #                        pkgdb=pkgdb))
     return fhash
 
-def describe_binary(type_, location, entities, pkgdb=None):
+def describe_binary(type_, location, entities, pkgdb=None, env=None):
     spec = dict(location=location)
-    actual_path = os.path.expandvars(location)
+    actual_path = expandvars(location, env)
     if not os.path.exists(actual_path):
         # maybe just a command, get first in search path
-        actual_path = which(location)
+        actual_path = which(location, env)
         if actual_path is None:
             lgr.debug("cannot find %s for path/command '%s' -> '%s'"
                       % (type_, location, actual_path))
@@ -648,14 +898,14 @@ def describe_binary(type_, location, entities, pkgdb=None):
         spec['interpreter'] = describe_binary('executable',
                                               interpreter_path.split()[0],
                                               entities,
-                                              pkgdb=pkgdb)
+                                              pkgdb=pkgdb, env=env)
     except ValueError:
         # not sure what this was
         pass
     for dep in shlibdeps:
         spec['shlibdeps'].append(
                 describe_binary('library', dep, entities,
-                                pkgdb=pkgdb))
+                                pkgdb=pkgdb, env=env))
 #    # provided by a package?
 #    pkgname = self._pkg_mngr.get_pkg_name(fpath)
 #    if not pkgname is None:
@@ -671,33 +921,34 @@ def describe_binary(type_, location, entities, pkgdb=None):
     return fhash
 
 
-def download_file(url, dst):
+def download_file(url, dst, sha1=None):
     """Download file from a URL to a destination path
 
+    The download is streamed to disk (see ``hashstore.fetch()``).
+
+    Parameters
+    ----------
+    sha1 : str or None
+      If given, the download is rejected unless the SHA1 hash of the
+      content matches.
+
     Returns
     -------
     None or path
       None is returned whenever the download failed.
     """
-    try:
-        urip = urlopen(url)
-        if os.path.exists(dst) or os.path.lexists(dst):
-            lgr.debug("removing existing file/link at '%s'" % dst)
-            os.remove(dst)
-        fp = open(dst, 'wb')
-        lgr.debug("download '%s'->'%s'" % (url, dst))
-        fp.write(urip.read())
-        fp.close()
-        return dst
-    except HTTPError:
-        lgr.debug("cannot find '%s' at '%s'" % (sha1, hp))
-    except URLError:
-        lgr.debug("cannot connect to at '%s'" % hp)
-    return None
+    from .hashstore import fetch
+    return fetch(url, dst, sha1=sha1)
 
-def _resolve_metric_value(val, metrics):
+def _resolve_metric_value(val, metrics, exec_info=None):
     if isinstance(val, string_types) and val.startswith('@metric:'):
         mid = val[8:]
         val = metrics[mid]
+    elif isinstance(val, string_types) and val.startswith('@exec:') \
+            and not exec_info is None:
+        # path into the execution info, e.g. @exec:0:resources:wallclock
+        for key in val[6:].split(':'):
+            exec_info = exec_info[key]
+        val = exec_info
     return val
 